@@ -3,21 +3,37 @@ from typing import Final
 # Common params
 RANDOM_SEED: Final[int] = 228
 THREAD_COUNT: Final[int] = 4
+# параллельный перебор сетки GB/NGB/TabNet: GRID_CPU_BUDGET ядер делятся между
+# GRID_WORKERS процессами, каждому достаётся GRID_CPU_BUDGET // GRID_WORKERS потоков
+GRID_WORKERS: Final[int] = 1
+GRID_CPU_BUDGET: Final[int] = THREAD_COUNT
 
 # Forecast params
 HORIZON: Final[int] = 6
 VALID_LEN: Final[int] = 12
 TEST_LEN: Final[int] = 12
 MAX_AVALIABILITY: Final[int] = 3
+# дополнительно к моделям GB/NGB/TabNet по горизонтам обучаются модели на все
+# горизонты сразу (горизонт — признак), их метрики идут в ту же таблицу
+POOLED_HORIZONS: Final[bool] = False
 
 # Catboost params
 START_ITERATIONS: Final[int] = 1000
 EARLY_STOPPING_ROUNDS: Final[int] = 50
+BORDER_COUNT_GB: Final[int] = 254  # границы квантования признаков, как в CatBoost
+# одна модель MultiRMSE на все таргеты вместо модели на каждый таргет;
+# в признаках тогда лаги всех таргетов, поэтому прогнозы отличаются
+MULTI_TARGET_GB: Final[bool] = False
 
 # NGB params
 START_ITERATIONS_NGB: Final[int] = 500
 LEARNING_RATE_NGB: Final[float] = 0.01
 DEPTH_NGB_BASE: Final[int] = 2
+# базовое дерево NGBoost на гистограммах (models/hist_tree.py) вместо
+# DecisionTreeRegressor; до MAX_BINS_NGB_BASE уникальных значений признака
+# разбиения совпадают с точными; меняет прогнозы, поэтому выключено
+HIST_BASE_NGB: Final[bool] = False
+MAX_BINS_NGB_BASE: Final[int] = 255
 EARLY_STOPPING_ROUNDS_NGB: Final[int] = 25
 
 # TabNet params
@@ -28,10 +44,52 @@ LAMBDA_SPARSE_TABNET: Final[float] = 0.005
 MASK_TYPE_TABNET: Final[str] = "sparsemax"
 MAX_EPOCHS_TABNET: Final[int] = 200
 EARLY_STOPPING_ROUNDS_TABNET: Final[int] = 20
+# одна TabNet с выходом на каждый таргет, аналог MULTI_TARGET_GB
+MULTI_TARGET_TABNET: Final[bool] = False
+# TabNet учится на заранее собранных тензорах float32 без DataLoader
+# (models/tabnet_engine.py); результат тот же, что с DataLoader
+TENSOR_BATCHES_TABNET: Final[bool] = True
+# потоки torch: батчи из 8 строк не распараллеливаются, а лишние потоки
+# конкурируют с CatBoost (THREAD_COUNT), если пайплайны идут параллельно
+TORCH_THREAD_COUNT: Final[int] = 1
+# обученные TabNet сохраняются модулями TorchScript вместе с маской колонок и
+# StandardScaler: прогноз без pytorch_tabnet (models/tabnet_script.py)
+EXPORT_TABNET_SCRIPT: Final[bool] = False
+TABNET_SCRIPT_DIR: Final[str] = "cache/tabnet_script"
+# батчи длиннее (сценарии) не копируются во входной тензор модуля, иначе
+# каждый модуль держал бы в памяти буфер под самый большой батч
+TABNET_SCRIPT_BUFFER_ROWS: Final[int] = 1024
+# предобучение TabNetPretrainer одно на (features_type, avaliability) по дизайнам
+# всех таргетов и горизонтов; его веса — начальные для всех ячеек группы
+PRETRAIN_TABNET: Final[bool] = False
+PRETRAINING_RATIO_TABNET: Final[float] = 0.5  # доля маскируемых признаков
+PRETRAIN_MAX_EPOCHS_TABNET: Final[int] = 100
+PRETRAIN_EARLY_STOPPING_ROUNDS_TABNET: Final[int] = 10
+PRETRAIN_BATCH_SIZE_TABNET: Final[int] = 64
+# ранняя остановка дообучения от предобученных весов
+FINETUNE_EARLY_STOPPING_ROUNDS_TABNET: Final[int] = 10
 
 # DFM params
 K_FACTORS_GRID = [1, 2]
 FACTOR_ORDER_GRID = [1]
+DFM_MAXITER: Final[int] = 5000
+# тёплый старт: окно начинает Nelder–Mead с параметров предыдущего окна той же
+# конфигурации; если llf на наблюдение упал сильнее DFM_WARM_START_LLF_TOL
+# относительно предыдущего окна, делается и холодный старт, берётся лучший.
+# Nelder–Mead здесь не сходится за DFM_MAXITER, поэтому тёплый старт меняет
+# прогнозы (на тесте RMSE выше) — по умолчанию выключен
+DFM_WARM_START: Final[bool] = False
+DFM_WARM_MAXITER: Final[int] = 1000
+DFM_WARM_MAXFUN: Final[int] = 3000
+DFM_WARM_START_LLF_TOL: Final[float] = 1.0
+# параметры DFM переоцениваются раз в DFM_REFIT_EVERY окон, в остальных окнах
+# модель дообновляется новыми наблюдениями через фильтр Калмана (1 — каждое окно)
+DFM_REFIT_EVERY: Final[int] = 1
+# "statsmodels" — DynamicFactor с признаками в exog, "collapsed" — схлопнутая
+# факторная модель с EM (models/collapsed_dfm.py) для сотен рядов
+DFM_ENGINE: Final[str] = "statsmodels"
+COLLAPSED_DFM_MAXITER: Final[int] = 500
+COLLAPSED_DFM_TOL: Final[float] = 1e-6
 
 # features params
 ROLLING_WINDOWS_MONTH: Final[list[int]] = [3, 6, 12]
@@ -45,3 +103,42 @@ GIGA_DATA_PATH: Final[str] = "data/giga_data_ready_07_2025.xlsx"
 FRED_DATA_PATH: Final[str] = "data/fred_data.xlsx"
 CBR_DATA_PATH: Final[str] = "data/cbr_data.xlsx"
 QUARTERLY_DATA_PATH: Final[str] = "data/quarterly_data.xlsx"
+
+# giga data parser params
+GIGA_PARSER_ENGINE: Final[str] = "calamine"  # "calamine" или "pandas"
+GIGA_PARSER_WORKERS: Final[int] = 1  # >1 — параллельный парсинг листов процессами
+
+# preprocessing params
+LAZY_PREPROCESSING: Final[bool] = False  # один ленивый план polars на весь DataE2E
+POLARS_ENGINE: Final[str] = "auto"  # "streaming" для больших панелей
+
+# cache params
+USE_RAW_CACHE: Final[bool] = True
+RAW_CACHE_DIR: Final[str] = "cache/raw"
+USE_FEATURE_STORE: Final[bool] = True
+FEATURE_STORE_DIR: Final[str] = "cache/features"
+# дообновление признаков по новым месяцам вместо полного пересчёта;
+# при пересмотре истории сырых данных всё равно делается полный пересчёт
+INCREMENTAL_FEATURES: Final[bool] = True
+VERIFY_INCREMENTAL_FEATURES: Final[bool] = False  # сверять с полным пересчётом
+# число закэшированных numpy-блоков признаков (выборка, колонки, лаг)
+DESIGN_CACHE_SIZE: Final[int] = 512
+# обученные модели сохраняются и при следующем запуске загружаются вместо
+# повторного обучения; сверх MODEL_STORE_MAX_SIZE_MB удаляются давно не
+# использованные
+USE_MODEL_STORE: Final[bool] = True
+MODEL_STORE_DIR: Final[str] = "cache/models"
+MODEL_STORE_MAX_SIZE_MB: Final[float] = 2048
+# квантованные пулы CatBoost (Pool.save) и их границы квантования
+# сохраняются в POOL_STORE_DIR только при SAVE_QUANTIZED_POOLS; иначе
+# границы пишутся во временный каталог на время квантования
+SAVE_QUANTIZED_POOLS: Final[bool] = False
+POOL_STORE_DIR: Final[str] = "cache/pools"
+
+# nowcast service params
+# прогноз по свежей версии данных всеми моделями из манифестов хранилища
+# моделей; признаки и прогнозы хранятся в памяти для NOWCAST_VINTAGE_CACHE_SIZE
+# последних версий данных
+NOWCAST_VINTAGE_CACHE_SIZE: Final[int] = 4
+NOWCAST_HOST: Final[str] = "127.0.0.1"
+NOWCAST_PORT: Final[int] = 8050
@@ -1,3 +1,4 @@
+import config
 from pipelines.run_dfm_test import run_main_dfm
 from pipelines.run_gb_test import run_main_gb
 from pipelines.run_metrics import run_metrics
@@ -5,11 +6,15 @@ from pipelines.run_ngb_test import run_main_ngb
 from pipelines.run_tabnet_test import run_main_tabnet
 
 if __name__ == "__main__":
-    run_main_gb()  # считается быстро, можно ускорять увеличивая THREAD_COUNT в config.py
-    run_main_ngb()  # считается быстро, можно ускорять увеличивая THREAD_COUNT в config.py
-    run_main_tabnet()  # считается быстро, можно ускорять увеличивая THREAD_COUNT в config.py
-    # run_main_dfm() # считается долго, много опций гиперпараметров, плюс прогноз рекурсивный
-    # можно не запускать без необходимости
+    run_main_gb()  # считается быстро, можно ускорять увеличивая GRID_WORKERS в config.py
+    run_main_ngb()  # считается быстро, можно ускорять увеличивая GRID_WORKERS в config.py
+    run_main_tabnet()  # считается быстро, можно ускорять увеличивая GRID_WORKERS в config.py
+    run_main_dfm()  # самый долгий этап, ускоряется увеличением GRID_WORKERS в config.py
+    if config.POOLED_HORIZONS:
+        # модели на все горизонты сразу, для сравнения с моделями по горизонтам
+        run_main_gb(pooled_horizons=True)
+        run_main_ngb(pooled_horizons=True)
+        run_main_tabnet(pooled_horizons=True)
     run_metrics(
         calculate_mfbvar=True, calculate_dfm=True
     )  # Если mfbvar и/или dfm не посчитаны, менять на False
@@ -0,0 +1,252 @@
+import glob
+import json
+import logging
+import os
+import pickle
+import tempfile
+from importlib.metadata import PackageNotFoundError, version
+from typing import Any, Callable, Optional
+
+import attrs
+
+import config
+from models.design import DataT
+from models.fit_planner import FitPlanner
+
+logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+# версия формата хранилища, менять при несовместимых изменениях
+STORE_VERSION = "1"
+
+# константы config, которые модель или её ячейка читают сами, а не через
+# params; правка config одного семейства переобучает только его ячейки
+_FAMILY_CONFIG_KEYS = {
+    "GB": ["RANDOM_SEED", "EARLY_STOPPING_ROUNDS", "BORDER_COUNT_GB"],
+    "NGB": [
+        "RANDOM_SEED",
+        "DEPTH_NGB_BASE",
+        "EARLY_STOPPING_ROUNDS_NGB",
+        "HIST_BASE_NGB",
+        "MAX_BINS_NGB_BASE",
+    ],
+    "TabNetModel": ["TENSOR_BATCHES_TABNET"],
+    "TabNetPretraining": ["TENSOR_BATCHES_TABNET"],
+    "DFM": [
+        "DFM_MAXITER",
+        "DFM_WARM_START",
+        "DFM_WARM_MAXITER",
+        "DFM_WARM_MAXFUN",
+        "DFM_WARM_START_LLF_TOL",
+    ],
+    "CollapsedDFM": ["COLLAPSED_DFM_MAXITER", "COLLAPSED_DFM_TOL"],
+}
+
+_FAMILY_LIBRARIES = {
+    "GB": ["catboost"],
+    "NGB": ["ngboost", "scikit-learn"],
+    "TabNetModel": ["torch", "pytorch-tabnet", "scikit-learn"],
+    "TabNetPretraining": ["torch", "pytorch-tabnet", "scikit-learn"],
+    "DFM": ["statsmodels", "pandas"],
+    "CollapsedDFM": ["pandas"],
+}
+
+_FAMILY_SOURCES = {
+    "GB": ["models/gb.py", "models/catboost_pools.py"],
+    "NGB": ["models/ngb.py", "models/hist_tree.py"],
+    "TabNetModel": [
+        "models/tabnet.py",
+        "models/tabnet_pretraining.py",
+        "models/tabnet_engine.py",
+    ],
+    "TabNetPretraining": ["models/tabnet_pretraining.py", "models/tabnet_engine.py"],
+    "DFM": ["models/dfm.py"],
+    "CollapsedDFM": ["models/dfm.py", "models/collapsed_dfm.py"],
+}
+
+
+def _library_version(name: str) -> Optional[str]:
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return None
+
+
+# Хранилище обученных моделей на диске: ключ — хэш семейства модели, её
+# параметров, колонок и данных обучения, констант config, версий библиотек
+# и кода модели. Самые давно использованные модели удаляются при
+# превышении max_size_mb.
+@attrs.define(slots=True)
+class ModelArtifactStore:
+    store_dir: str = config.MODEL_STORE_DIR
+    enabled: bool = config.USE_MODEL_STORE
+    max_size_mb: float = config.MODEL_STORE_MAX_SIZE_MB
+
+    @staticmethod
+    def fingerprint(family: str, *parts: Any) -> str:
+        sources = []
+        for path in ["models/design.py"] + _FAMILY_SOURCES.get(family, []):
+            with open(path, "rb") as file:
+                sources.append(file.read().decode())
+
+        return FitPlanner.fingerprint(
+            STORE_VERSION,
+            family,
+            {key: getattr(config, key) for key in _FAMILY_CONFIG_KEYS.get(family, [])},
+            {
+                library: _library_version(library)
+                for library in ["numpy"] + _FAMILY_LIBRARIES.get(family, [])
+            },
+            sources,
+            *parts,
+        )[:32]
+
+    @staticmethod
+    def pretraining_key(pretraining: Any, train: DataT, valid: DataT) -> str:
+        return ModelArtifactStore.fingerprint(
+            type(pretraining).__name__,
+            pretraining.params,
+            pretraining.features_type,
+            pretraining.avaliability,
+            pretraining.target_grid,
+            pretraining.horizon_grid,
+            pretraining._get_design(train),
+            pretraining._get_design(valid),
+        )
+
+    @staticmethod
+    def model_key(model: Any, *data: Optional[DataT]) -> str:
+        # для GB, NGB и TabNetModel: params берутся до fit, который их меняет
+        data_parts = []
+        for split in data:
+            if split is not None and not split.is_empty():
+                data_parts += [model._get_design(split), model._get_target(split)]
+
+        # TabNet, дообученная с предобучения, зависит и от его ключа
+        pretrained_key = getattr(model, "pretrained_key", None)
+        if pretrained_key is not None:
+            data_parts.append(pretrained_key)
+
+        return ModelArtifactStore.fingerprint(
+            type(model).__name__,
+            model.params,
+            model.features_type,
+            model.avaliability,
+            model.target_name,
+            model.horizon,
+            *data_parts,
+        )
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.store_dir, f"{key}.pkl")
+
+    @staticmethod
+    def script_path(key: str) -> str:
+        # модуль TorchScript модели (EXPORT_TABNET_SCRIPT) лежит отдельно, но
+        # входит в размер хранилища и вытесняется вместе с моделью
+        return os.path.join(config.TABNET_SCRIPT_DIR, f"{key}.pt")
+
+    def touch(self, key: str) -> None:
+        # модель использована без загрузки pickle (например, её модуль TorchScript)
+        try:
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def load(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                artifact = pickle.load(file)
+            # время изменения файла — время последнего использования для LRU
+            os.utime(path)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+        return artifact
+
+    def save(self, key: str, artifact: Any) -> None:
+        if not self.enabled:
+            return
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        # запись через временный файл: воркеры пула пишут в одно хранилище
+        fd, tmp_path = tempfile.mkstemp(dir=self.store_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            pickle.dump(artifact, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path(key))
+
+        self._evict()
+
+    def _evict(self) -> None:
+        artifacts = []
+        for path in glob.glob(os.path.join(self.store_dir, "*.pkl")):
+            key = os.path.splitext(os.path.basename(path))[0]
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            size = stat.st_size
+            if os.path.exists(self.script_path(key)):
+                size += os.path.getsize(self.script_path(key))
+            artifacts.append((stat.st_mtime, size, key))
+
+        total_size = sum(size for _, size, _ in artifacts)
+        for _, size, key in sorted(artifacts):
+            if total_size <= self.max_size_mb * 2**20:
+                break
+            for path in (self._path(key), self.script_path(key)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            logger.info(f"Model artifact {key} was evicted")
+            total_size -= size
+
+        # модули TorchScript без модели в хранилище уже не найти по манифестам
+        for path in glob.glob(os.path.join(config.TABNET_SCRIPT_DIR, "*.pt")):
+            key = os.path.splitext(os.path.basename(path))[0]
+            if not os.path.exists(self._path(key)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _manifest_path(self, name: str) -> str:
+        return os.path.join(self.store_dir, f"{name}.json")
+
+    def save_manifest(self, name: str, entries: list[dict]) -> None:
+        # манифест — ключи моделей последнего запуска сетки с их ячейками,
+        # по нему сервис прогнозов находит модели в хранилище
+        if not self.enabled:
+            return
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.store_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as file:
+            json.dump(entries, file, indent=2)
+        os.replace(tmp_path, self._manifest_path(name))
+
+    def load_manifest(self, name: str) -> Optional[list[dict]]:
+        if not self.enabled:
+            return None
+
+        try:
+            with open(self._manifest_path(name)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def get_or_fit(self, key: str, fit: Callable[[], Any]) -> tuple[Any, bool]:
+        # (модель, загружена ли она из хранилища)
+        artifact = self.load(key)
+        if artifact is not None:
+            return artifact, True
+
+        artifact = fit()
+        self.save(key, artifact)
+
+        return artifact, False
@@ -0,0 +1,104 @@
+import os
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator
+
+import numpy as np
+from catboost import Pool
+
+import config
+from models.fit_planner import FitPlanner
+
+# хэш блока колонок -> текст границ квантования в формате
+# save_quantization_borders ("номер колонки\tграница" по строке на границу)
+_borders_cache: OrderedDict = OrderedDict()
+
+
+def _block_borders(X: np.ndarray) -> str:
+    key = FitPlanner.fingerprint(config.BORDER_COUNT_GB, X)
+    cached = _borders_cache.get(key)
+    if cached is not None:
+        _borders_cache.move_to_end(key)
+        return cached
+
+    pool = Pool(X)
+    pool.quantize(border_count=config.BORDER_COUNT_GB)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "borders.tsv")
+        pool.save_quantization_borders(path)
+        with open(path) as file:
+            borders = file.read()
+
+    _borders_cache[key] = borders
+    if len(_borders_cache) > config.DESIGN_CACHE_SIZE:
+        _borders_cache.popitem(last=False)
+
+    return borders
+
+
+def _shift_borders(borders: str, offset: int) -> str:
+    shifted = []
+    for line in borders.splitlines():
+        column, rest = line.split("\t", 1)
+        shifted.append(f"{int(column) + offset}\t{rest}\n")
+
+    return "".join(shifted)
+
+
+def _write_atomic(path: str, write) -> None:
+    # воркеры пула пишут в один каталог, поэтому через временный файл
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def borders_file(X: np.ndarray, shared_columns: int) -> Iterator[str]:
+    # границы считаются по колонкам независимо, поэтому границы блока
+    # признаков (первые shared_columns колонок) одинаковы у всех таргетов и
+    # считаются один раз; отдельно — только колонки лагов таргета
+    borders = _block_borders(X[:, :shared_columns]) + _shift_borders(
+        _block_borders(X[:, shared_columns:]), shared_columns
+    )
+
+    def write(tmp_path: str) -> None:
+        with open(tmp_path, "w") as file:
+            file.write(borders)
+
+    key = FitPlanner.fingerprint(borders)[:32]
+    if not config.SAVE_QUANTIZED_POOLS:
+        # файл нужен CatBoost только на время квантования пулов
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, f"{key}.tsv")
+            write(path)
+            yield path
+        return
+
+    # имя файла границ входит в ключ сохранённых пулов
+    path = os.path.join(config.POOL_STORE_DIR, "borders", f"{key}.tsv")
+    if not os.path.exists(path):
+        _write_atomic(path, write)
+
+    yield path
+
+
+def get_quantized_pool(X: np.ndarray, y: np.ndarray, borders_path: str) -> Pool:
+    # valid квантуется границами train, как это делает сам CatBoost
+    if not config.SAVE_QUANTIZED_POOLS:
+        pool = Pool(data=X, label=y)
+        pool.quantize(input_borders=borders_path)
+        return pool
+
+    key = FitPlanner.fingerprint(X, y, os.path.basename(borders_path))[:32]
+    path = os.path.join(config.POOL_STORE_DIR, f"{key}.bin")
+    if os.path.exists(path):
+        return Pool(f"quantized://{path}")
+
+    pool = Pool(data=X, label=y)
+    pool.quantize(input_borders=borders_path)
+    _write_atomic(path, pool.save)
+
+    return pool
@@ -0,0 +1,352 @@
+from typing import Optional
+
+import attrs
+import numpy as np
+import pandas as pd
+import polars as pl
+from scipy.linalg import solve_discrete_lyapunov
+
+import config
+from models.dfm import DFM, FrameDFM
+
+_LOG_2PI = np.log(2 * np.pi)
+
+
+@attrs.define(slots=True)
+class FactorParams:
+    columns: list[str]
+    mean: np.ndarray
+    scale: np.ndarray
+    loadings: np.ndarray
+    sigma2: np.ndarray
+    transition: np.ndarray
+    state_cov: np.ndarray
+    llf: float = np.nan
+
+
+# Факторная модель для больших панелей: z_t = Λ f_t + e_t, e_t ~ N(0, diag σ²),
+# f_t — VAR(factor_order). Таргеты и признаки стандартизуются и входят в z_t
+# вместе. Панель схлопывается (Jungbacker–Koopman) в k_factors рядов одной
+# матричной операцией, поэтому фильтр Калмана работает с размерностью
+# факторов, а не числа рядов. Параметры оцениваются EM с учётом пропусков.
+# Интерфейс и схема прогноза — как у DFM.
+@attrs.define(slots=True)
+class CollapsedDFM(DFM):
+    @staticmethod
+    def _filter_nan_features(train: FrameDFM, features_cols: list[str]) -> list[str]:
+        # пропуски EM учитывает сам, отбрасываются только пустые и
+        # константные ряды
+        std = DFM._select(train, features_cols).std()
+
+        return [col for col, value in std.items() if value > 0]
+
+    @staticmethod
+    def _standardize(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        mean = np.nanmean(values, axis=0)
+        scale = np.nanstd(values, axis=0)
+        scale[~(scale > 0)] = 1.0
+
+        return mean, scale
+
+    def _companion(self, params: FactorParams) -> tuple[np.ndarray, np.ndarray]:
+        k = self.k_factors
+        state_dim = k * self.factor_order
+
+        transition = np.zeros((state_dim, state_dim))
+        transition[:k] = params.transition
+        transition[k:, :-k] = np.eye(state_dim - k)
+
+        state_cov = np.zeros((state_dim, state_dim))
+        state_cov[:k, :k] = params.state_cov
+
+        return transition, state_cov
+
+    @staticmethod
+    def _initial_state_cov(transition: np.ndarray, state_cov: np.ndarray) -> np.ndarray:
+        # безусловная ковариация стационарного VAR, иначе диффузное начало
+        if np.max(np.abs(np.linalg.eigvals(transition))) < 1:
+            initial_cov = solve_discrete_lyapunov(transition, state_cov)
+            if np.all(np.isfinite(initial_cov)):
+                return initial_cov
+
+        return np.eye(len(transition)) * 10.0
+
+    @staticmethod
+    def _collapse(
+        z: np.ndarray, mask: np.ndarray, params: FactorParams
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # GLS-проекция каждой строки на факторы: z*_t = C_t⁻¹ Λ' H⁻¹ z_t,
+        # Cov = C_t⁻¹, C_t = Λ_o' H_o⁻¹ Λ_o по наблюдаемым рядам строки
+        loadings = params.loadings
+        weights = mask / params.sigma2
+        z_filled = np.where(mask, z, 0.0)
+
+        precision = np.einsum("tn,nk,nl->tkl", weights, loadings, loadings)
+        observed = mask.any(axis=1)
+        precision[~observed] = np.eye(loadings.shape[1])
+
+        collapsed = np.linalg.solve(
+            precision, ((z_filled * weights) @ loadings)[:, :, None]
+        )[:, :, 0]
+        collapsed_cov = np.linalg.inv(precision)
+
+        # слагаемое правдоподобия, отброшенное при схлопывании
+        residuals = np.where(mask, z_filled - collapsed @ loadings.T, 0.0)
+        _, logdet_precision = np.linalg.slogdet(precision)
+        llf_correction = -0.5 * (
+            (mask.sum(axis=1) - loadings.shape[1]) * _LOG_2PI
+            + (mask * np.log(params.sigma2)).sum(axis=1)
+            + logdet_precision
+            + (residuals**2 * weights).sum(axis=1)
+        )
+        llf_correction[~observed] = 0.0
+
+        return collapsed, collapsed_cov, observed, llf_correction
+
+    def _kalman(
+        self, z: np.ndarray, mask: np.ndarray, params: FactorParams, smooth: bool
+    ) -> dict:
+        k = self.k_factors
+        transition, state_cov = self._companion(params)
+        state_dim = len(transition)
+        n_obs = len(z)
+
+        collapsed, collapsed_cov, observed, llf_correction = self._collapse(
+            z, mask, params
+        )
+
+        state_pred = np.zeros((n_obs + 1, state_dim))
+        cov_pred = np.zeros((n_obs + 1, state_dim, state_dim))
+        state_filt = np.zeros((n_obs, state_dim))
+        cov_filt = np.zeros((n_obs, state_dim, state_dim))
+        cov_pred[0] = self._initial_state_cov(transition, state_cov)
+
+        llf = llf_correction.sum()
+        for t in range(n_obs):
+            if observed[t]:
+                innovation = collapsed[t] - state_pred[t, :k]
+                innovation_cov = cov_pred[t, :k, :k] + collapsed_cov[t]
+                gain = np.linalg.solve(innovation_cov, cov_pred[t, :k, :]).T
+
+                state_filt[t] = state_pred[t] + gain @ innovation
+                cov_filt[t] = cov_pred[t] - gain @ cov_pred[t, :k, :]
+
+                _, logdet = np.linalg.slogdet(innovation_cov)
+                llf -= 0.5 * (
+                    k * _LOG_2PI
+                    + logdet
+                    + innovation @ np.linalg.solve(innovation_cov, innovation)
+                )
+            else:
+                state_filt[t] = state_pred[t]
+                cov_filt[t] = cov_pred[t]
+
+            state_pred[t + 1] = transition @ state_filt[t]
+            cov_pred[t + 1] = transition @ cov_filt[t] @ transition.T + state_cov
+
+        result = {"state_filt": state_filt, "llf": llf}
+        if not smooth:
+            return result
+
+        # сглаживание Rauch–Tung–Striebel и ковариации соседних состояний для EM
+        state_smooth = state_filt.copy()
+        cov_smooth = cov_filt.copy()
+        cov_lag = np.zeros((n_obs, state_dim, state_dim))
+        for t in range(n_obs - 2, -1, -1):
+            smoother_gain = cov_filt[t] @ transition.T @ np.linalg.pinv(cov_pred[t + 1])
+            state_smooth[t] = state_filt[t] + smoother_gain @ (
+                state_smooth[t + 1] - state_pred[t + 1]
+            )
+            cov_smooth[t] = (
+                cov_filt[t]
+                + smoother_gain
+                @ (cov_smooth[t + 1] - cov_pred[t + 1])
+                @ smoother_gain.T
+            )
+            cov_lag[t + 1] = cov_smooth[t + 1] @ smoother_gain.T
+
+        result.update(state_smooth=state_smooth, cov_smooth=cov_smooth, cov_lag=cov_lag)
+        return result
+
+    def _em_step(
+        self, z: np.ndarray, mask: np.ndarray, params: FactorParams, smoothed: dict
+    ) -> FactorParams:
+        k = self.k_factors
+        state = smoothed["state_smooth"]
+        cov = smoothed["cov_smooth"]
+
+        # уравнение наблюдений: регрессия каждого ряда на факторы по его
+        # наблюдаемым строкам (Bańbura–Modugno для диагональной H)
+        factors = state[:, :k]
+        factors_moment = factors[:, :, None] * factors[:, None, :] + cov[:, :k, :k]
+        z_filled = np.where(mask, z, 0.0)
+
+        loadings = np.linalg.solve(
+            np.einsum("tn,tkl->nkl", mask, factors_moment) + 1e-8 * np.eye(k)[None],
+            (z_filled.T @ factors)[:, :, None],
+        )[:, :, 0]
+        sigma2 = (
+            (z_filled**2).sum(axis=0)
+            - 2 * ((z_filled.T @ factors) * loadings).sum(axis=1)
+            + np.einsum("nk,tn,tkl,nl->n", loadings, mask, factors_moment, loadings)
+        ) / np.maximum(mask.sum(axis=0), 1)
+        sigma2 = np.maximum(sigma2, 1e-4)
+
+        # уравнение состояния: VAR(factor_order) по сглаженным моментам
+        lagged = state[:-1]
+        moment_cross = (
+            factors[1:, :, None] * lagged[:, None, :] + smoothed["cov_lag"][1:, :k, :]
+        ).sum(axis=0)
+        moment_lagged = (lagged[:, :, None] * lagged[:, None, :] + cov[:-1]).sum(axis=0)
+        moment_current = factors_moment[1:].sum(axis=0)
+
+        transition = moment_cross @ np.linalg.pinv(moment_lagged)
+        state_cov = (moment_current - transition @ moment_cross.T) / (len(z) - 1)
+        state_cov = (state_cov + state_cov.T) / 2 + 1e-8 * np.eye(k)
+
+        return FactorParams(
+            columns=params.columns,
+            mean=params.mean,
+            scale=params.scale,
+            loadings=loadings,
+            sigma2=sigma2,
+            transition=transition,
+            state_cov=state_cov,
+        )
+
+    def _initial_params(
+        self, z: np.ndarray, mask: np.ndarray, columns: list[str], mean, scale
+    ) -> FactorParams:
+        # старт EM — главные компоненты полностью наблюдаемых рядов; если их
+        # меньше k_factors, то всех рядов с пропусками, заполненными средним
+        # (нулём после стандартизации)
+        k = self.k_factors
+        if len(columns) < k:
+            raise ValueError(
+                f"CollapsedDFM needs at least k_factors={k} series, got {len(columns)}"
+            )
+
+        z_filled = np.where(mask, z, 0.0)
+        full_columns = mask.all(axis=0)
+        panel = z[:, full_columns] if full_columns.sum() >= k else z_filled
+        _, _, components = np.linalg.svd(panel, full_matrices=False)
+        factors = panel @ components[:k].T
+        factors /= factors.std(axis=0)
+
+        loadings = np.linalg.lstsq(factors, z_filled, rcond=None)[0].T
+        sigma2 = np.maximum(
+            np.where(mask, z_filled - factors @ loadings.T, 0.0).var(axis=0), 1e-4
+        )
+
+        lags = np.hstack(
+            [
+                factors[self.factor_order - lag - 1 : len(factors) - lag - 1]
+                for lag in range(self.factor_order)
+            ]
+        )
+        current = factors[self.factor_order :]
+        transition = np.linalg.lstsq(lags, current, rcond=None)[0].T
+        state_cov = np.cov((current - lags @ transition.T).T).reshape(k, k)
+
+        return FactorParams(
+            columns=columns,
+            mean=mean,
+            scale=scale,
+            loadings=loadings,
+            sigma2=sigma2,
+            transition=transition,
+            state_cov=state_cov,
+        )
+
+    def _prepare(self, frame: FrameDFM, columns: list[str], params=None):
+        values = self._select(frame, columns).to_numpy(dtype=np.float64)
+        if params is None:
+            mean, scale = self._standardize(values)
+        else:
+            mean, scale = params.mean, params.scale
+
+        z = (values - mean) / scale
+        return z, ~np.isnan(z), mean, scale
+
+    def fit(self, warm_start_from: Optional["DFM"] = None):
+        columns = self.targets + self._get_features_names()
+        z, mask, mean, scale = self._prepare(self.train_dfm, columns)
+
+        prev_params = (
+            warm_start_from.model_fitted
+            if isinstance(warm_start_from, CollapsedDFM)
+            else None
+        )
+        if prev_params is not None and prev_params.columns == columns:
+            params = attrs.evolve(prev_params, mean=mean, scale=scale)
+            fit_mode = "warm"
+        else:
+            params = self._initial_params(z, mask, columns, mean, scale)
+            fit_mode = "cold"
+
+        # последние параметры всегда оценены фильтром: выход после E-шага
+        llf_prev = -np.inf
+        for iteration in range(1, config.COLLAPSED_DFM_MAXITER + 1):
+            smoothed = self._kalman(z, mask, params, smooth=True)
+            params.llf = smoothed["llf"]
+            converged = np.isfinite(llf_prev) and abs(
+                smoothed["llf"] - llf_prev
+            ) <= config.COLLAPSED_DFM_TOL * (1 + abs(llf_prev))
+            if converged or iteration == config.COLLAPSED_DFM_MAXITER:
+                break
+            llf_prev = smoothed["llf"]
+            params = self._em_step(z, mask, params, smoothed)
+
+        self.model_fitted = params
+        self.fit_info = {
+            "fit_mode": fit_mode,
+            "iterations": iteration,
+            "fcalls": iteration,
+        }
+
+    def update(self, train_dfm: FrameDFM) -> bool:
+        # параметры не меняются, а фильтр при прогнозе прогоняется по всей
+        # истории, поэтому достаточно заменить окно
+        if self._get_features_names(train_dfm) != self._get_features_names():
+            return False
+
+        self.train_dfm = train_dfm
+        self.fit_info = {"fit_mode": "update", "iterations": 0, "fcalls": 0}
+
+        return True
+
+    def predict(self, test_dfm: FrameDFM) -> pl.DataFrame:
+        params = self.model_fitted
+        n_targets = len(self.targets)
+
+        z_train, mask_train, _, _ = self._prepare(
+            self.train_dfm, params.columns, params
+        )
+        z_test, mask_test, _, _ = self._prepare(test_dfm, params.columns, params)
+        # таргеты теста неизвестны: факторы оцениваются только по панели
+        mask_test[:, :n_targets] = False
+
+        filtered = self._kalman(
+            np.vstack([z_train, z_test]),
+            np.vstack([mask_train, mask_test]),
+            params,
+            smooth=False,
+        )
+        factors = filtered["state_filt"][len(z_train) :, : self.k_factors]
+        preds = (
+            factors @ params.loadings[:n_targets].T * params.scale[:n_targets]
+            + params.mean[:n_targets]
+        )
+
+        dates = pd.DatetimeIndex(self._select(test_dfm, self.targets).index)
+        forecast_pl = pl.DataFrame(
+            {"date": dates.to_numpy()}
+            | {
+                target + "_dfm_pred": preds[:, index]
+                for index, target in enumerate(self.targets)
+            }
+        )
+        return forecast_pl.with_columns(
+            pl.col("date").cast(pl.Date),
+            pl.Series("horizon", range(1, forecast_pl.height + 1)),
+        )
@@ -0,0 +1,170 @@
+import weakref
+from collections import OrderedDict
+from typing import Union
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+import config
+from preprocess_data.feature_matrix import FeatureMatrixSplit
+
+# выборка для модели: кадр с материализованными лагами или диапазон FeatureMatrix
+DataT = Union[pl.DataFrame, FeatureMatrixSplit]
+
+# (id кадра, колонки, dtype) -> (weakref на кадр, массив); weakref защищает
+# от совпадения id у нового кадра после сборки мусора старого
+_numpy_cache: OrderedDict = OrderedDict()
+
+
+# таргет модели: одна колонка или список колонок для многомерной модели
+TargetT = Union[str, list[str]]
+
+
+def get_target_names(target_name: TargetT) -> list[str]:
+    if isinstance(target_name, str):
+        return [target_name]
+
+    return list(target_name)
+
+
+def get_design_blocks(
+    features_list: list[str], target_name: TargetT, horizon: int
+) -> list[tuple[list[str], int]]:
+    # признаки берутся с лагом horizon - 1, таргет — с лагом horizon
+    # (у многомерной модели — лаги всех её таргетов)
+    if horizon < 1:
+        raise ValueError(f"Invalid horizon: {horizon}, must be >= 1")
+
+    return [(features_list, horizon - 1), (get_target_names(target_name), horizon)]
+
+
+def _lag_column_name(column: str, lag: int) -> str:
+    return column if lag == 0 else f"{column}_lag{lag}"
+
+
+def frame_to_numpy(
+    frame: pl.DataFrame, columns: list[str], dtype: type = np.float32
+) -> np.ndarray:
+    # сначала выбираем колонки, потом приводим тип в polars и сразу
+    # получаем C-массив: без pandas и без конвертации всего широкого кадра
+    key = (id(frame), tuple(columns), np.dtype(dtype).str)
+    cached = _numpy_cache.get(key)
+    if cached is not None and cached[0]() is frame:
+        _numpy_cache.move_to_end(key)
+        return cached[1]
+
+    array = frame.select(
+        pl.col(columns).cast(pl.Float32 if dtype == np.float32 else pl.Float64)
+    ).to_numpy(order="c")
+    # массив общий для всех моделей, поэтому только на чтение
+    array.flags.writeable = False
+
+    _numpy_cache[key] = (weakref.ref(frame), array)
+    if len(_numpy_cache) > config.DESIGN_CACHE_SIZE:
+        _numpy_cache.popitem(last=False)
+
+    return array
+
+
+def get_design(data: DataT, blocks: list[tuple[list[str], int]]) -> np.ndarray:
+    # блоки кэшируются по отдельности: блок признаков общий у всех таргетов
+    if isinstance(data, FeatureMatrixSplit):
+        arrays = [data.lagged(columns, lag) for columns, lag in blocks]
+    else:
+        arrays = [
+            frame_to_numpy(data, [_lag_column_name(column, lag) for column in columns])
+            for columns, lag in blocks
+        ]
+
+    return np.hstack(arrays)
+
+
+def get_target(data: DataT, target_name: TargetT) -> np.ndarray:
+    # копия: модели (например, torch) ждут записываемый массив;
+    # для списка таргетов — матрица (строки, таргеты)
+    if not isinstance(target_name, str):
+        return get_design(data, [(get_target_names(target_name), 0)]).copy()
+
+    if isinstance(data, FeatureMatrixSplit):
+        return data.get_column(target_name).copy()
+
+    return frame_to_numpy(data, [target_name])[:, 0].copy()
+
+
+def get_indexed_pandas(frame: pl.DataFrame, columns: list[str]) -> pd.DataFrame:
+    # для statsmodels: float64 и индекс по датам, без to_pandas всего кадра
+    return pd.DataFrame(
+        frame_to_numpy(frame, columns, np.float64),
+        index=pd.DatetimeIndex(
+            frame["date"].to_numpy().astype("datetime64[ns]"), name="date"
+        ),
+        columns=columns,
+        copy=True,
+    )
+
+
+def get_dates(data: DataT) -> pl.DataFrame:
+    if isinstance(data, FeatureMatrixSplit):
+        return data.dates()
+
+    return data.select("date")
+
+
+def concat_data(first: DataT, second: DataT) -> DataT:
+    if isinstance(first, FeatureMatrixSplit):
+        return first.concat(second)
+
+    return pl.concat([first, second])
+
+
+# горизонт модели: один или список горизонтов для общей модели, где горизонт —
+# признак, а выборки всех горизонтов стоят друг под другом
+HorizonT = Union[int, list[int]]
+
+
+def get_horizons(horizon: HorizonT) -> list[int]:
+    if isinstance(horizon, int):
+        return [horizon]
+
+    return list(horizon)
+
+
+def get_horizon_design(
+    data: DataT, features_list: list[str], target_name: TargetT, horizon: HorizonT
+) -> np.ndarray:
+    if isinstance(horizon, int):
+        return get_design(data, get_design_blocks(features_list, target_name, horizon))
+
+    return np.vstack(
+        [
+            np.hstack(
+                [
+                    get_design(
+                        data, get_design_blocks(features_list, target_name, one_horizon)
+                    ),
+                    np.full((data.height, 1), one_horizon, dtype=np.float32),
+                ]
+            )
+            for one_horizon in horizon
+        ]
+    )
+
+
+def get_horizon_target(
+    data: DataT, target_name: TargetT, horizon: HorizonT
+) -> np.ndarray:
+    target = get_target(data, target_name)
+    if isinstance(horizon, int):
+        return target
+
+    return np.concatenate([target] * len(horizon))
+
+
+def get_horizon_dates(data: DataT, horizon: HorizonT) -> pl.DataFrame:
+    # даты и горизонт строк get_horizon_design
+    horizons = get_horizons(horizon)
+
+    return pl.concat([get_dates(data)] * len(horizons)).with_columns(
+        pl.Series(np.repeat(horizons, data.height)).cast(pl.Int32).alias("horizon")
+    )
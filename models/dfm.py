@@ -1,14 +1,21 @@
+from typing import Optional, Union
+
 import attrs
+import numpy as np
 import pandas as pd
 import polars as pl
 from statsmodels.tsa.statespace.dynamic_factor import DynamicFactor
 
 import config
+from models.design import get_indexed_pandas
+
+# окно DFM: кадр polars или уже подготовленный pandas с индексом по датам
+FrameDFM = Union[pl.DataFrame, pd.DataFrame]
 
 
 @attrs.define(slots=True)
 class DFM:
-    train_dfm: pl.DataFrame
+    train_dfm: FrameDFM
     targets: list[str]
     avaliability: int
     k_factors: int
@@ -17,17 +24,22 @@ class DFM:
     features_type: str = "d12"
     features_strategy: str = "avail_only"
     model_fitted: object = None
+    fit_info: dict = attrs.field(factory=dict)
+
+    @staticmethod
+    def _select(frame: FrameDFM, columns: list[str]) -> pd.DataFrame:
+        if isinstance(frame, pd.DataFrame):
+            return frame[columns]
+
+        return get_indexed_pandas(frame, columns)
 
     @staticmethod
-    def _filter_nan_features(
-        train: pl.DataFrame, features_cols: list[str]
-    ) -> list[str]:
-        df_train = train.select(features_cols).to_pandas()
-        mask = ~df_train.isna().any()
+    def _filter_nan_features(train: FrameDFM, features_cols: list[str]) -> list[str]:
+        mask = ~DFM._select(train, features_cols).isna().any()
 
         return [col for col, ok in mask.items() if ok]
 
-    def _get_features_names(self) -> list[str]:
+    def _get_features_names(self, train_dfm: Optional[FrameDFM] = None) -> list[str]:
         if self.features_type == "d12":
             if self.features_strategy == "avail_only":
                 if self.avaliability == 1:
@@ -68,22 +80,36 @@ class DFM:
         else:
             raise ValueError("features_typey must be 'd12' (default) or 'rolling'")
 
-        feature_cols_no_nans = self._filter_nan_features(self.train_dfm, feature_cols)
+        feature_cols_no_nans = self._filter_nan_features(
+            self.train_dfm if train_dfm is None else train_dfm, feature_cols
+        )
 
         return feature_cols_no_nans
 
-    def fit(self):
+    @staticmethod
+    def _llf_per_obs(model_fitted) -> float:
+        return model_fitted.llf / model_fitted.nobs
+
+    @staticmethod
+    def _is_bad_warm_fit(model_fitted, prev_model_fitted) -> bool:
+        if not np.isfinite(model_fitted.llf) or not np.all(
+            np.isfinite(model_fitted.params)
+        ):
+            return True
+
+        # окна отличаются на квартал, поэтому резкое падение правдоподобия
+        # значит, что старт из прошлого оптимума завёл в плохую область
+        return (
+            DFM._llf_per_obs(model_fitted)
+            < DFM._llf_per_obs(prev_model_fitted) - config.DFM_WARM_START_LLF_TOL
+        )
+
+    def fit(self, warm_start_from: Optional["DFM"] = None):
 
         feature_cols_no_nans = self._get_features_names()
 
-        endog = (
-            self.train_dfm.select(["date"] + self.targets).to_pandas().set_index("date")
-        )
-        exog = (
-            self.train_dfm.select(["date"] + feature_cols_no_nans)
-            .to_pandas()
-            .set_index("date")
-        )
+        endog = self._select(self.train_dfm, self.targets)
+        exog = self._select(self.train_dfm, feature_cols_no_nans)
 
         model = DynamicFactor(
             endog=endog,
@@ -92,17 +118,91 @@ class DFM:
             factor_order=self.factor_order,
         )
 
-        self.model_fitted = model.fit(disp=False, maxiter=5000, method="nm")
+        prev_model_fitted = (
+            warm_start_from.model_fitted if warm_start_from is not None else None
+        )
+        # тёплый старт возможен, только если набор параметров не изменился
+        # (например, в новом окне не отпал признак с пропусками)
+        if prev_model_fitted is not None and list(
+            prev_model_fitted.params.index
+        ) == list(model.param_names):
+            warm_fitted = model.fit(
+                start_params=prev_model_fitted.params.values,
+                disp=False,
+                maxiter=config.DFM_WARM_MAXITER,
+                maxfun=config.DFM_WARM_MAXFUN,
+                method="nm",
+            )
+            iterations = warm_fitted.mle_retvals["iterations"]
+            fcalls = warm_fitted.mle_retvals["fcalls"]
+
+            if not self._is_bad_warm_fit(warm_fitted, prev_model_fitted):
+                self.model_fitted = warm_fitted
+                fit_mode = "warm"
+            else:
+                cold_fitted = model.fit(
+                    disp=False, maxiter=config.DFM_MAXITER, method="nm"
+                )
+                iterations += cold_fitted.mle_retvals["iterations"]
+                fcalls += cold_fitted.mle_retvals["fcalls"]
+
+                if np.isfinite(warm_fitted.llf) and warm_fitted.llf > cold_fitted.llf:
+                    self.model_fitted = warm_fitted
+                else:
+                    self.model_fitted = cold_fitted
+                fit_mode = "cold_fallback"
+        else:
+            self.model_fitted = model.fit(
+                disp=False, maxiter=config.DFM_MAXITER, method="nm"
+            )
+            iterations = self.model_fitted.mle_retvals["iterations"]
+            fcalls = self.model_fitted.mle_retvals["fcalls"]
+            fit_mode = "cold"
+
+        self.fit_info = {
+            "fit_mode": fit_mode,
+            "iterations": iterations,
+            "fcalls": fcalls,
+        }
+
+    def update(self, train_dfm: FrameDFM) -> bool:
+        # новые строки train_dfm прогоняются через фильтр Калмана с прежними
+        # параметрами (append), без переоценки; False — обновить нельзя и
+        # окно нужно оценивать заново
+        feature_cols_no_nans = self._get_features_names()
+        if self._get_features_names(train_dfm) != feature_cols_no_nans:
+            return False
+
+        last_date = self._select(self.train_dfm, self.targets).index.max()
+        endog = self._select(train_dfm, self.targets)
+        exog = self._select(train_dfm, feature_cols_no_nans)
+        new_rows = endog.index > last_date
+
+        freq = self.model_fitted.model.data.freq
+        if freq is None:
+            return False
+
+        # индекс новых строк должен продолжать индекс модели с её частотой
+        new_index = pd.DatetimeIndex(endog.index[new_rows], freq=freq)
+        try:
+            model_fitted = self.model_fitted.append(
+                endog[new_rows].set_axis(new_index),
+                exog=exog[new_rows].set_axis(new_index),
+            )
+        except ValueError:
+            return False
 
-    def predict(self, test_dfm: pl.DataFrame) -> pl.DataFrame:
+        self.train_dfm = train_dfm
+        self.model_fitted = model_fitted
+        self.fit_info = {"fit_mode": "update", "iterations": 0, "fcalls": 0}
+
+        return True
+
+    def predict(self, test_dfm: FrameDFM) -> pl.DataFrame:
 
         feature_cols_no_nans = self._get_features_names()
 
-        exog_pred = (
-            test_dfm.select(["date"] + feature_cols_no_nans)
-            .to_pandas()
-            .set_index("date")
-        )
+        exog_pred = self._select(test_dfm, feature_cols_no_nans)
 
         forecast = self.model_fitted.forecast(steps=len(exog_pred), exog=exog_pred)
 
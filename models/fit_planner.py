@@ -0,0 +1,63 @@
+import hashlib
+import json
+import logging
+from typing import Any, Callable
+
+import attrs
+import numpy as np
+
+logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+
+# Учёт обучений по отпечатку (модель, параметры, признаки, строки обучения):
+# повторный запрос с тем же отпечатком получает уже обученную модель.
+@attrs.define(slots=True)
+class FitPlanner:
+    fitted: dict[str, Any] = attrs.field(factory=dict)
+    requested: int = 0
+    reused: int = 0
+
+    @staticmethod
+    def fingerprint(*parts: Any) -> str:
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                digest.update(f"{part.dtype}{part.shape}".encode())
+                digest.update(np.ascontiguousarray(part).tobytes())
+            else:
+                digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+            digest.update(b"\x00")
+
+        return digest.hexdigest()
+
+    def get_or_fit(self, key: str, fit: Callable[[], Any]) -> Any:
+        self.requested += 1
+        if key in self.fitted:
+            self.reused += 1
+        else:
+            self.fitted[key] = fit()
+
+        return self.fitted[key]
+
+    def dedupe(self, keys: list[str]) -> list[int]:
+        # для каждого запроса — номер первого запроса с тем же отпечатком
+        first_index = {}
+        for index, key in enumerate(keys):
+            first_index.setdefault(key, index)
+
+        self.requested += len(keys)
+        self.reused += len(keys) - len(first_index)
+
+        return [first_index[key] for key in keys]
+
+    def add_counts(self, requested: int, reused: int) -> None:
+        self.requested += requested
+        self.reused += reused
+
+    def log_summary(self, name: str) -> None:
+        logger.info(
+            f"{name}: {self.requested} fits requested,"
+            f" {self.reused} duplicates reused,"
+            f" {self.requested - self.reused} trained"
+        )
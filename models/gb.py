@@ -1,77 +1,83 @@
 from typing import Optional
 
 import attrs
+import numpy as np
 import polars as pl
 from catboost import CatBoostRegressor, Pool
 
 import config
+from models.catboost_pools import borders_file, get_quantized_pool
+from models.design import (
+    DataT,
+    HorizonT,
+    TargetT,
+    get_horizon_dates,
+    get_horizon_design,
+    get_horizon_target,
+    get_target_names,
+)
 
 
 @attrs.define(slots=True)
 class GB:
     features_type: str
     avaliability: int
-    target_name: str
-    horizon: int
+    # список таргетов — одна модель MultiRMSE на все таргеты сразу
+    target_name: TargetT
+    # список горизонтов — одна модель на все горизонты, горизонт — признак
+    horizon: HorizonT
     avail_features_full: dict
     params: Optional[dict] = {}
     model: Optional[CatBoostRegressor] = None
 
-    @staticmethod
-    def _get_actual_lags_features(features_list: list[str], horizon: int) -> list[str]:
-        if horizon > 1:
-            features_list_actual_lags = []
-            for feature in features_list:
-                features_list_actual_lags.append(feature + f"_lag{horizon - 1}")
-
-            return features_list_actual_lags
-
-        elif horizon == 1:
-            return features_list
-        else:
-            raise ValueError(f"Invalid horizon: {horizon}, must be >= 1")
-
-    @staticmethod
-    def _get_lags_target(target_name, horizon: int) -> list[str]:
-        target_lags = target_name + f"_lag{horizon}"
+    def _get_design(self, data: DataT) -> np.ndarray:
+        return get_horizon_design(
+            data,
+            self.avail_features_full[self.features_type][self.avaliability],
+            self.target_name,
+            self.horizon,
+        )
 
-        return [target_lags]
+    def _get_target(self, data: DataT) -> np.ndarray:
+        return get_horizon_target(data, self.target_name, self.horizon)
 
     def fit(
         self,
-        train: pl.DataFrame,
-        valid: Optional[pl.DataFrame] = None,
+        train: DataT,
+        valid: Optional[DataT] = None,
         early_stopping: Optional[int] = None,
+        # число потоков не меняет модель и не входит в params, а с ними в ключ
+        thread_count: int = config.THREAD_COUNT,
     ):
 
         base_params = {
             "random_seed": config.RANDOM_SEED,
-            "loss_function": "RMSE",
+            "loss_function": (
+                "RMSE" if isinstance(self.target_name, str) else "MultiRMSE"
+            ),
             "verbose": False,
-            "thread_count": config.THREAD_COUNT,
+            "thread_count": thread_count,
         }
 
         if self.params:
             base_params.update(**self.params)
 
-        features_cols = self._get_actual_lags_features(
-            self.avail_features_full[self.features_type][self.avaliability],
-            self.horizon,
-        ) + self._get_lags_target(self.target_name, self.horizon)
-
-        target_col = self.target_name
-
-        train_pool = Pool(
-            data=train.select(features_cols).to_pandas(),
-            label=train.select(target_col).to_pandas(),
-        )
-
-        if valid is not None and not valid.is_empty():
-            valid_pool = Pool(
-                data=valid.select(features_cols).to_pandas(),
-                label=valid.select(target_col).to_pandas(),
+        # границы квантования считаются по train и общие для valid
+        X_train = self._get_design(train)
+        use_valid = valid is not None and not valid.is_empty()
+        with borders_file(
+            X_train,
+            len(self.avail_features_full[self.features_type][self.avaliability]),
+        ) as borders_path:
+            train_pool = get_quantized_pool(
+                X_train, self._get_target(train), borders_path
             )
+            if use_valid:
+                valid_pool = get_quantized_pool(
+                    self._get_design(valid), self._get_target(valid), borders_path
+                )
 
+        if use_valid:
             base_params["early_stopping_rounds"] = early_stopping
             self.model = CatBoostRegressor(
                 **base_params, eval_metric=base_params["loss_function"]
@@ -88,20 +94,26 @@ class GB:
             self.model = CatBoostRegressor(**base_params)
             self.model.fit(train_pool)
 
-    def predict(self, test: pl.DataFrame):
-
-        features_cols = self._get_actual_lags_features(
-            self.avail_features_full[self.features_type][self.avaliability],
-            self.horizon,
-        ) + self._get_lags_target(self.target_name, self.horizon)
-
-        test_pool = Pool(data=test.select(features_cols).to_pandas())
-
-        pred_df = test.select("date").with_columns(
-            pl.lit(self.model.predict(test_pool)).alias("pred_gb"),
-            pl.lit(self.horizon).alias("horizon"),
-            pl.lit(self.avaliability).alias("avaliability"),
-            pl.lit(self.target_name).alias("target_name"),
-            pl.lit(self.features_type).alias("features_type"),
+    def predict(self, test: DataT):
+
+        # все горизонты общей модели прогнозируются одним вызовом predict
+        test_pool = Pool(data=self._get_design(test))
+        target_names = get_target_names(self.target_name)
+        preds = self.model.predict(test_pool).reshape(test_pool.num_row(), -1)
+        pred_dates = get_horizon_dates(test, self.horizon)
+
+        # прогноз многомерной модели раскладывается в строки по таргетам,
+        # как у отдельных моделей
+        pred_df = pl.concat(
+            [
+                pred_dates.select("date").with_columns(
+                    pl.Series(preds[:, index]).alias("pred_gb"),
+                    pred_dates["horizon"],
+                    pl.lit(self.avaliability).alias("avaliability"),
+                    pl.lit(target_name).alias("target_name"),
+                    pl.lit(self.features_type).alias("features_type"),
+                )
+                for index, target_name in enumerate(target_names)
+            ]
         )
         return pred_df
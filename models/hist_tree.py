@@ -0,0 +1,285 @@
+from collections import OrderedDict
+from typing import Optional
+
+import attrs
+import numpy as np
+
+import config
+from models.fit_planner import FitPlanner
+
+# хэш выборки -> бины; NGBoost обучает два дерева на каждой итерации на одной
+# и той же выборке, поэтому бины считаются один раз за fit
+_bins_cache: OrderedDict = OrderedDict()
+
+
+# Выборка, разбитая на бины: бин i колонки j — значения из
+# (thresholds[j, i - 1], thresholds[j, i]], последний бин — пропуски
+@attrs.define(slots=True)
+class _BinnedDesign:
+    bins: np.ndarray
+    thresholds: np.ndarray
+    # колонки с пропусками: только для них пробуется отправить пропуски влево
+    missing_columns: np.ndarray
+    # индексы ячеек гистограммы корня (признак, бин), число наблюдений в них
+    # и накопленное слева число наблюдений — от градиента не зависят
+    root_cells: np.ndarray
+    root_counts: np.ndarray
+    root_left_counts: np.ndarray
+
+
+def _column_edges(column: np.ndarray, max_bins: int) -> np.ndarray:
+    values = np.unique(column[~np.isnan(column)]).astype(np.float64)
+    if len(values) > max_bins:
+        # значений больше, чем бинов: границы по квантилям
+        positions = np.linspace(0, len(values) - 1, max_bins + 1)[1:-1]
+        values = np.unique(values[np.round(positions).astype(int)])
+
+    # порог — середина между соседними значениями, как в sklearn
+    edges = values[:-1] / 2.0 + values[1:] / 2.0
+    equal_upper = (edges == values[1:]) | np.isinf(edges)
+    edges[equal_upper] = values[:-1][equal_upper]
+    return edges
+
+
+def _get_bins(X: np.ndarray, max_bins: int) -> _BinnedDesign:
+    key = FitPlanner.fingerprint(max_bins, X)
+    cached = _bins_cache.get(key)
+    if cached is not None:
+        _bins_cache.move_to_end(key)
+        return cached
+
+    columns_edges = [_column_edges(column, max_bins) for column in X.T]
+    # порог inf отделяет пропуски от всех значений
+    n_bins = max(len(edges) for edges in columns_edges) + 2
+    thresholds = np.full((X.shape[1], n_bins), np.inf)
+    bins = np.empty(X.shape, dtype=np.int64)
+    for j, edges in enumerate(columns_edges):
+        thresholds[j, : len(edges)] = edges
+        bins[:, j] = np.searchsorted(edges, X[:, j], side="left")
+    bins[np.isnan(X)] = n_bins - 1
+
+    root_cells = (np.arange(X.shape[1]) * n_bins + bins).ravel()
+    root_counts = np.bincount(root_cells, minlength=thresholds.size)
+    root_counts = root_counts.reshape(1, *thresholds.shape).astype(np.float64)
+    binned = _BinnedDesign(
+        bins=bins,
+        thresholds=thresholds,
+        missing_columns=np.flatnonzero(np.isnan(X).any(axis=0)),
+        root_cells=root_cells,
+        root_counts=root_counts,
+        root_left_counts=np.cumsum(root_counts[..., :-1], axis=2),
+    )
+
+    _bins_cache[key] = binned
+    if len(_bins_cache) > config.DESIGN_CACHE_SIZE:
+        _bins_cache.popitem(last=False)
+
+    return binned
+
+
+def _split_gains(
+    left_g: np.ndarray, left_w: np.ndarray, total_g: np.ndarray, total_w: np.ndarray
+) -> np.ndarray:
+    # уменьшение суммы квадратов ошибок (friedman_mse) равно
+    # total_w * d^2 / (left_w * right_w), d = left_g - left_w * среднее узла;
+    # множитель total_w общий для узла и опускается, пустой потомок — 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = (total_g / total_w)[:, None, None]
+    d = left_g - left_w * mean
+    denominator = left_w * (total_w[:, None, None] - left_w)
+    gains = np.divide(d * d, denominator, out=np.zeros_like(d), where=denominator > 0)
+
+    return gains.reshape(len(gains), -1)
+
+
+def _children_hist(
+    parent_hist: np.ndarray, left_hist: np.ndarray, split: np.ndarray
+) -> np.ndarray:
+    # потомки узла i уровня — узлы 2i и 2i + 1 следующего уровня
+    hist = np.empty((2 * len(parent_hist), *parent_hist.shape[1:]))
+    hist[0::2] = left_hist
+    np.subtract(parent_hist, left_hist, out=hist[1::2])
+    # у неразбитого узла потомков нет
+    hist[1::2][~split] = 0.0
+
+    return hist
+
+
+# Дерево регрессии ограниченной глубины на гистограммах: признаки
+# разбиваются на бины один раз за fit NGBoost, лучшие разбиения всех узлов
+# уровня ищутся по гистограммам сразу, без цикла по узлам и признакам.
+# Заменяет DecisionTreeRegressor в NGBoost
+@attrs.define(slots=True)
+class HistTreeRegressor:
+    max_depth: int = 2
+    max_bins: int = 255
+    # узлы в порядке кучи: потомки узла i — 2i + 1 и 2i + 2
+    feature_: Optional[np.ndarray] = attrs.field(default=None, init=False)
+    threshold_: Optional[np.ndarray] = attrs.field(default=None, init=False)
+    missing_left_: Optional[np.ndarray] = attrs.field(default=None, init=False)
+    value_: Optional[np.ndarray] = attrs.field(default=None, init=False)
+
+    # NGBoost клонирует базовую модель на каждой итерации через sklearn.clone
+    def get_params(self, deep: bool = True) -> dict:
+        return {"max_depth": self.max_depth, "max_bins": self.max_bins}
+
+    def set_params(self, **params) -> "HistTreeRegressor":
+        for name, value in params.items():
+            setattr(self, name, value)
+        return self
+
+    def __sklearn_clone__(self) -> "HistTreeRegressor":
+        return HistTreeRegressor(**self.get_params())
+
+    def fit(
+        self, X: np.ndarray, y: np.ndarray, sample_weight: Optional[np.ndarray] = None
+    ) -> "HistTreeRegressor":
+        X = np.asarray(X, dtype=np.float32)
+        y = np.asarray(y, dtype=np.float64)
+        w = np.ones(len(y)) if sample_weight is None else np.asarray(sample_weight)
+        binned = _get_bins(X, self.max_bins)
+        n_features, n_bins = binned.thresholds.shape
+        size = n_features * n_bins
+
+        n_nodes = 2 ** (self.max_depth + 1) - 1
+        self.feature_ = np.full(n_nodes, -1)
+        self.threshold_ = np.full(n_nodes, np.inf)
+        self.missing_left_ = np.zeros(n_nodes, dtype=bool)
+
+        # гистограммы сумм градиента и весов по (узел уровня, признак, бин)
+        hist_g = np.bincount(binned.root_cells, np.repeat(w * y, n_features), size)
+        hist_g = hist_g.reshape(binned.root_counts.shape)
+        if sample_weight is None:
+            hist_w = binned.root_counts
+        else:
+            hist_w = np.bincount(binned.root_cells, np.repeat(w, n_features), size)
+            hist_w = hist_w.reshape(binned.root_counts.shape)
+
+        node = np.zeros(len(y), dtype=np.int64)
+        for depth in range(self.max_depth):
+            first = 2**depth - 1
+            n_level = 2**depth
+            levels = np.arange(n_level)
+
+            left_g = np.cumsum(hist_g[..., :-1], axis=2)
+            if depth == 0 and sample_weight is None:
+                left_w = binned.root_left_counts
+            else:
+                left_w = np.cumsum(hist_w[..., :-1], axis=2)
+            total_g, total_w = hist_g[:, 0].sum(axis=1), hist_w[:, 0].sum(axis=1)
+            missing_w = hist_w[..., -1]
+
+            # пропуски (последний бин) уходят вправо; в колонках с пропусками
+            # пробуется и влево, берётся лучшее
+            gains = _split_gains(left_g, left_w, total_g, total_w)
+            best = np.argmax(gains, axis=1)
+            best_gain = gains[levels, best]
+            feature, split_bin = np.divmod(best, n_bins - 1)
+            missing_left = np.zeros(n_level, dtype=bool)
+            missing_columns = binned.missing_columns
+            if len(missing_columns):
+                gains = _split_gains(
+                    left_g[:, missing_columns] + hist_g[:, missing_columns, -1:],
+                    left_w[:, missing_columns] + hist_w[:, missing_columns, -1:],
+                    total_g,
+                    total_w,
+                )
+                best = np.argmax(gains, axis=1)
+                missing_left = gains[levels, best] > best_gain
+                best_gain = np.where(missing_left, gains[levels, best], best_gain)
+                feature = np.where(
+                    missing_left, missing_columns[best // (n_bins - 1)], feature
+                )
+                split_bin = np.where(missing_left, best % (n_bins - 1), split_bin)
+
+            # как в sklearn: узел с нулевой дисперсией градиента — лист
+            level_g2 = np.bincount(node, w * y**2, first + n_level)[first:]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                impurity = level_g2 / total_w - (total_g / total_w) ** 2
+            split = (best_gain > 0) & (impurity > np.finfo(np.float64).eps)
+            if not split.any():
+                break
+
+            # если пропусков в узле не было, они идут в больший потомок
+            left_count = left_w[levels, feature, split_bin]
+            missing_left = np.where(
+                missing_w[levels, feature] > 0,
+                missing_left,
+                left_count >= total_w - left_count,
+            )
+
+            level_nodes = first + levels[split]
+            self.feature_[level_nodes] = feature[split]
+            self.threshold_[level_nodes] = binned.thresholds[feature, split_bin][split]
+            self.missing_left_[level_nodes] = missing_left[split]
+
+            node = self._apply_level(X, node)
+            if depth + 1 == self.max_depth:
+                break
+
+            # гистограммы строятся только для левых потомков, у правых —
+            # разность с гистограммой родителя
+            rows = np.flatnonzero((node >= first + n_level) & (node % 2 == 1))
+            parent = (node[rows] - 1) // 2 - first
+            cells = (parent[:, None] * n_features + np.arange(n_features)) * n_bins
+            cells = (cells + binned.bins[rows]).ravel()
+            shape = (n_level, n_features, n_bins)
+            left_hist_g = np.bincount(
+                cells, np.repeat(w[rows] * y[rows], n_features), n_level * size
+            ).reshape(shape)
+            left_hist_w = np.bincount(
+                cells, np.repeat(w[rows], n_features), n_level * size
+            ).reshape(shape)
+            hist_g = _children_hist(hist_g, left_hist_g, split)
+            hist_w = _children_hist(hist_w, left_hist_w, split)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.value_ = np.nan_to_num(
+                np.bincount(node, w * y, n_nodes) / np.bincount(node, w, n_nodes)
+            )
+
+        return self
+
+    def _apply_level(self, X: np.ndarray, node: np.ndarray) -> np.ndarray:
+        feature = self.feature_[node]
+        internal = feature >= 0
+        x = X[np.arange(len(X)), np.where(internal, feature, 0)]
+        go_left = np.where(
+            np.isnan(x), self.missing_left_[node], x <= self.threshold_[node]
+        )
+        return np.where(internal, 2 * node + 1 + ~go_left, node)
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        X = np.asarray(X, dtype=np.float32)
+        node = np.zeros(len(X), dtype=np.int64)
+        for _ in range(self.max_depth):
+            node = self._apply_level(X, node)
+
+        return self.value_[node]
+
+
+def predict_trees(trees: list[HistTreeRegressor], X: np.ndarray) -> np.ndarray:
+    # прогнозы деревьев одной глубины (деревья, строки): узлы всех деревьев
+    # сложены в массивы и проходятся за max_depth шагов, как в _apply_level,
+    # вместо вызова predict у каждого дерева
+    X = np.asarray(X, dtype=np.float32)
+    feature = np.stack([tree.feature_ for tree in trees])
+    threshold = np.stack([tree.threshold_ for tree in trees])
+    missing_left = np.stack([tree.missing_left_ for tree in trees])
+    value = np.stack([tree.value_ for tree in trees])
+
+    tree_index = np.arange(len(trees))[:, None]
+    rows = np.arange(len(X))
+    node = np.zeros((len(trees), len(X)), dtype=np.int64)
+    for _ in range(trees[0].max_depth):
+        node_feature = feature[tree_index, node]
+        internal = node_feature >= 0
+        x = X[rows, np.where(internal, node_feature, 0)]
+        go_left = np.where(
+            np.isnan(x),
+            missing_left[tree_index, node],
+            x <= threshold[tree_index, node],
+        )
+        node = np.where(internal, 2 * node + 1 + ~go_left, node)
+
+    return value[tree_index, node]
@@ -9,6 +9,16 @@ from ngboost.scores import CRPS
 from sklearn.tree import DecisionTreeRegressor
 
 import config
+from models.design import (
+    DataT,
+    HorizonT,
+    concat_data,
+    get_horizon_dates,
+    get_horizon_design,
+    get_horizon_target,
+)
+from models.fit_planner import FitPlanner
+from models.hist_tree import HistTreeRegressor, predict_trees
 
 
 @attrs.define(slots=True)
@@ -16,54 +26,57 @@ class NGB:
     features_type: str
     avaliability: int
     target_name: str
-    horizon: int
+    # список горизонтов — одна модель на все горизонты, горизонт — признак
+    horizon: HorizonT
     avail_features_full: dict
     params: Dict[str, Any] = attrs.field(factory=dict)
     model: Optional[NGBoost] = None
+    # повторный fit с теми же данными и параметрами отдаёт готовую модель
+    fit_planner: FitPlanner = attrs.field(factory=FitPlanner)
 
-    @staticmethod
-    def _get_actual_lags_features(features_list: list[str], horizon: int) -> list[str]:
-        if horizon > 1:
-            return [f"{feature}_lag{horizon - 1}" for feature in features_list]
-        elif horizon == 1:
-            return features_list
-        else:
-            raise ValueError(f"Invalid horizon: {horizon}, must be >= 1")
-
-    @staticmethod
-    def _get_lags_target(target_name: str, horizon: int) -> list[str]:
-        return [f"{target_name}_lag{horizon}"]
-
-    def _prepare_numpy(
-        self, df: pl.DataFrame, features_cols: list[str]
-    ) -> tuple[np.ndarray, np.ndarray]:
-        df_pd = df.drop("date").to_pandas()
-        X = df_pd[features_cols].astype(np.float32).values
-        y = df_pd[self.target_name].astype(np.float32).values
+    def _get_design(self, data: DataT) -> np.ndarray:
+        return get_horizon_design(
+            data,
+            self.avail_features_full[self.features_type][self.avaliability],
+            self.target_name,
+            self.horizon,
+        )
+
+    def _get_target(self, data: DataT) -> np.ndarray:
+        return get_horizon_target(data, self.target_name, self.horizon)
+
+    def _get_base(self, random_state: int) -> Any:
+        if config.HIST_BASE_NGB:
+            return HistTreeRegressor(
+                max_depth=config.DEPTH_NGB_BASE, max_bins=config.MAX_BINS_NGB_BASE
+            )
+
+        return DecisionTreeRegressor(
+            criterion="friedman_mse",
+            max_depth=config.DEPTH_NGB_BASE,
+            random_state=random_state,
+        )
+
+    def _prepare_numpy(self, data: DataT) -> tuple[np.ndarray, np.ndarray]:
+        X = self._get_design(data)
+        y = self._get_target(data)
         return X, y
 
     def fit(
         self,
-        train: pl.DataFrame,
-        valid: Optional[pl.DataFrame] = None,
+        train: DataT,
+        valid: Optional[DataT] = None,
         early_stopping: Optional[int] = 30,
     ):
 
-        features_cols = self._get_actual_lags_features(
-            self.avail_features_full[self.features_type][self.avaliability],
-            self.horizon,
-        ) + self._get_lags_target(self.target_name, self.horizon)
-
-        X_train, y_train = self._prepare_numpy(train, features_cols)
+        X_train, y_train = self._prepare_numpy(train)
 
         if valid is not None and not valid.is_empty():
-            X_valid, y_valid = self._prepare_numpy(valid, features_cols)
+            X_valid, y_valid = self._prepare_numpy(valid)
 
             base_params = {
-                "Base": DecisionTreeRegressor(
-                    criterion="friedman_mse",
-                    max_depth=config.DEPTH_NGB_BASE,
-                    random_state=self.params.get("random_state", config.RANDOM_SEED),
+                "Base": self._get_base(
+                    self.params.get("random_state", config.RANDOM_SEED)
                 ),
                 "Dist": Normal,
                 "Score": CRPS,
@@ -92,42 +105,73 @@ class NGB:
             )
 
         if valid is not None and not valid.is_empty():
-            train_valid = pl.concat([train, valid])
+            train_valid = concat_data(train, valid)
         else:
             train_valid = train
 
-        X_train_valid, y_train_valid = self._prepare_numpy(train_valid, features_cols)
-
-        final_model = NGBoost(
-            Base=DecisionTreeRegressor(
-                criterion="friedman_mse",
-                max_depth=config.DEPTH_NGB_BASE,
-                random_state=self.params.get("random_state", config.RANDOM_SEED),
-            ),
-            Dist=Normal,
-            Score=CRPS,
-            n_estimators=best_n_estimators,
-            learning_rate=self.params.get("learning_rate", config.LEARNING_RATE_NGB),
-            verbose=self.params.get("verbose", True),
-            random_state=self.params.get("random_state", config.RANDOM_SEED),
+        X_train_valid, y_train_valid = self._prepare_numpy(train_valid)
+
+        final_params = {
+            "n_estimators": best_n_estimators,
+            "learning_rate": self.params.get("learning_rate", config.LEARNING_RATE_NGB),
+            "random_state": self.params.get("random_state", config.RANDOM_SEED),
+            "max_depth": config.DEPTH_NGB_BASE,
+            "hist_base": config.HIST_BASE_NGB,
+            "max_bins": config.MAX_BINS_NGB_BASE,
+        }
+
+        # fit(train, valid) уже обучает финальную модель на train + valid,
+        # поэтому следующий fit(train_valid) получает её без переобучения
+        fit_key = FitPlanner.fingerprint(
+            "NGBoost",
+            final_params,
+            [self.features_type, self.avaliability, self.target_name, self.horizon],
+            X_train_valid,
+            y_train_valid,
+        )
+        self.model = self.fit_planner.get_or_fit(
+            fit_key,
+            lambda: NGBoost(
+                Base=self._get_base(final_params["random_state"]),
+                Dist=Normal,
+                Score=CRPS,
+                n_estimators=final_params["n_estimators"],
+                learning_rate=final_params["learning_rate"],
+                verbose=self.params.get("verbose", True),
+                random_state=final_params["random_state"],
+            ).fit(X_train_valid, y_train_valid),
         )
 
-        final_model.fit(X_train_valid, y_train_valid)
-        self.model = final_model
+    def _predict_loc(self, X: np.ndarray) -> np.ndarray:
+        base_models = self.model.base_models
+        if self.model.col_sample != 1.0 or not isinstance(
+            base_models[0][0], HistTreeRegressor
+        ):
+            return self.model.predict(X)
+
+        # NGBoost.predict — среднее Normal, то есть параметр loc: начальное
+        # значение минус вклады деревьев loc по итерациям. Деревья на
+        # гистограммах считаются все сразу, вклады вычитаются в том же
+        # порядке, что и в NGBoost.pred_param
+        values = predict_trees([models[0] for models in base_models], X)
+        steps = (
+            self.model.learning_rate * values * np.array(self.model.scalings)[:, None]
+        )
+        loc = np.ones(len(X)) * self.model.init_params[0]
+        for step in steps:
+            loc -= step
 
-    def predict(self, test: pl.DataFrame) -> pl.DataFrame:
+        return loc
 
-        features_cols = self._get_actual_lags_features(
-            self.avail_features_full[self.features_type][self.avaliability],
-            self.horizon,
-        ) + self._get_lags_target(self.target_name, self.horizon)
+    def predict(self, test: DataT) -> pl.DataFrame:
 
-        X_test, _ = self._prepare_numpy(test, features_cols)
-        preds = self.model.predict(X_test)
+        # все горизонты общей модели прогнозируются одним вызовом predict
+        preds = self._predict_loc(self._get_design(test))
+        pred_dates = get_horizon_dates(test, self.horizon)
 
-        pred_df = test.select("date").with_columns(
+        pred_df = pred_dates.select("date").with_columns(
             pl.Series(preds.ravel()).alias("pred_ngb"),
-            pl.lit(self.horizon).alias("horizon"),
+            pred_dates["horizon"],
             pl.lit(self.avaliability).alias("avaliability"),
             pl.lit(self.target_name).alias("target_name"),
             pl.lit(self.features_type).alias("features_type"),
@@ -1,84 +1,107 @@
+import copy
+import time
+import warnings
 from typing import Any, Dict, Optional
 
 import attrs
 import numpy as np
 import polars as pl
+import torch
+from pytorch_tabnet.sparsemax import Entmax15, Sparsemax
 from pytorch_tabnet.tab_model import TabNetRegressor
+from pytorch_tabnet.tab_network import GBN
 from sklearn.preprocessing import StandardScaler
 
+import config
+from models.design import (
+    DataT,
+    HorizonT,
+    TargetT,
+    get_horizon_design,
+    get_horizon_target,
+)
+from models.tabnet_engine import TensorTabNetRegressor, set_torch_threads
+from models.tabnet_pretraining import TabNetPretraining
+from models.tabnet_script import (
+    FrozenTabNet,
+    ScriptedTabNet,
+    ScriptEntmax15,
+    ScriptSparsemax,
+    get_tabnet_pred_frame,
+)
+
 
 @attrs.define(slots=True)
 class TabNetModel:
     features_type: str
     avaliability: int
-    target_name: str
-    horizon: int
+    # список таргетов — одна TabNet с выходом на каждый таргет
+    target_name: TargetT
+    # список горизонтов — одна модель на все горизонты, горизонт — признак
+    horizon: HorizonT
     avail_features_full: dict
     params: Dict[str, Any] = attrs.field(factory=dict)
     model: Optional[TabNetRegressor] = None
     scaler: Optional[StandardScaler] = None
-    feature_cols_no_nans: Optional[list[str]] = None
-
-    @staticmethod
-    def _get_actual_lags_features(features_list: list[str], horizon: int) -> list[str]:
-        if horizon > 1:
-            return [f"{feature}_lag{horizon - 1}" for feature in features_list]
-        elif horizon == 1:
-            return features_list
-        else:
-            raise ValueError(f"Invalid horizon: {horizon}, must be >= 1")
-
-    @staticmethod
-    def _get_lags_target(target_name: str, horizon: int) -> list[str]:
-        return [f"{target_name}_lag{horizon}"]
-
-    @staticmethod
-    def _prepare_numpy(
-        df: pl.DataFrame, features_cols: list[str], target_name: str
-    ) -> tuple[np.ndarray, np.ndarray]:
-        df_pd = df.drop("date").to_pandas()
-        X = df_pd[features_cols].astype(np.float32).values
-        y = df_pd[target_name].astype(np.float32).values.reshape(-1, 1)
-        return X, y
-
-    @staticmethod
-    def _filter_nan_features(
-        train: pl.DataFrame, valid: Optional[pl.DataFrame], features_cols: list[str]
-    ) -> list[str]:
-        df_train = train.select(features_cols).to_pandas()
-        valid_pd = (
-            valid.select(features_cols).to_pandas()
-            if valid is not None and not valid.is_empty()
-            else None
+    feature_mask_no_nans: Optional[np.ndarray] = None
+    # предобучение группы ячеек: его веса — начальные, его маска и масштаб
+    # признаков — общие для группы
+    pretrained: Optional[TabNetPretraining] = None
+    # скорость последнего обучения, для логов
+    epochs_per_second: Optional[float] = None
+
+    @property
+    def pretrained_key(self) -> Optional[str]:
+        return None if self.pretrained is None else self.pretrained.key
+
+    def _get_design(self, data: DataT) -> np.ndarray:
+        return get_horizon_design(
+            data,
+            self.avail_features_full[self.features_type][self.avaliability],
+            self.target_name,
+            self.horizon,
         )
 
-        mask = ~df_train.isna().any()
-        if valid_pd is not None:
-            mask &= ~valid_pd.isna().any()
+    def _get_target(self, data: DataT) -> np.ndarray:
+        return get_horizon_target(data, self.target_name, self.horizon)
 
-        return [col for col, ok in mask.items() if ok]
+    def _prepare_numpy(self, data: DataT) -> tuple[np.ndarray, np.ndarray]:
+        X = self._get_design(data)[:, self.feature_mask_no_nans]
+        y = self._get_target(data).reshape(len(X), -1)
+        return X, y
+
+    def _filter_nan_features(self, train: DataT, valid: Optional[DataT]) -> np.ndarray:
+        mask = ~np.isnan(self._get_design(train)).any(axis=0)
+        if valid is not None and not valid.is_empty():
+            mask &= ~np.isnan(self._get_design(valid)).any(axis=0)
+
+        return mask
 
     def fit(
         self,
-        train: pl.DataFrame,
-        valid: Optional[pl.DataFrame] = None,
+        train: DataT,
+        valid: Optional[DataT] = None,
     ):
 
-        features_cols = self._get_actual_lags_features(
-            self.avail_features_full[self.features_type][self.avaliability],
-            self.horizon,
-        ) + self._get_lags_target(self.target_name, self.horizon)
-
-        self.feature_cols_no_nans = self._filter_nan_features(
-            train, valid, features_cols
-        )
+        self.feature_mask_no_nans = self._filter_nan_features(train, valid)
+        X_train, y_train = self._prepare_numpy(train)
+
+        # веса предобучения подходят, только если вход сети тот же
+        from_unsupervised = None
+        if self.pretrained is not None and np.array_equal(
+            self.feature_mask_no_nans, self.pretrained.feature_mask_no_nans
+        ):
+            from_unsupervised = self.pretrained.model
+            self.scaler = self.pretrained.scaler
+            X_train = self.scaler.transform(X_train)
+        else:
+            self.scaler = StandardScaler()
+            X_train = self.scaler.fit_transform(X_train)
 
-        self.scaler = StandardScaler()
-        X_train, y_train = self._prepare_numpy(
-            train, self.feature_cols_no_nans, self.target_name
+        set_torch_threads()
+        regressor = (
+            TensorTabNetRegressor if config.TENSOR_BATCHES_TABNET else TabNetRegressor
         )
-        X_train = self.scaler.fit_transform(X_train)
-
         tabnet_params = dict(
             optimizer_params={"lr": self.params.get("learning_rate", 0.05)},
             mask_type=self.params.get("mask_type", "sparsemax"),
@@ -87,13 +110,12 @@ class TabNetModel:
             verbose=0,
         )
 
+        start = time.perf_counter()
         if valid is not None and not valid.is_empty():
-            X_valid, y_valid = self._prepare_numpy(
-                valid, self.feature_cols_no_nans, self.target_name
-            )
+            X_valid, y_valid = self._prepare_numpy(valid)
             X_valid = self.scaler.transform(X_valid)
 
-            self.model = TabNetRegressor(**tabnet_params)
+            self.model = regressor(**tabnet_params)
 
             self.model.fit(
                 X_train=X_train,
@@ -106,6 +128,7 @@ class TabNetModel:
                 batch_size=self.params.get("batch_size", 8),
                 virtual_batch_size=self.params.get("virtual_batch_size", 8),
                 drop_last=False,
+                from_unsupervised=from_unsupervised,
             )
 
             best_epoch = np.argmin(self.model.history["valid_rmse"]) + 1
@@ -117,7 +140,7 @@ class TabNetModel:
                 )
 
         else:
-            self.model = TabNetRegressor(**tabnet_params)
+            self.model = regressor(**tabnet_params)
             self.model.fit(
                 X_train=X_train,
                 y_train=y_train,
@@ -125,20 +148,65 @@ class TabNetModel:
                 batch_size=self.params.get("batch_size", 8),
                 virtual_batch_size=self.params.get("virtual_batch_size", 8),
                 drop_last=False,
+                from_unsupervised=from_unsupervised,
             )
 
-    def predict(self, test: pl.DataFrame) -> pl.DataFrame:
-        X_test, _ = self._prepare_numpy(
-            test, self.feature_cols_no_nans, self.target_name
+        self.epochs_per_second = len(self.model.history["loss"]) / (
+            time.perf_counter() - start
         )
+
+    def predict(self, test: DataT) -> pl.DataFrame:
+        X_test, _ = self._prepare_numpy(test)
         X_test = self.scaler.transform(X_test)
-        preds = self.model.predict(X_test).flatten()
-
-        pred_df = test.select("date").with_columns(
-            pl.Series(preds).alias("pred_tabnet"),
-            pl.lit(self.horizon).alias("horizon"),
-            pl.lit(self.avaliability).alias("avaliability"),
-            pl.lit(self.target_name).alias("target_name"),
-            pl.lit(self.features_type).alias("features_type"),
+        # в обучении колонок с пропусками нет (их отбрасывает маска), а в
+        # прогнозе по свежим данным пропуск бывает (ещё не вышедший месяц
+        # квартала): он заменяется средним по train, то есть нулём после
+        # StandardScaler; sparsemax на NaN падает
+        X_test = np.where(np.isnan(X_test), 0.0, X_test)
+        # все горизонты общей модели прогнозируются одним вызовом predict
+        preds = self.model.predict(X_test)
+
+        return get_tabnet_pred_frame(
+            preds,
+            test,
+            self.features_type,
+            self.avaliability,
+            self.target_name,
+            self.horizon,
+        )
+
+    def to_script(self) -> ScriptedTabNet:
+        network = copy.deepcopy(self.model.network).eval()
+        # в режиме eval ghost batch norm — обычный BatchNorm по накопленной
+        # статистике, без разбиения на виртуальные батчи; sparsemax и entmax —
+        # их прямой проход без autograd.Function
+        for module in list(network.modules()):
+            for name, child in module.named_children():
+                if isinstance(child, GBN):
+                    setattr(module, name, child.bn)
+                elif isinstance(child, Sparsemax):
+                    setattr(module, name, ScriptSparsemax())
+                elif isinstance(child, Entmax15):
+                    setattr(module, name, ScriptEntmax15())
+
+        frozen = FrozenTabNet(
+            network,
+            self.feature_mask_no_nans,
+            self.scaler.mean_,
+            self.scaler.scale_,
+        ).eval()
+        example = torch.zeros((2, len(self.feature_mask_no_nans)))
+        # torch 2.9+ помечает torch.jit устаревшим, но загрузка без Python-кода
+        # модели есть только у TorchScript
+        with torch.no_grad(), warnings.catch_warnings():
+            warnings.simplefilter("ignore", FutureWarning)
+            module = torch.jit.freeze(torch.jit.trace(frozen, example))
+
+        return ScriptedTabNet(
+            features_type=self.features_type,
+            avaliability=self.avaliability,
+            target_name=self.target_name,
+            horizon=self.horizon,
+            features=self.avail_features_full[self.features_type][self.avaliability],
+            module=module,
         )
-        return pred_df
@@ -0,0 +1,145 @@
+from typing import Iterator, Optional
+
+import attrs
+import numpy as np
+import torch
+from pytorch_tabnet.pretraining import TabNetPretrainer
+from pytorch_tabnet.tab_model import TabNetRegressor
+from torch.nn.utils import clip_grad_norm_
+
+import config
+
+
+def set_torch_threads(thread_count: int = config.TORCH_THREAD_COUNT) -> None:
+    # не больше заданного и не больше, чем уже выделил воркер сетки:
+    # лишние потоки torch конкурируют с CatBoost за ядра
+    thread_count = min(thread_count, torch.get_num_threads())
+    if torch.get_num_threads() != thread_count:
+        torch.set_num_threads(thread_count)
+
+
+# Батчи из заранее собранных тензоров вместо DataLoader: выборки TabNet
+# маленькие, и на батче из 8 строк сборка через Dataset и collate
+# заметна на фоне шага сети. Порядок батчей и расход глобального генератора
+# torch те же, что у DataLoader, поэтому обучение не меняется
+@attrs.define(slots=True)
+class _TensorBatches:
+    X: torch.Tensor
+    y: Optional[torch.Tensor]
+    batch_size: int
+    shuffle: bool
+    drop_last: bool
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.X) // self.batch_size
+        return -(-len(self.X) // self.batch_size)
+
+    def __iter__(self) -> Iterator:
+        # DataLoader на каждой эпохе берёт из генератора seed воркеров,
+        # а RandomSampler — seed перестановки
+        torch.empty((), dtype=torch.int64).random_()
+        X, y = self.X, self.y
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_()))
+            order = torch.randperm(len(X), generator=generator)
+            X = X[order]
+            y = None if y is None else y[order]
+
+        for index in range(len(self)):
+            rows = slice(index * self.batch_size, (index + 1) * self.batch_size)
+            yield X[rows] if y is None else (X[rows], y[rows])
+
+
+def _to_tensor(X: np.ndarray) -> torch.Tensor:
+    return torch.from_numpy(np.ascontiguousarray(X, dtype=np.float32))
+
+
+# Общее для регрессора и предобучения: pytorch-tabnet обходит дерево модулей
+# сети на каждом батче дважды (обнуление градиентов и clip_grad_norm_), здесь
+# список параметров собирается один раз при создании оптимизатора
+class _TensorTrainingMixin:
+    def _set_optimizer(self):
+        self._network_parameters = list(self.network.parameters())
+        # многотензорный шаг Adam вместо цикла по параметрам в Python
+        self._optimizer = self.optimizer_fn(
+            self._network_parameters, **{"foreach": True, **self.optimizer_params}
+        )
+
+    def _step(self, loss: torch.Tensor) -> float:
+        loss.backward()
+        if self.clip_value:
+            clip_grad_norm_(self._network_parameters, self.clip_value)
+        self._optimizer.step()
+
+        return loss.item()
+
+    def _zero_grad(self) -> None:
+        for param in self._network_parameters:
+            param.grad = None
+
+
+# TabNetRegressor, обучающийся на _TensorBatches. Сеть, оптимизатор и
+# ранняя остановка — из pytorch-tabnet без изменений
+class TensorTabNetRegressor(_TensorTrainingMixin, TabNetRegressor):
+    def _construct_loaders(self, X_train, y_train, eval_set):
+        train_batches = _TensorBatches(
+            _to_tensor(X_train),
+            # таргет остаётся float64: по нему считается метрика ранней остановки
+            torch.from_numpy(np.ascontiguousarray(self.prepare_target(y_train))),
+            self.batch_size,
+            shuffle=True,
+            drop_last=self.drop_last,
+        )
+        valid_batches = [
+            _TensorBatches(
+                _to_tensor(X),
+                torch.from_numpy(np.ascontiguousarray(self.prepare_target(y))),
+                self.batch_size,
+                shuffle=False,
+                drop_last=False,
+            )
+            for X, y in eval_set
+        ]
+
+        return train_batches, valid_batches
+
+    def _train_batch(self, X, y):
+        X = X.to(self.device).float()
+        y = y.to(self.device).float()
+        if self.augmentations is not None:
+            X, y = self.augmentations(X, y)
+
+        self._zero_grad()
+        output, M_loss = self.network(X)
+        loss = self.compute_loss(output, y) - self.lambda_sparse * M_loss
+
+        return {"batch_size": X.shape[0], "loss": self._step(loss)}
+
+
+# То же для предобучения; в pytorch-tabnet валидация предобучения
+# перемешивается так же, как train
+class TensorTabNetPretrainer(_TensorTrainingMixin, TabNetPretrainer):
+    def _construct_loaders(self, X_train, eval_set):
+        train_batches, *valid_batches = [
+            _TensorBatches(
+                _to_tensor(X),
+                None,
+                self.batch_size,
+                shuffle=True,
+                drop_last=self.drop_last,
+            )
+            for X in [X_train, *eval_set]
+        ]
+
+        return train_batches, valid_batches
+
+    def _train_batch(self, X):
+        X = X.to(self.device).float()
+
+        self._zero_grad()
+        output, embedded_x, obf_vars = self.network(X)
+        loss = self.compute_loss(output, embedded_x, obf_vars)
+
+        return {"batch_size": X.shape[0], "loss": self._step(loss)}
@@ -0,0 +1,105 @@
+from typing import Any, Dict, Optional
+
+import attrs
+import numpy as np
+from pytorch_tabnet.pretraining import TabNetPretrainer
+from sklearn.preprocessing import StandardScaler
+
+import config
+from models.design import DataT, HorizonT, TargetT, get_horizon_design
+from models.tabnet_engine import TensorTabNetPretrainer, set_torch_threads
+
+
+def _no_nans_mask(designs: list[np.ndarray]) -> np.ndarray:
+    return ~np.any([np.isnan(X).any(axis=0) for X in designs], axis=0)
+
+
+# Горизонты, у которых после отбрасывания колонок с пропусками остаются одни и
+# те же признаки: только у таких ячеек совпадает вход сети, и они могут
+# дообучаться от общего предобучения
+def group_horizons(
+    train: DataT,
+    valid: DataT,
+    features: list[str],
+    target_grid: list[TargetT],
+    horizon_grid: list[HorizonT],
+) -> list[list[HorizonT]]:
+    groups: dict[bytes, list[HorizonT]] = {}
+    for horizon in horizon_grid:
+        mask = _no_nans_mask(
+            [
+                get_horizon_design(data, features, target_name, horizon)
+                for data in (train, valid)
+                for target_name in target_grid
+            ]
+        )
+        groups.setdefault(mask.tobytes(), []).append(horizon)
+
+    return list(groups.values())
+
+
+# Предобучение TabNet без учителя (восстановление замаскированных признаков),
+# одно на набор признаков (features_type, avaliability) и группу горизонтов из
+# group_horizons. Строки — дизайны всех таргетов и горизонтов группы, поэтому
+# колонки совпадают с дизайном любой её ячейки: лаг своего таргета в одной и
+# той же колонке
+@attrs.define(slots=True)
+class TabNetPretraining:
+    features_type: str
+    avaliability: int
+    target_grid: list[TargetT]
+    horizon_grid: list[HorizonT]
+    avail_features_full: dict
+    params: Dict[str, Any] = attrs.field(factory=dict)
+    # ключ в хранилище моделей, входит в ключи дообученных на нём моделей
+    key: Optional[str] = None
+    model: Optional[TabNetPretrainer] = None
+    scaler: Optional[StandardScaler] = None
+    feature_mask_no_nans: Optional[np.ndarray] = None
+
+    def _get_design(self, data: DataT) -> np.ndarray:
+        return np.vstack(
+            [
+                get_horizon_design(
+                    data,
+                    self.avail_features_full[self.features_type][self.avaliability],
+                    target_name,
+                    horizon,
+                )
+                for target_name in self.target_grid
+                for horizon in self.horizon_grid
+            ]
+        )
+
+    def fit(self, train: DataT, valid: DataT):
+
+        X_train = self._get_design(train)
+        X_valid = self._get_design(valid)
+
+        # маска и масштаб общие для всех ячеек группы
+        self.feature_mask_no_nans = _no_nans_mask([X_train, X_valid])
+        self.scaler = StandardScaler()
+        X_train = self.scaler.fit_transform(X_train[:, self.feature_mask_no_nans])
+        X_valid = self.scaler.transform(X_valid[:, self.feature_mask_no_nans])
+
+        set_torch_threads()
+        pretrainer = (
+            TensorTabNetPretrainer if config.TENSOR_BATCHES_TABNET else TabNetPretrainer
+        )
+        self.model = pretrainer(
+            optimizer_params={"lr": self.params.get("learning_rate", 0.05)},
+            mask_type=self.params.get("mask_type", "sparsemax"),
+            device_name=self.params.get("device_name", "cpu"),
+            verbose=0,
+        )
+        self.model.fit(
+            X_train=X_train,
+            eval_set=[X_valid],
+            eval_name=["valid"],
+            pretraining_ratio=self.params.get("pretraining_ratio", 0.5),
+            max_epochs=self.params.get("max_epochs", 100),
+            patience=self.params.get("early_stopping_rounds", 10),
+            batch_size=self.params.get("batch_size", 64),
+            virtual_batch_size=self.params.get("virtual_batch_size", 8),
+            drop_last=False,
+        )
@@ -0,0 +1,160 @@
+import json
+import warnings
+from typing import Optional
+
+import attrs
+import numpy as np
+import polars as pl
+import torch
+
+import config
+from models.design import (
+    DataT,
+    HorizonT,
+    TargetT,
+    get_horizon_dates,
+    get_horizon_design,
+    get_target_names,
+)
+
+
+def get_tabnet_pred_frame(
+    preds: np.ndarray,
+    test: DataT,
+    features_type: str,
+    avaliability: int,
+    target_name: TargetT,
+    horizon: HorizonT,
+) -> pl.DataFrame:
+    pred_dates = get_horizon_dates(test, horizon)
+
+    return pl.concat(
+        [
+            pred_dates.select("date").with_columns(
+                pl.Series(preds[:, index]).alias("pred_tabnet"),
+                pred_dates["horizon"],
+                pl.lit(avaliability).alias("avaliability"),
+                pl.lit(target_name).alias("target_name"),
+                pl.lit(features_type).alias("features_type"),
+            )
+            for index, target_name in enumerate(get_target_names(target_name))
+        ]
+    )
+
+
+def _make_ix_like(input: torch.Tensor) -> torch.Tensor:
+    return torch.arange(1, input.size(-1) + 1, dtype=input.dtype).view(1, -1)
+
+
+# sparsemax и entmax15 из pytorch_tabnet — autograd.Function, которые
+# TorchScript не сохраняет; здесь тот же прямой проход по последней оси
+class ScriptSparsemax(torch.nn.Module):
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        input = input - input.max(dim=-1, keepdim=True)[0]
+        input_srt = torch.sort(input, descending=True, dim=-1)[0]
+        input_cumsum = input_srt.cumsum(-1) - 1
+        support = _make_ix_like(input) * input_srt > input_cumsum
+        support_size = support.sum(dim=-1).unsqueeze(-1)
+        tau = input_cumsum.gather(-1, support_size - 1)
+        tau = tau / support_size.to(input.dtype)
+        return torch.clamp(input - tau, min=0)
+
+
+class ScriptEntmax15(torch.nn.Module):
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        input = (input - input.max(dim=-1, keepdim=True)[0]) / 2
+        Xsrt = torch.sort(input, descending=True, dim=-1)[0]
+        rho = _make_ix_like(input)
+        mean = Xsrt.cumsum(-1) / rho
+        mean_sq = (Xsrt**2).cumsum(-1) / rho
+        delta = (1 - rho * (mean_sq - mean**2)) / rho
+        tau = mean - torch.sqrt(torch.clamp(delta, 0))
+        support_size = (tau <= Xsrt).sum(-1).unsqueeze(-1)
+        tau_star = tau.gather(-1, support_size - 1)
+        return torch.clamp(input - tau_star, min=0) ** 2
+
+
+# Сеть TabNet вместе с маской колонок и StandardScaler: на входе строки
+# get_horizon_design, на выходе прогноз, как у TabNetModel.predict
+class FrozenTabNet(torch.nn.Module):
+    def __init__(
+        self,
+        network: torch.nn.Module,
+        feature_mask: np.ndarray,
+        mean: np.ndarray,
+        scale: np.ndarray,
+    ):
+        super().__init__()
+        self.network = network
+        self.register_buffer("columns", torch.from_numpy(np.flatnonzero(feature_mask)))
+        self.register_buffer("mean", torch.from_numpy(mean))
+        self.register_buffer("scale", torch.from_numpy(scale))
+
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        X = X.index_select(1, self.columns)
+        # как StandardScaler на float32: шаги во float64, результат — float32
+        X = (X.double() - self.mean).float()
+        X = (X.double() / self.scale).float()
+        # пропуск — среднее по train, как у TabNetModel.predict
+        X = torch.where(torch.isnan(X), torch.zeros_like(X), X)
+        return self.network(X)[0]
+
+
+# Обученная TabNet как модуль TorchScript: загружается и прогнозирует без
+# pytorch_tabnet. Строки дизайна копируются в один заранее выделенный тензор
+@attrs.define(slots=True)
+class ScriptedTabNet:
+    features_type: str
+    avaliability: int
+    target_name: TargetT
+    horizon: HorizonT
+    features: list[str]
+    module: torch.jit.ScriptModule
+    _inputs: Optional[torch.Tensor] = attrs.field(default=None, init=False)
+
+    def predict_design(self, X: np.ndarray) -> np.ndarray:
+        if len(X) > config.TABNET_SCRIPT_BUFFER_ROWS:
+            inputs = torch.from_numpy(np.ascontiguousarray(X, dtype=np.float32))
+        else:
+            if self._inputs is None or self._inputs.shape[0] < len(X):
+                self._inputs = torch.empty(X.shape, dtype=torch.float32)
+            inputs = self._inputs[: len(X)]
+            inputs.numpy()[:] = X
+
+        with torch.inference_mode():
+            return self.module(inputs).numpy()
+
+    def predict(self, test: DataT) -> pl.DataFrame:
+        X_test = get_horizon_design(test, self.features, self.target_name, self.horizon)
+
+        return get_tabnet_pred_frame(
+            self.predict_design(X_test),
+            test,
+            self.features_type,
+            self.avaliability,
+            self.target_name,
+            self.horizon,
+        )
+
+    def save(self, path: str) -> None:
+        meta = {
+            "features_type": self.features_type,
+            "avaliability": self.avaliability,
+            "target_name": self.target_name,
+            "horizon": self.horizon,
+            "features": self.features,
+        }
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", FutureWarning)
+            torch.jit.save(
+                self.module, path, _extra_files={"meta.json": json.dumps(meta)}
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "ScriptedTabNet":
+        extra_files = {"meta.json": ""}
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", FutureWarning)
+            module = torch.jit.load(path, _extra_files=extra_files)
+
+        return cls(**json.loads(extra_files["meta.json"]), module=module)
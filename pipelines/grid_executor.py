@@ -0,0 +1,93 @@
+import logging
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Iterator
+
+import attrs
+from threadpoolctl import threadpool_limits
+
+import config
+
+logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+# ячейка сетки: (cell, data, thread_count) -> прогноз (или прогноз вместе
+# со служебными счётчиками ячейки)
+FitCellT = Callable[[tuple, tuple, int], Any]
+
+# данные и лимит потоков процесса-воркера, задаются один раз в _init_worker
+_worker_data: tuple = ()
+_worker_threads: int = 1
+_worker_limits: Any = None
+
+
+def _set_torch_threads(thread_count: int) -> None:
+    # torch импортирует только TabNet, остальным воркерам он не нужен
+    torch = sys.modules.get("torch")
+    thread_count = min(thread_count, config.TORCH_THREAD_COUNT)
+    if torch is not None and torch.get_num_threads() != thread_count:
+        torch.set_num_threads(thread_count)
+
+
+def _init_worker(data: tuple, thread_count: int) -> None:
+    global _worker_data, _worker_threads, _worker_limits
+
+    _worker_data = data
+    _worker_threads = thread_count
+    # BLAS/OpenMP внутри numpy и sklearn тоже держим в бюджете воркера
+    _worker_limits = threadpool_limits(limits=thread_count)
+
+
+def _run_cell(fit_cell: FitCellT, cell: tuple) -> Any:
+    _set_torch_threads(_worker_threads)
+    return fit_cell(cell, _worker_data, _worker_threads)
+
+
+# Перебор независимых ячеек сетки моделей. Данные передаются воркерам один раз
+# при старте, результаты возвращаются в порядке cells, поэтому при любом числе
+# воркеров прогнозы совпадают с последовательным запуском.
+@attrs.define(slots=True)
+class GridExecutor:
+    workers: int = config.GRID_WORKERS
+    cpu_budget: int = config.GRID_CPU_BUDGET
+
+    @property
+    def thread_count(self) -> int:
+        return max(1, self.cpu_budget // self.workers)
+
+    def iter_completed(
+        self, fit_cell: FitCellT, cells: list[tuple], data: tuple
+    ) -> Iterator[tuple[int, Any]]:
+        # (номер ячейки, прогноз) по мере готовности — для записи на диск
+        # до окончания всей сетки
+        if self.workers <= 1:
+            for index, cell in enumerate(cells):
+                yield index, fit_cell(cell, data, self.thread_count)
+            return
+
+        logger.info(
+            f"Fitting {len(cells)} cells on {self.workers} workers"
+            f" with {self.thread_count} threads each"
+        )
+
+        # spawn: fork процесса с уже запущенными потоками torch/catboost небезопасен
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(data, self.thread_count),
+        ) as executor:
+            futures = {
+                executor.submit(_run_cell, fit_cell, cell): index
+                for index, cell in enumerate(cells)
+            }
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def map(self, fit_cell: FitCellT, cells: list[tuple], data: tuple) -> list[Any]:
+        results = [None] * len(cells)
+        for index, result in self.iter_completed(fit_cell, cells, data):
+            results[index] = result
+
+        return results
@@ -0,0 +1,433 @@
+import asyncio
+import copy
+import functools
+import io
+import json
+import logging
+import os
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Optional
+
+import attrs
+import polars as pl
+from dateutil.relativedelta import relativedelta
+
+import config
+from models.artifact_store import ModelArtifactStore
+from models.dfm import DFM
+from models.fit_planner import FitPlanner
+from models.tabnet_script import ScriptedTabNet
+from preprocess_data.feature_matrix import FeatureMatrix, FeatureMatrixSplit
+from preprocess_data.montlhy_to_quarterly import MonthlyToQuarterlyService
+from preprocess_data.prepare_data import FeaturesService
+
+logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+# манифесты сеток в хранилище моделей, их пишут run_main_*
+_MANIFESTS = ["gb", "gb_pooled", "ngb", "ngb_pooled", "tabnet", "tabnet_pooled", "dfm"]
+
+# колонки ответа: у GB, NGB и TabNet метки DFM пустые
+_NOWCAST_COLUMNS = [
+    "model",
+    "target_name",
+    "horizon",
+    "date",
+    "features_type",
+    "avaliability",
+    "features_strategy",
+    "k_factors",
+    "factor_order",
+    "pred",
+    "avaliability_observed",
+    "pred_missing",
+]
+
+
+def _vintage_key(
+    monthly_data_raw: pl.DataFrame, quarterly_data_raw: pl.DataFrame
+) -> str:
+    return FitPlanner.fingerprint(
+        *[
+            part
+            for frame in (monthly_data_raw, quarterly_data_raw)
+            for part in (str(frame.schema), frame.hash_rows().to_numpy())
+        ]
+    )
+
+
+def _quarters_after(anchor: date, count: int) -> list[date]:
+    return [anchor + relativedelta(months=3 * step) for step in range(count)]
+
+
+# Признаки одной версии данных: anchor — квартал последнего месяца данных,
+# модель горизонта h прогнозирует квартал anchor + h - 1 по его признакам
+@attrs.define(slots=True)
+class NowcastVintage:
+    anchor: date
+    # сколько месяцев квартала anchor уже есть в данных
+    months_observed: int
+    # anchor и HORIZON - 1 следующих кварталов без данных: строки дизайна
+    # GB, NGB и TabNet для прогноза с anchor
+    split: FeatureMatrixSplit
+    # кварталы с START_YEAR по anchor, как у окон DFM
+    features: pl.DataFrame
+    # сырые месячные данные версии, из них сценарии пересчитывают признаки
+    monthly_data_raw: pl.DataFrame
+    # колонки таргетов (log_d4)
+    targets: list[str]
+    nowcast: Optional[pl.DataFrame] = None
+
+
+def _build_vintage(
+    monthly_data_raw: pl.DataFrame, quarterly_data_raw: pl.DataFrame
+) -> NowcastVintage:
+    anchor = monthly_data_raw.select(pl.col("datem").max().dt.truncate("1q")).item()
+    months_observed = monthly_data_raw.filter(pl.col("datem") >= anchor).height
+
+    # кварталы, по которым месячные данные уже есть, а квартальных ещё нет,
+    # дописываются пустыми строками: иначе join признаков их отбросит
+    new_quarters = (
+        monthly_data_raw.select(
+            pl.col("datem").dt.truncate("1q").unique().alias("dateq")
+        )
+        .filter(pl.col("dateq") > quarterly_data_raw["dateq"].max())
+        .with_columns(
+            pl.col("dateq").dt.quarter().alias("quarter"),
+            pl.col("dateq").dt.year().alias("year"),
+        )
+    )
+    quarterly_data_raw = pl.concat(
+        [quarterly_data_raw, new_quarters], how="diagonal"
+    ).sort("dateq")
+
+    features_service = FeaturesService()
+    monthly_data, quarterly_data = features_service.get_features_from_raw(
+        monthly_data_raw, quarterly_data_raw
+    )
+    mtoq_service = MonthlyToQuarterlyService(
+        features_service.columns_d12, features_service.columns_rolling
+    )
+    features = mtoq_service.run_transorm(monthly_data, quarterly_data)
+
+    future_dates = _quarters_after(anchor, config.HORIZON)
+    matrix = FeatureMatrix.from_features(
+        pl.concat(
+            [
+                features,
+                pl.DataFrame({"date": future_dates[1:]}, schema={"date": pl.Date}),
+            ],
+            how="diagonal",
+        ),
+        mtoq_service.avail_features_full,
+        features_service.columns_d4,
+    )
+
+    return NowcastVintage(
+        anchor=anchor,
+        months_observed=months_observed,
+        split=matrix.split(future_dates[0], future_dates[-1]),
+        features=features.filter(pl.col("date").dt.year() >= config.START_YEAR),
+        monthly_data_raw=monthly_data_raw,
+        targets=features_service.columns_d4,
+    )
+
+
+def _dfm_labels(cell: list) -> list[pl.Expr]:
+    _, features_type, features_strategy, avaliability, k_factors, factor_order = cell
+
+    return [
+        pl.lit("dfm").alias("model"),
+        pl.lit(features_type).alias("features_type"),
+        pl.lit(avaliability).alias("avaliability"),
+        pl.lit(features_strategy).alias("features_strategy"),
+        pl.lit(k_factors).alias("k_factors"),
+        pl.lit(factor_order).alias("factor_order"),
+    ]
+
+
+def _predict_dfm(dfm: DFM, vintage: NowcastVintage) -> Optional[pl.DataFrame]:
+    # модель из хранилища дообновляется кварталами после своего окна; update
+    # заменяет атрибуты, а не меняет их, поэтому достаточно копии объекта
+    dfm = copy.copy(dfm)
+    history = vintage.features.filter(pl.col("date") < vintage.anchor)
+    last_date = DFM._select(dfm.train_dfm, dfm.targets).index.max()
+    if history["date"].max() > last_date.date() and not dfm.update(history):
+        return None
+
+    # у DFM признаки — в квартале прогноза, поэтому с anchor только горизонт 1
+    anchor_features = vintage.features.filter(pl.col("date") == vintage.anchor)
+    # statsmodels не прогнозирует с пропуском в exog (ряд ещё не вышел за
+    # последний месяц), тогда прогноз — NaN; свёрнутый DFM пропуски учитывает
+    if type(dfm) is DFM and DFM._select(
+        anchor_features, dfm._get_features_names()
+    ).isna().any(axis=None):
+        return pl.DataFrame(
+            {
+                "date": [vintage.anchor] * len(dfm.targets),
+                "horizon": [1] * len(dfm.targets),
+                "target_name": dfm.targets,
+                "pred": [float("nan")] * len(dfm.targets),
+            }
+        )
+
+    pred = dfm.predict(anchor_features)
+
+    return pred.unpivot(
+        index=["date", "horizon"],
+        on=[target + "_dfm_pred" for target in dfm.targets],
+        variable_name="target_name",
+        value_name="pred",
+    ).with_columns(pl.col("target_name").str.strip_suffix("_dfm_pred"))
+
+
+# Прогнозы по свежей версии данных сразу всеми обученными моделями: модели
+# загружаются из хранилища по манифестам сеток один раз, признаки и прогнозы
+# каждой версии данных считаются один раз и хранятся в памяти
+@attrs.define(slots=True)
+class NowcastService:
+    store: ModelArtifactStore = attrs.field(factory=ModelArtifactStore)
+    vintage_cache_size: int = config.NOWCAST_VINTAGE_CACHE_SIZE
+    # манифест -> [(ячейка, ключ, модель)]
+    models: Optional[dict[str, list[tuple[list, str, Any]]]] = attrs.field(
+        default=None, init=False
+    )
+    _vintages: OrderedDict = attrs.field(factory=OrderedDict, init=False)
+
+    def _load_model(self, name: str, key: str) -> Optional[Any]:
+        # у TabNet модуль TorchScript, если он экспортирован, быстрее модели
+        if name.startswith("tabnet"):
+            script_path = self.store.script_path(key)
+            if os.path.exists(script_path):
+                self.store.touch(key)
+                return ScriptedTabNet.load(script_path)
+
+        return self.store.load(key)
+
+    def load_models(self) -> None:
+        self.models = {}
+        # прогнозы прошлых версий данных считались прежними моделями
+        self._vintages.clear()
+
+        loaded = {}
+        for name in _MANIFESTS:
+            manifest = self.store.load_manifest(name)
+            if manifest is None:
+                continue
+
+            entries = []
+            for entry in manifest:
+                key = entry["key"]
+                if key not in loaded:
+                    loaded[key] = self._load_model(name, key)
+                if loaded[key] is None:
+                    logger.info(f"Model {key} from manifest {name} is not in store")
+                    continue
+                entries.append((entry["cell"], key, loaded[key]))
+            self.models[name] = entries
+
+        logger.info(
+            f"{len(loaded)} models were loaded for nowcasting: "
+            + ", ".join(
+                f"{name} {len(entries)}" for name, entries in self.models.items()
+            )
+        )
+
+    def _predict(self, vintage: NowcastVintage) -> pl.DataFrame:
+        frames = []
+        # одинаковые ячейки сетки DFM хранятся одной моделью
+        dfm_preds = {}
+        for name, entries in self.models.items():
+            for cell, key, model in entries:
+                if isinstance(model, DFM):
+                    if key not in dfm_preds:
+                        dfm_preds[key] = _predict_dfm(model, vintage)
+                        if dfm_preds[key] is None:
+                            logger.info(
+                                f"DFM {key} can't be updated with new quarters,"
+                                " nowcast is skipped"
+                            )
+                    if dfm_preds[key] is not None:
+                        frames.append(dfm_preds[key].with_columns(*_dfm_labels(cell)))
+                    continue
+
+                frames.append(
+                    model.predict(vintage.split).select(
+                        pl.lit(name).alias("model"),
+                        "target_name",
+                        "horizon",
+                        "date",
+                        "features_type",
+                        "avaliability",
+                        pl.lit(None, pl.String).alias("features_strategy"),
+                        pl.lit(None, pl.Int32).alias("k_factors"),
+                        pl.lit(None, pl.Int32).alias("factor_order"),
+                        # TabNet из TorchScript прогнозирует во float32
+                        pl.col("^pred_.*$").cast(pl.Float64).alias("pred"),
+                    )
+                )
+
+        if not frames:
+            raise ValueError("No fitted models in store manifests, run the grids first")
+
+        # из строк дизайна нужен только прогноз с anchor: на горизонте h —
+        # квартал anchor + h - 1
+        nowcast_dates = pl.DataFrame(
+            {
+                "horizon": range(1, config.HORIZON + 1),
+                "date": _quarters_after(vintage.anchor, config.HORIZON),
+            },
+            schema={"horizon": pl.Int32, "date": pl.Date},
+        )
+
+        return (
+            pl.concat(
+                [
+                    frame.select(_NOWCAST_COLUMNS[:-2]).with_columns(
+                        pl.col(
+                            "horizon", "avaliability", "k_factors", "factor_order"
+                        ).cast(pl.Int32)
+                    )
+                    for frame in frames
+                ]
+            )
+            .join(nowcast_dates, on=["horizon", "date"], how="semi")
+            .with_columns(
+                (pl.col("avaliability") <= vintage.months_observed).alias(
+                    "avaliability_observed"
+                ),
+                # statsmodels DFM не прогнозирует с пропуском в exog
+                pl.col("pred").is_nan().alias("pred_missing"),
+            )
+        )
+
+    def get_vintage(
+        self,
+        monthly_data_raw: Optional[pl.DataFrame] = None,
+        quarterly_data_raw: Optional[pl.DataFrame] = None,
+    ) -> NowcastVintage:
+        # без аргументов — текущие файлы данных, как у FeaturesService
+        if monthly_data_raw is None or quarterly_data_raw is None:
+            monthly_data_disk, quarterly_data_disk = FeaturesService().get_raw_data()
+            if monthly_data_raw is None:
+                monthly_data_raw = monthly_data_disk
+            if quarterly_data_raw is None:
+                quarterly_data_raw = quarterly_data_disk
+
+        key = _vintage_key(monthly_data_raw, quarterly_data_raw)
+        vintage = self._vintages.get(key)
+        if vintage is not None:
+            self._vintages.move_to_end(key)
+            return vintage
+
+        vintage = _build_vintage(monthly_data_raw, quarterly_data_raw)
+        self._vintages[key] = vintage
+        if len(self._vintages) > self.vintage_cache_size:
+            self._vintages.popitem(last=False)
+
+        return vintage
+
+    def nowcast(
+        self,
+        monthly_data_raw: Optional[pl.DataFrame] = None,
+        quarterly_data_raw: Optional[pl.DataFrame] = None,
+    ) -> pl.DataFrame:
+        if self.models is None:
+            self.load_models()
+
+        vintage = self.get_vintage(monthly_data_raw, quarterly_data_raw)
+        if vintage.nowcast is None:
+            vintage.nowcast = self._predict(vintage)
+            logger.info(
+                f"Nowcast from {vintage.anchor} with {vintage.months_observed}"
+                f" months observed: {vintage.nowcast.height} forecasts"
+            )
+
+        return vintage.nowcast
+
+
+async def _handle_request(
+    service: NowcastService,
+    lock: asyncio.Lock,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+) -> None:
+    # GET /nowcast — прогноз по текущим файлам данных, POST /nowcast — по
+    # месячным данным из тела запроса (csv с колонкой datem, как у
+    # FeaturesService.get_raw_data)
+    try:
+        method, path, _ = (await reader.readline()).decode().split(" ", 2)
+        headers = {}
+        while line := (await reader.readline()).decode().strip():
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+        if path.split("?")[0] != "/nowcast" or method not in ("GET", "POST"):
+            status, payload = "404 Not Found", b'{"error": "not found"}'
+        else:
+            monthly_data_raw = None
+            if body:
+                monthly_data_raw = pl.read_csv(
+                    io.BytesIO(body), try_parse_dates=True, infer_schema_length=None
+                ).with_columns(pl.exclude("datem").cast(pl.Float64))
+
+            # модели и кэш версий общие: запросы считаются по одному, а цикл
+            # событий тем временем принимает новые соединения
+            async with lock:
+                nowcast = await asyncio.get_running_loop().run_in_executor(
+                    None, service.nowcast, monthly_data_raw
+                )
+            status, payload = "200 OK", nowcast.write_json().encode()
+    except (
+        ValueError,
+        KeyError,
+        asyncio.IncompleteReadError,
+        pl.exceptions.PolarsError,
+    ) as e:
+        status, payload = "400 Bad Request", json.dumps({"error": str(e)}).encode()
+    except Exception as e:
+        # любая другая ошибка (нет файлов данных, ошибка модели) — ответ 500,
+        # иначе клиент ждал бы на открытом соединении
+        logger.exception("Nowcast request failed")
+        status = "500 Internal Server Error"
+        payload = json.dumps({"error": f"{type(e).__name__}: {e}"}).encode()
+
+    try:
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode()
+            + payload
+        )
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+    except ConnectionError:
+        # клиент уже закрыл соединение
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_nowcast(
+    service: Optional[NowcastService] = None,
+    host: str = config.NOWCAST_HOST,
+    port: int = config.NOWCAST_PORT,
+) -> None:
+    if service is None:
+        service = NowcastService()
+    # модели загружаются до первого запроса
+    service.load_models()
+
+    server = await asyncio.start_server(
+        functools.partial(_handle_request, service, asyncio.Lock()), host, port
+    )
+    logger.info(f"Nowcast service is listening on http://{host}:{port}/nowcast")
+
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve_nowcast())
@@ -1,101 +1,340 @@
+import itertools
 import logging
 import os
 import warnings
+from typing import Optional
 
-import attrs
 import polars as pl
 from dateutil.relativedelta import relativedelta
-from statsmodels.tsa.statespace.dynamic_factor import DynamicFactor
 
 import config
+from models.artifact_store import ModelArtifactStore
+from models.collapsed_dfm import CollapsedDFM
+from models.design import get_indexed_pandas
 from models.dfm import DFM
-from preprocess_data.datae2e import DataE2E
+from models.fit_planner import FitPlanner
+from pipelines.grid_executor import GridExecutor
+from preprocess_data.feature_store import FeatureStore
 
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
 warnings.filterwarnings("ignore")
 
+_DFM_ENGINES = {"statsmodels": DFM, "collapsed": CollapsedDFM}
 
-def run_main_dfm() -> None:
-    logger.info("Start fitting DFM models")
 
-    train, valid, train_valid, test, avail_features_full = DataE2E().run()
+def _get_windows(
+    features: pl.DataFrame, columns: list[str], forecasts_steps: range
+) -> dict:
+    # каждое окно переводится в pandas один раз и затем общее для всех
+    # гиперпараметров и всех воркеров
+    windows = {}
+    for forecast_length in forecasts_steps:
+
+        end_date_dfm = features["date"].max() - relativedelta(
+            months=3 * (config.TEST_LEN - forecast_length - 1)
+        )
+        start_date_dfm = features["date"].max() - relativedelta(
+            months=3 * (config.TEST_LEN - 1 - forecast_length - 1 + config.HORIZON)
+        )
+
+        train_dfm = features.filter((pl.col("date") < start_date_dfm))
+        test_dfm = features.filter(
+            (pl.col("date") >= start_date_dfm) & (pl.col("date") <= end_date_dfm)
+        )
+
+        windows[forecast_length] = (
+            get_indexed_pandas(train_dfm, columns),
+            get_indexed_pandas(test_dfm, columns),
+        )
+
+    return windows
+
+
+def _cell_labels(cell: tuple) -> list[pl.Expr]:
+    _, features_type, features_strategy, avaliability, k_factors, factor_order = cell
+
+    return [
+        pl.lit(avaliability).alias("avaliability"),
+        pl.lit(features_type).alias("features_type"),
+        pl.lit(features_strategy).alias("features_strategy"),
+        pl.lit(k_factors).alias("k_factors"),
+        pl.lit(factor_order).alias("factor_order"),
+    ]
+
+
+def _plan_cells(cells: list[tuple], data: tuple, fit_planner: FitPlanner) -> list[int]:
+    # отпечаток ячейки — движок, гиперпараметры, окна и итоговый список
+    # признаков каждого окна: например, доступность 1 даёт одни и те же
+    # признаки при avail_only и all, и такая модель обучается один раз
+    windows, targets, avail_features_full, refit_every, engine = data
+
+    features_names = {}
+    keys = []
+    for cell in cells:
+        (
+            forecast_lengths,
+            features_type,
+            features_strategy,
+            avaliability,
+            k_factors,
+            factor_order,
+        ) = cell
+
+        cell_features_names = []
+        for forecast_length in forecast_lengths:
+            names_key = (
+                forecast_length,
+                features_type,
+                features_strategy,
+                avaliability,
+            )
+            if names_key not in features_names:
+                features_names[names_key] = _DFM_ENGINES[engine](
+                    train_dfm=windows[forecast_length][0],
+                    targets=targets,
+                    avaliability=avaliability,
+                    k_factors=k_factors,
+                    factor_order=factor_order,
+                    avail_features_full=avail_features_full,
+                    features_type=features_type,
+                    features_strategy=features_strategy,
+                )._get_features_names()
+            cell_features_names.append(features_names[names_key])
+
+        keys.append(
+            FitPlanner.fingerprint(
+                engine,
+                targets,
+                k_factors,
+                factor_order,
+                refit_every,
+                config.DFM_WARM_START,
+                forecast_lengths,
+                cell_features_names,
+            )
+        )
+
+    return fit_planner.dedupe(keys)
+
+
+def _fit_dfm(dfm: DFM, warm_start_from: Optional[DFM]) -> DFM:
+    dfm.fit(warm_start_from=warm_start_from)
+    return dfm
+
+
+def _fit_dfm_cell(
+    cell: tuple, data: tuple, thread_count: int
+) -> tuple[pl.DataFrame, Optional[str]]:
+    # ячейка — цепочка окон одной конфигурации: при тёплом старте окна
+    # считаются по порядку, и каждое стартует с параметров предыдущего;
+    # вместе с прогнозом возвращается ключ последней оценённой модели
+    (
+        forecast_lengths,
+        features_type,
+        features_strategy,
+        avaliability,
+        k_factors,
+        factor_order,
+    ) = cell
+    windows, targets, avail_features_full, refit_every, engine = data
+
+    store = ModelArtifactStore()
+    pred_dfm_list = []
+    prev_dfm = None
+    prev_key = None
+    for window_index, forecast_length in enumerate(forecast_lengths):
+        train_dfm, test_dfm = windows[forecast_length]
+
+        # между переоценками параметров модель только дообновляется новыми
+        # наблюдениями; если это невозможно, окно оценивается заново
+        if (
+            prev_dfm is not None
+            and window_index % refit_every != 0
+            and prev_dfm.update(train_dfm)
+        ):
+            dfm = prev_dfm
+            loaded = False
+        else:
+            dfm = _DFM_ENGINES[engine](
+                train_dfm=train_dfm,
+                targets=targets,
+                avaliability=avaliability,
+                k_factors=k_factors,
+                factor_order=factor_order,
+                avail_features_full=avail_features_full,
+                features_type=features_type,
+                features_strategy=features_strategy,
+            )
+
+            warm_start_from = prev_dfm if config.DFM_WARM_START else None
+            # тёплый старт зависит от предыдущей оценки, поэтому её ключ
+            # входит в ключ окна
+            train_values = dfm._select(
+                train_dfm, dfm.targets + dfm._get_features_names()
+            )
+            dfm_key = ModelArtifactStore.fingerprint(
+                type(dfm).__name__,
+                k_factors,
+                factor_order,
+                list(train_values.columns),
+                train_values.to_numpy(),
+                train_values.index.to_numpy(),
+                prev_key if warm_start_from is not None else None,
+            )
+            dfm, loaded = store.get_or_fit(
+                dfm_key, lambda: _fit_dfm(dfm, warm_start_from)
+            )
+            if loaded:
+                # диагностика оценки из хранилища относится к прошлому запуску
+                dfm.fit_info = {"fit_mode": "store", "iterations": 0, "fcalls": 0}
+            prev_key = dfm_key
+        prev_dfm = dfm
+
+        pred_dfm = dfm.predict(test_dfm)
+
+        pred_dfm = pred_dfm.with_columns(
+            *_cell_labels(cell),
+            pl.lit(dfm.fit_info["fit_mode"]).alias("fit_mode"),
+            pl.lit(dfm.fit_info["iterations"]).alias("iterations"),
+            pl.lit(dfm.fit_info["fcalls"]).alias("fcalls"),
+            pl.lit(refit_every).alias("refit_every"),
+            pl.lit(engine).alias("engine"),
+        )
+        pred_dfm_list.append(pred_dfm)
+
+        logger.info(
+            f"DFM for {test_dfm.index.min().date()}–{test_dfm.index.max().date()}"
+            f" was {'loaded from store' if loaded else 'fitted'}:"
+            f" features_type={features_type},"
+            f" features_strategy={features_strategy}, avaliability={avaliability},"
+            f" k_factors={k_factors}, factor_order={factor_order},"
+            f" fit_mode={dfm.fit_info['fit_mode']}, {dfm.fit_info['iterations']}"
+            f" iterations, {dfm.fit_info['fcalls']} function evaluations"
+        )
+
+    return pl.concat(pred_dfm_list), prev_key
+
+
+def run_main_dfm(
+    refit_every: int = config.DFM_REFIT_EVERY, engine: str = config.DFM_ENGINE
+) -> None:
+    if engine not in _DFM_ENGINES:
+        raise ValueError(f"engine must be one of {list(_DFM_ENGINES)}, got {engine}")
+
+    logger.info(f"Start fitting DFM models, engine: {engine}")
+
+    features_type_grid = ["d12"]
+
+    train, valid, train_valid, test, avail_features_full = FeatureStore().get(
+        features_types=features_type_grid
+    )
     features = pl.concat([train, valid, test])
 
     targets = ["gdp_log_d4", "cons_log_d4", "inv_log_d4", "inv_cap_log_d4"]
 
     forecasts_steps = range(config.TEST_LEN + config.HORIZON - 1)
 
-    features_type_grid = ["d12"]
     features_strategy_grid = ["avail_only", "all"]
     avaliability_grid = range(1, config.MAX_AVALIABILITY + 1)
     k_factors_grid = config.K_FACTORS_GRID
     factor_order_grid = config.FACTOR_ORDER_GRID
 
-    pred_dfm_list = []
+    columns = targets + [
+        column
+        for features_type in features_type_grid
+        for avaliability in avaliability_grid
+        for column in avail_features_full[features_type][avaliability]
+    ]
+    windows = _get_windows(features, columns, forecasts_steps)
 
-    for forecast_length in forecasts_steps:
+    # при тёплом старте и дообновлении окна одной конфигурации зависят друг
+    # от друга и идут одной ячейкой, иначе каждое окно — отдельная ячейка
+    if config.DFM_WARM_START or refit_every > 1:
+        windows_grid = [tuple(forecasts_steps)]
+    else:
+        windows_grid = [(forecast_length,) for forecast_length in forecasts_steps]
 
-        end_date_dfm = features["date"].max() - relativedelta(
-            months=3 * (config.TEST_LEN - forecast_length - 1)
-        )
-        start_date_dfm = features["date"].max() - relativedelta(
-            months=3 * (config.TEST_LEN - 1 - forecast_length - 1 + config.HORIZON)
+    cells = list(
+        itertools.product(
+            windows_grid,
+            features_type_grid,
+            features_strategy_grid,
+            avaliability_grid,
+            k_factors_grid,
+            factor_order_grid,
         )
-        end_date_dfm, start_date_dfm
+    )
 
-        train_dfm = features.filter((pl.col("date") < start_date_dfm))
-        test_dfm = features.filter(
-            (pl.col("date") >= start_date_dfm) & (pl.col("date") <= end_date_dfm)
-        )
+    data = (windows, targets, avail_features_full, refit_every, engine)
 
-        test_dates = sorted(test_dfm["date"].unique().to_list())
-        logger.info(f"Start training DFM to predict {test_dates} period")
-
-        for features_type in features_type_grid:
-            for features_strategy in features_strategy_grid:
-                for avaliability in avaliability_grid:
-                    for k_factors in k_factors_grid:
-                        for factor_order in factor_order_grid:
-
-                            logger.info(
-                                f"DFM has parameters features_type={features_type}, "
-                                f"features_strategy={features_strategy}, avaliability={avaliability}"
-                            )
-                            logger.info(
-                                f"k_factors={k_factors}, factor_order={factor_order}"
-                            )
-                            dfm = DFM(
-                                train_dfm=train_dfm,
-                                targets=targets,
-                                avaliability=avaliability,
-                                k_factors=k_factors,
-                                factor_order=factor_order,
-                                avail_features_full=avail_features_full,
-                                features_type=features_type,
-                                features_strategy=features_strategy,
-                            )
-
-                            dfm.fit()
-
-                            pred_dfm = dfm.predict(test_dfm)
-
-                            pred_dfm = pred_dfm.with_columns(
-                                pl.lit(avaliability).alias("avaliability"),
-                                pl.lit(features_type).alias("features_type"),
-                                pl.lit(features_strategy).alias("features_strategy"),
-                                pl.lit(k_factors).alias("k_factors"),
-                                pl.lit(factor_order).alias("factor_order"),
-                            )
-
-                            pred_dfm_list.append(pred_dfm)
-                            logger.info(f"Successfully fitted")
+    # дубликаты не обучаются: они получают прогноз первой такой же ячейки
+    # со своими метками и fit_mode "reused"
+    fit_planner = FitPlanner()
+    first_index = _plan_cells(cells, data, fit_planner)
+    unique_cells = sorted(set(first_index))
+    duplicates = {index: [] for index in unique_cells}
+    for index, first in enumerate(first_index):
+        duplicates[first].append(index)
 
-    dfm_preds_pl_df = pl.concat(pred_dfm_list)
+    # готовые прогнозы сразу дописываются в partial-файл, чтобы долгий
+    # расчёт не терялся целиком; итоговый csv пишется в порядке сетки
     os.makedirs("preds", exist_ok=True)
+    partial_path = "preds/dfm_pred_test.partial.csv"
+    pred_dfm_list = [None] * len(cells)
+    keys = [None] * len(cells)
+    with open(partial_path, "w") as partial_file:
+        for done_count, (unique_index, (pred_dfm, key)) in enumerate(
+            GridExecutor().iter_completed(
+                _fit_dfm_cell, [cells[index] for index in unique_cells], data
+            ),
+            start=1,
+        ):
+            first = unique_cells[unique_index]
+            for index in duplicates[first]:
+                keys[index] = key
+                if index != first:
+                    pred_dfm_list[index] = pred_dfm.with_columns(
+                        *_cell_labels(cells[index]),
+                        pl.lit("reused").alias("fit_mode"),
+                        pl.lit(0).alias("iterations"),
+                        pl.lit(0).alias("fcalls"),
+                    )
+                else:
+                    pred_dfm_list[index] = pred_dfm
+                pred_dfm_list[index].write_csv(
+                    partial_file, include_header=partial_file.tell() == 0
+                )
+            partial_file.flush()
+            logger.info(f"{done_count}/{len(unique_cells)} DFM cells are done")
+
+    dfm_preds_pl_df = pl.concat(pred_dfm_list)
     dfm_preds_pl_df.write_csv("preds/dfm_pred_test.csv")
+    os.remove(partial_path)
+
+    # для прогноза по свежим данным нужны модели последнего окна: сервис
+    # дообновляет их новыми кварталами
+    ModelArtifactStore().save_manifest(
+        "dfm",
+        [
+            {"key": key, "cell": cell}
+            for cell, key in zip(cells, keys)
+            if forecasts_steps[-1] in cell[0]
+        ],
+    )
+
+    fcalls_by_mode = (
+        dfm_preds_pl_df.filter(pl.col("horizon") == 1)
+        .group_by("fit_mode")
+        .agg(pl.len().alias("fits"), pl.col("fcalls").sum())
+    )
+    for fit_mode, fits, fcalls in fcalls_by_mode.sort("fit_mode").iter_rows():
+        logger.info(
+            f"DFM {fit_mode} starts: {fits} fits, {fcalls} function evaluations"
+        )
 
+    fit_planner.log_summary("DFM cells")
     logger.info("All DFM models was fitted, prediction saved")
 
 
@@ -1,58 +1,96 @@
+import itertools
 import logging
 import os
 
 import polars as pl
 
 import config
+from models.artifact_store import ModelArtifactStore
 from models.gb import GB
-from preprocess_data.datae2e import DataE2E
+from pipelines.grid_executor import GridExecutor
+from preprocess_data.feature_store import FeatureStore
 
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
 
-def run_main_gb() -> None:
+def _fit_gb_cell(
+    cell: tuple, data: tuple, thread_count: int
+) -> tuple[pl.DataFrame, str]:
+    features_type, target, horizon, avaliability = cell
+    train, valid, train_valid, test, avail_features_full = data
+
+    params = {"iterations": config.START_ITERATIONS}
+
+    gb = GB(
+        features_type=features_type,
+        avaliability=avaliability,
+        target_name=target,
+        horizon=horizon,
+        avail_features_full=avail_features_full,
+        params=params,
+    )
+
+    def fit() -> GB:
+        gb.fit(
+            train,
+            valid,
+            early_stopping=config.EARLY_STOPPING_ROUNDS,
+            thread_count=thread_count,
+        )
+
+        gb.fit(train_valid, thread_count=thread_count)
+        return gb
+
+    # ключ считается до fit: fit меняет params
+    key = ModelArtifactStore.model_key(gb, train, valid, train_valid)
+    gb, loaded = ModelArtifactStore().get_or_fit(key, fit)
+
+    gb_pred = gb.predict(test)
+    logger.info(
+        f"Predict for {target},"
+        f" horizon {horizon} with avaliability {avaliability} was calculated,"
+        f" features: {features_type}"
+        f"{', model loaded from store' if loaded else ''}"
+    )
+
+    return gb_pred, key
+
+
+def run_main_gb(pooled_horizons: bool = False) -> None:
     logger.info("Start fitting GB models")
 
     horizon_grid = range(1, config.HORIZON + 1)
+    if pooled_horizons:
+        # одна модель на все горизонты, горизонт — признак
+        horizon_grid = [list(horizon_grid)]
     features_type_grid = ["rolling", "d12"]
     avaliability_grid = range(1, config.MAX_AVALIABILITY + 1)
     target_grid = ["gdp_log_d4", "cons_log_d4", "inv_log_d4", "inv_cap_log_d4"]
+    if config.MULTI_TARGET_GB:
+        # одна ячейка на все таргеты, прогноз раскладывается по таргетам
+        target_grid = [target_grid]
+
+    data = FeatureStore().get_matrix()
+
+    cells = list(
+        itertools.product(
+            features_type_grid, target_grid, horizon_grid, avaliability_grid
+        )
+    )
+    results = GridExecutor().map(_fit_gb_cell, cells, data)
 
-    train, valid, train_valid, test, avail_features_full = DataE2E().run()
-
-    gb_pred = []
-    for features_type in features_type_grid:
-        for target in target_grid:
-            for horizon in horizon_grid:
-                for avaliability in avaliability_grid:
-                    params = {
-                        "iterations": config.START_ITERATIONS,
-                    }
-
-                    gb = GB(
-                        features_type=features_type,
-                        avaliability=avaliability,
-                        target_name=target,
-                        horizon=horizon,
-                        avail_features_full=avail_features_full,
-                        params=params,
-                    )
-
-                    gb.fit(train, valid, early_stopping=config.EARLY_STOPPING_ROUNDS)
-
-                    gb.fit(train_valid)
-
-                    gb_pred.append(gb.predict(test))
-                    logger.info(
-                        f"Predict for {target},"
-                        f" horizon {horizon} with avaliability {avaliability} was calculated,"
-                        f" features: {features_type}"
-                    )
-
-    gb_pred_pl = pl.concat(gb_pred)
+    gb_pred_pl = pl.concat([gb_pred for gb_pred, _ in results])
     os.makedirs("preds", exist_ok=True)
-    gb_pred_pl.write_csv("preds/gb_pred_test.csv")
+    pred_path = (
+        "preds/gb_pooled_pred_test.csv" if pooled_horizons else "preds/gb_pred_test.csv"
+    )
+    gb_pred_pl.write_csv(pred_path)
+
+    ModelArtifactStore().save_manifest(
+        "gb_pooled" if pooled_horizons else "gb",
+        [{"key": key, "cell": cell} for cell, (_, key) in zip(cells, results)],
+    )
 
     logger.info("All GB models was fitted, prediction saved")
 
@@ -3,8 +3,9 @@ import os
 
 import polars as pl
 
+import config
 from metrics.metrics import MetricsCalculator
-from preprocess_data.datae2e import DataE2E
+from preprocess_data.feature_store import FeatureStore
 
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
@@ -18,7 +19,10 @@ def run_metrics(calculate_mfbvar: bool = True, calculate_dfm: bool = True) -> No
     if calculate_dfm:
         logger.info("DFM metrics calculation will be performed too")
 
-    train, valid, train_valid, test, avail_features_full = DataE2E().run()
+    # для метрик нужны только таргеты, месячные признаки не строим
+    train, valid, train_valid, test, avail_features_full = FeatureStore().get(
+        features_types=[]
+    )
 
     gb_pred_pl = pl.read_csv("preds/gb_pred_test.csv").with_columns(
         pl.col("date").cast(pl.Date)
@@ -34,6 +38,16 @@ def run_metrics(calculate_mfbvar: bool = True, calculate_dfm: bool = True) -> No
 
     preds_list = [gb_pred_pl, ngb_pred_pl, tabnet_pred_pl]
     ml_model_names = ["gb", "ngb", "tabnet"]
+    if config.POOLED_HORIZONS:
+        # модели на все горизонты сразу идут в таблицу рядом с моделями по
+        # горизонтам под именами gb_pooled, ngb_pooled, tabnet_pooled
+        for model_name in ["gb", "ngb", "tabnet"]:
+            preds_list.append(
+                pl.read_csv(f"preds/{model_name}_pooled_pred_test.csv")
+                .with_columns(pl.col("date").cast(pl.Date))
+                .rename({f"pred_{model_name}": f"pred_{model_name}_pooled"})
+            )
+            ml_model_names.append(f"{model_name}_pooled")
     target_names = ["gdp_log_d4", "cons_log_d4", "inv_log_d4", "inv_cap_log_d4"]
 
     metrics = MetricsCalculator(
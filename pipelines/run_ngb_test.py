@@ -1,61 +1,103 @@
+import itertools
 import logging
 import os
 
 import polars as pl
 
 import config
+from models.artifact_store import ModelArtifactStore
+from models.fit_planner import FitPlanner
 from models.ngb import NGB
-from preprocess_data.datae2e import DataE2E
+from pipelines.grid_executor import GridExecutor
+from preprocess_data.feature_store import FeatureStore
 
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
 
-def run_main_ngb() -> None:
+def _fit_ngb_cell(
+    cell: tuple, data: tuple, thread_count: int
+) -> tuple[pl.DataFrame, tuple[int, int], str]:
+    features_type, target, horizon, avaliability = cell
+    train, valid, train_valid, test, avail_features_full = data
+
+    params = {
+        "n_estimators": config.START_ITERATIONS_NGB,
+        "learning_rate": config.LEARNING_RATE_NGB,
+        "verbose": False,
+    }
+
+    ngb = NGB(
+        features_type=features_type,
+        avaliability=avaliability,
+        target_name=target,
+        horizon=horizon,
+        avail_features_full=avail_features_full,
+        params=params,
+    )
+
+    def fit() -> NGB:
+        ngb.fit(train, valid, early_stopping=config.EARLY_STOPPING_ROUNDS_NGB)
+        # финальная модель на train_valid уже обучена в fit(train, valid),
+        # планировщик NGB вернёт её без повторного обучения
+        ngb.fit(train_valid)
+        return ngb
+
+    # ключ считается до fit: fit меняет params
+    key = ModelArtifactStore.model_key(ngb, train, valid, train_valid)
+    ngb, loaded = ModelArtifactStore().get_or_fit(key, fit)
+
+    ngb_pred = ngb.predict(test)
+    logger.info(
+        f"Predict for {target},"
+        f" horizon {horizon} with avaliability {avaliability} was calculated,"
+        f" features: {features_type}"
+        f"{', model loaded from store' if loaded else ''}"
+    )
+
+    # счётчики обучений ячейки возвращаются вместе с прогнозом, так как
+    # воркер пула не разделяет состояние с основным процессом
+    return ngb_pred, (ngb.fit_planner.requested, ngb.fit_planner.reused), key
+
+
+def run_main_ngb(pooled_horizons: bool = False) -> None:
     logger.info("Start fitting NGB models")
 
     horizon_grid = range(1, config.HORIZON + 1)
+    if pooled_horizons:
+        # одна модель на все горизонты, горизонт — признак
+        horizon_grid = [list(horizon_grid)]
     features_type_grid = ["rolling", "d12"]
     avaliability_grid = range(1, config.MAX_AVALIABILITY + 1)
     target_grid = ["gdp_log_d4", "cons_log_d4", "inv_log_d4", "inv_cap_log_d4"]
 
-    train, valid, train_valid, test, avail_features_full = DataE2E().run()
-
-    ngb_pred = []
-    for features_type in features_type_grid:
-        for target in target_grid:
-            for horizon in horizon_grid:
-                for avaliability in avaliability_grid:
-                    params = {
-                        "n_estimators": config.START_ITERATIONS_NGB,
-                        "learning_rate": config.LEARNING_RATE_NGB,
-                        "verbose": False,
-                    }
-
-                    ngb = NGB(
-                        features_type=features_type,
-                        avaliability=avaliability,
-                        target_name=target,
-                        horizon=horizon,
-                        avail_features_full=avail_features_full,
-                        params=params,
-                    )
-
-                    ngb.fit(
-                        train, valid, early_stopping=config.EARLY_STOPPING_ROUNDS_NGB
-                    )
-                    ngb.fit(train_valid)
-
-                    ngb_pred.append(ngb.predict(test))
-                    logger.info(
-                        f"Predict for {target},"
-                        f" horizon {horizon} with avaliability {avaliability} was calculated,"
-                        f" features: {features_type}"
-                    )
-
-    ngb_pred_pl = pl.concat(ngb_pred)
+    data = FeatureStore().get_matrix()
+
+    cells = list(
+        itertools.product(
+            features_type_grid, target_grid, horizon_grid, avaliability_grid
+        )
+    )
+    results = GridExecutor().map(_fit_ngb_cell, cells, data)
+
+    fit_planner = FitPlanner()
+    for _, (requested, reused), _ in results:
+        fit_planner.add_counts(requested, reused)
+    fit_planner.log_summary("NGB final models")
+
+    ngb_pred_pl = pl.concat([ngb_pred for ngb_pred, _, _ in results])
     os.makedirs("preds", exist_ok=True)
-    ngb_pred_pl.write_csv("preds/ngb_pred_test.csv")
+    pred_path = (
+        "preds/ngb_pooled_pred_test.csv"
+        if pooled_horizons
+        else "preds/ngb_pred_test.csv"
+    )
+    ngb_pred_pl.write_csv(pred_path)
+
+    ModelArtifactStore().save_manifest(
+        "ngb_pooled" if pooled_horizons else "ngb",
+        [{"key": key, "cell": cell} for cell, (_, _, key) in zip(cells, results)],
+    )
 
     logger.info("All NGB models was fitted, prediction saved")
 
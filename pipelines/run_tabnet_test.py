@@ -1,26 +1,79 @@
+import itertools
 import logging
 import os
+from typing import Hashable
 
 import polars as pl
 
 import config
+from models.artifact_store import ModelArtifactStore
+from models.design import HorizonT
 from models.tabnet import TabNetModel
-from preprocess_data.datae2e import DataE2E
+from models.tabnet_pretraining import TabNetPretraining, group_horizons
+from pipelines.grid_executor import GridExecutor
+from preprocess_data.feature_store import FeatureStore
 
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
 
-def run_main_tabnet() -> None:
-    logger.info("Starting fitting tabnet")
+def _horizon_key(horizon: HorizonT) -> Hashable:
+    # список горизонтов общей модели — не ключ словаря
+    return horizon if isinstance(horizon, int) else tuple(horizon)
 
-    horizon_grid = range(1, config.HORIZON + 1)
-    features_type_grid = ["rolling", "d12"]
-    avaliability_grid = range(1, config.MAX_AVALIABILITY + 1)
-    target_grid = ["gdp_log_d4", "cons_log_d4", "inv_log_d4", "inv_cap_log_d4"]
 
-    train, valid, train_valid, test, avail_features_full = DataE2E().run()
+def _pretrain_tabnet_group(
+    cell: tuple, data: tuple, thread_count: int
+) -> TabNetPretraining:
+    features_type, avaliability, target_grid, horizon_grid = cell
+    train, valid, train_valid, test, avail_features_full = data
+
+    params = {
+        "batch_size": config.PRETRAIN_BATCH_SIZE_TABNET,
+        "virtual_batch_size": config.VIRTUAL_BATCH_SIZE_TABNET,
+        "learning_rate": config.LEARNING_RATE_TABNET,
+        "mask_type": config.MASK_TYPE_TABNET,
+        "pretraining_ratio": config.PRETRAINING_RATIO_TABNET,
+        "max_epochs": config.PRETRAIN_MAX_EPOCHS_TABNET,
+        "early_stopping_rounds": config.PRETRAIN_EARLY_STOPPING_ROUNDS_TABNET,
+    }
+
+    pretraining = TabNetPretraining(
+        features_type=features_type,
+        avaliability=avaliability,
+        target_grid=target_grid,
+        horizon_grid=horizon_grid,
+        avail_features_full=avail_features_full,
+        params=params,
+    )
+    # предобучение только на train: valid нужен ячейкам для ранней остановки
+    pretraining.key = ModelArtifactStore.pretraining_key(pretraining, train, valid)
+
+    def fit() -> TabNetPretraining:
+        pretraining.fit(train, valid)
+        return pretraining
+
+    pretraining, loaded = ModelArtifactStore().get_or_fit(pretraining.key, fit)
 
+    logger.info(
+        f"TabNet pretraining for horizons {horizon_grid}, "
+        f"availability {avaliability}, features: {features_type} "
+        f"{'loaded from store' if loaded else 'was fitted'}"
+    )
+
+    return pretraining
+
+
+def _fit_tabnet_cell(
+    cell: tuple, data: tuple, thread_count: int
+) -> tuple[pl.DataFrame, str]:
+    features_type, target, horizon, avaliability = cell
+    train, valid, train_valid, test, avail_features_full, pretrained = data
+
+    pretraining = pretrained.get((features_type, avaliability, _horizon_key(horizon)))
+
+    # свой словарь на ячейку: fit меняет max_epochs, и общий словарь
+    # делал бы результат зависимым от порядка перебора
     params = {
         "batch_size": config.BATCH_SIZE_TABNET,
         "virtual_batch_size": config.VIRTUAL_BATCH_SIZE_TABNET,
@@ -28,39 +81,119 @@ def run_main_tabnet() -> None:
         "lambda_sparse": config.LAMBDA_SPARSE_TABNET,
         "mask_type": config.MASK_TYPE_TABNET,
         "max_epochs": config.MAX_EPOCHS_TABNET,
-        "early_stopping_rounds": config.EARLY_STOPPING_ROUNDS_TABNET,
+        "early_stopping_rounds": (
+            config.EARLY_STOPPING_ROUNDS_TABNET
+            if pretraining is None
+            else config.FINETUNE_EARLY_STOPPING_ROUNDS_TABNET
+        ),
         "verbose": False,
     }
 
-    tabnet_pred = []
-    for features_type in features_type_grid:
-        for target in target_grid:
-            for horizon in horizon_grid:
-                for avaliability in avaliability_grid:
-
-                    tabnet = TabNetModel(
-                        features_type=features_type,
-                        avaliability=avaliability,
-                        target_name=target,
-                        horizon=horizon,
-                        avail_features_full=avail_features_full,
-                        params=params,
-                    )
-
-                    tabnet.fit(train, valid)
-                    tabnet.fit(train_valid)
-
-                    tabnet_pred.append(tabnet.predict(test))
+    tabnet = TabNetModel(
+        features_type=features_type,
+        avaliability=avaliability,
+        target_name=target,
+        horizon=horizon,
+        avail_features_full=avail_features_full,
+        params=params,
+        pretrained=pretraining,
+    )
+
+    def fit() -> TabNetModel:
+        tabnet.fit(train, valid)
+        tabnet.fit(train_valid)
+        return tabnet
+
+    # ключ считается до fit: fit меняет params
+    key = ModelArtifactStore.model_key(tabnet, train, valid, train_valid)
+    tabnet, loaded = ModelArtifactStore().get_or_fit(key, fit)
+
+    # модуль TorchScript называется по ключу модели: для переобученной модели
+    # пишется новый файл, для загруженной из хранилища он уже есть; удаляется
+    # хранилищем вместе с моделью
+    if config.EXPORT_TABNET_SCRIPT:
+        script_path = ModelArtifactStore.script_path(key)
+        if not os.path.exists(script_path):
+            os.makedirs(config.TABNET_SCRIPT_DIR, exist_ok=True)
+            tabnet.to_script().save(script_path)
+
+    tabnet_pred = tabnet.predict(test)
+
+    logger.info(
+        f"Predict for {target}, horizon {horizon}, "
+        f"availability {avaliability} calculated, "
+        f"features: {features_type}"
+        f"{', model loaded from store' if loaded else ''}, "
+        f"{tabnet.epochs_per_second:.1f} epochs/s"
+    )
+
+    return tabnet_pred, key
+
+
+def run_main_tabnet(pooled_horizons: bool = False) -> None:
+    logger.info("Starting fitting tabnet")
 
-                    logger.info(
-                        f"Predict for {target}, horizon {horizon}, "
-                        f"availability {avaliability} calculated, "
-                        f"features: {features_type}"
+    horizon_grid = range(1, config.HORIZON + 1)
+    if pooled_horizons:
+        # одна модель на все горизонты, горизонт — признак
+        horizon_grid = [list(horizon_grid)]
+    features_type_grid = ["rolling", "d12"]
+    avaliability_grid = range(1, config.MAX_AVALIABILITY + 1)
+    target_grid = ["gdp_log_d4", "cons_log_d4", "inv_log_d4", "inv_cap_log_d4"]
+    if config.MULTI_TARGET_TABNET:
+        # одна ячейка на все таргеты, прогноз раскладывается по таргетам
+        target_grid = [target_grid]
+
+    data = FeatureStore().get_matrix()
+
+    cells = list(
+        itertools.product(
+            features_type_grid, target_grid, horizon_grid, avaliability_grid
+        )
+    )
+
+    # предобучения групп считаются до сетки и передаются ячейкам вместе с данными
+    pretrained = {}
+    if config.PRETRAIN_TABNET:
+        train, valid, train_valid, test, avail_features_full = data
+        groups = [
+            (features_type, avaliability, target_grid, horizons)
+            for features_type, avaliability in itertools.product(
+                features_type_grid, avaliability_grid
+            )
+            for horizons in group_horizons(
+                train,
+                valid,
+                avail_features_full[features_type][avaliability],
+                target_grid,
+                horizon_grid,
+            )
+        ]
+        for pretraining in GridExecutor().map(_pretrain_tabnet_group, groups, data):
+            for horizon in pretraining.horizon_grid:
+                pretrained[
+                    (
+                        pretraining.features_type,
+                        pretraining.avaliability,
+                        _horizon_key(horizon),
                     )
+                ] = pretraining
+
+    results = GridExecutor().map(_fit_tabnet_cell, cells, (*data, pretrained))
 
-    tabnet_pred_pl = pl.concat(tabnet_pred)
+    tabnet_pred_pl = pl.concat([tabnet_pred for tabnet_pred, _ in results])
     os.makedirs("preds", exist_ok=True)
-    tabnet_pred_pl.write_csv("preds/tabnet_pred_test.csv")
+    pred_path = (
+        "preds/tabnet_pooled_pred_test.csv"
+        if pooled_horizons
+        else "preds/tabnet_pred_test.csv"
+    )
+    tabnet_pred_pl.write_csv(pred_path)
+
+    ModelArtifactStore().save_manifest(
+        "tabnet_pooled" if pooled_horizons else "tabnet",
+        [{"key": key, "cell": cell} for cell, (_, key) in zip(cells, results)],
+    )
 
     logger.info("All tabnets models was fitted, prediction saved")
 
@@ -0,0 +1,278 @@
+import logging
+from datetime import date
+from typing import Optional
+
+import attrs
+import numpy as np
+import polars as pl
+from dateutil.relativedelta import relativedelta
+from numpy.lib.stride_tricks import sliding_window_view
+
+import config
+from models.dfm import DFM
+from pipelines.nowcast_service import NowcastService, NowcastVintage
+from preprocess_data.feature_matrix import FeatureMatrix, ScenarioSplit
+
+logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+# шоки — строки (сценарий, месяц, сырой месячный ряд, значение); level —
+# значение ряда в месяце, relative — относительное изменение (0.1 — +10%)
+_SHOCK_COLUMNS = ["scenario", "datem", "column", "value"]
+_SHOCK_KINDS = ["level", "relative"]
+
+_SCENARIO_COLUMNS = [
+    "scenario",
+    "model",
+    "target_name",
+    "horizon",
+    "date",
+    "features_type",
+    "avaliability",
+    "pred",
+    "pred_base",
+    "avaliability_observed",
+]
+
+
+def _scenario_months(anchor: date) -> list[date]:
+    # признаки квартала anchor зависят от его трёх месяцев и от окна d12 и
+    # самого длинного скользящего среднего перед ними
+    lookback_months = 12 + max(config.ROLLING_WINDOWS_MONTH) - 1
+
+    return [
+        anchor + relativedelta(months=month) for month in range(-lookback_months, 3)
+    ]
+
+
+def _month_number(month: pl.Expr) -> pl.Expr:
+    return month.dt.year().cast(pl.Int32) * 12 + month.dt.month().cast(pl.Int32)
+
+
+def _apply_shocks(
+    base_paths: np.ndarray, shocks: pl.DataFrame, n_scenarios: int, kind: str
+) -> np.ndarray:
+    # пути рядов (сценарий, месяц, ряд); нулевой сценарий — без шоков
+    paths = np.tile(base_paths, (n_scenarios + 1, 1, 1))
+    index = tuple(
+        shocks[column].to_numpy()
+        for column in ["scenario_index", "month_index", "column_index"]
+    )
+    values = shocks["value"].to_numpy()
+
+    if kind == "level":
+        paths[index] = values
+    else:
+        np.multiply.at(paths, index, 1 + values)
+
+    return paths
+
+
+def _monthly_features(
+    paths: np.ndarray, log_columns: np.ndarray
+) -> dict[str, np.ndarray]:
+    # те же d12 и скользящие средние d12, что у FeaturesService, но по оси
+    # месяцев сразу для всех сценариев; на выходе — три месяца квартала anchor
+    with np.errstate(divide="ignore", invalid="ignore"):
+        levels = np.where(log_columns, np.log(paths), paths)
+    d12 = levels[:, 12:] - levels[:, :-12]
+
+    features = {"": d12[:, -3:]}
+    for roll_window in config.ROLLING_WINDOWS_MONTH:
+        features[f"_roll_mean_{roll_window}"] = sliding_window_view(
+            d12, roll_window, axis=1
+        )[:, -3:].mean(axis=-1)
+
+    return features
+
+
+def _d12_column(matrix: FeatureMatrix, column: str) -> str:
+    # лог-разность или разность — как решил FeaturesService по истории ряда
+    for d12_column in (column + "_log_d12", column + "_d12"):
+        if d12_column + "_m1" in matrix.column_index:
+            return d12_column
+
+    raise ValueError(f"Column {column} is not a monthly feature series")
+
+
+def _scenario_split(
+    vintage: NowcastVintage,
+    shocks: pl.DataFrame,
+    columns: list[str],
+    n_scenarios: int,
+    kind: str,
+) -> ScenarioSplit:
+    matrix = vintage.split.matrix
+    row = matrix.pad + vintage.split.start
+    values = np.tile(matrix.values[row], (n_scenarios + 1, 1))
+    targets = [matrix.column_index[target] for target in vintage.targets]
+    values[:, targets] = matrix.values[row - 1, targets]
+
+    if columns:
+        months = pl.DataFrame({"datem": _scenario_months(vintage.anchor)})
+        base_paths = (
+            months.join(
+                vintage.monthly_data_raw.select("datem", *columns),
+                on="datem",
+                how="left",
+            )
+            .sort("datem")
+            .select(pl.col(columns).cast(pl.Float64))
+            .to_numpy()
+        )
+        d12_columns = [_d12_column(matrix, column) for column in columns]
+        features = _monthly_features(
+            _apply_shocks(base_paths, shocks, n_scenarios, kind),
+            np.array([column.endswith("_log_d12") for column in d12_columns]),
+        )
+
+        for index, d12_column in enumerate(d12_columns):
+            for suffix, feature in features.items():
+                for month in range(1, 4):
+                    values[
+                        :, matrix.column_index[f"{d12_column}{suffix}_m{month}"]
+                    ] = feature[:, month - 1, index]
+
+    # строки отдаются моделям без копирования, как у FeatureMatrix
+    values.flags.writeable = False
+
+    return ScenarioSplit(
+        FeatureMatrix(
+            values=values,
+            dates=[vintage.anchor] * len(values),
+            column_index=matrix.column_index,
+            pad=0,
+        ),
+        0,
+        len(values),
+    )
+
+
+# Прогнозы с anchor при шоках сырых месячных рядов (пути Brent, NEER, ставки
+# и т.п.): шоки проходят через d12, скользящие средние и разбиение по месяцам
+# квартала массивами сразу для всех сценариев, и каждая модель прогнозирует
+# все сценарии одним вызовом predict. Прогноз DFM — фильтр Калмана по всему
+# окну, а не построчный predict, поэтому DFM в сценариях не участвует
+@attrs.define(slots=True)
+class ScenarioService:
+    nowcast_service: NowcastService = attrs.field(factory=NowcastService)
+
+    def _prepare_shocks(
+        self, shocks: pl.DataFrame, vintage: NowcastVintage, scenarios: pl.Series
+    ) -> tuple[pl.DataFrame, list[str]]:
+        months = _scenario_months(vintage.anchor)
+        shocks = shocks.with_columns(pl.col("datem").cast(pl.Date).dt.truncate("1mo"))
+
+        # шоки вне окна не меняют признаков квартала anchor
+        in_window = shocks.filter(pl.col("datem").is_between(months[0], months[-1]))
+        if in_window.height < shocks.height:
+            logger.info(
+                f"{shocks.height - in_window.height} shocks are outside"
+                f" {months[0]} - {months[-1]} and don't affect the nowcast"
+            )
+
+        columns = in_window["column"].unique(maintain_order=True).to_list()
+        unknown = set(columns) - set(vintage.monthly_data_raw.columns) - {"datem"}
+        if unknown or "datem" in columns:
+            raise ValueError(f"Unknown monthly columns in shocks: {sorted(unknown)}")
+
+        shocks = in_window.select(
+            pl.col("scenario")
+            .replace_strict(scenarios, range(1, len(scenarios) + 1))
+            .alias("scenario_index"),
+            (
+                _month_number(pl.col("datem"))
+                - _month_number(pl.lit(months[0], pl.Date))
+            ).alias("month_index"),
+            pl.col("column")
+            .replace_strict(columns, range(len(columns)))
+            .alias("column_index"),
+            pl.col("value").cast(pl.Float64),
+        )
+
+        return shocks, columns
+
+    def run(
+        self,
+        shocks: pl.DataFrame,
+        kind: str = "level",
+        monthly_data_raw: Optional[pl.DataFrame] = None,
+        quarterly_data_raw: Optional[pl.DataFrame] = None,
+    ) -> pl.DataFrame:
+        if kind not in _SHOCK_KINDS:
+            raise ValueError("kind must be 'level' or 'relative'")
+        missing = set(_SHOCK_COLUMNS) - set(shocks.columns)
+        if missing:
+            raise ValueError(f"Shocks must have columns {_SHOCK_COLUMNS}")
+
+        service = self.nowcast_service
+        if service.models is None:
+            service.load_models()
+        vintage = service.get_vintage(monthly_data_raw, quarterly_data_raw)
+
+        # сценарий без шоков в окне всё равно есть в ответе, с базовым прогнозом
+        scenarios = shocks["scenario"].unique(maintain_order=True)
+        shocks, columns = self._prepare_shocks(shocks, vintage, scenarios)
+        split = _scenario_split(vintage, shocks, columns, len(scenarios), kind)
+
+        frames = []
+        for name, entries in service.models.items():
+            for _, _, model in entries:
+                if isinstance(model, DFM):
+                    continue
+
+                # строка 0 каждого таргета и горизонта — прогноз без шоков
+                frames.append(
+                    model.predict(split)
+                    .select(
+                        pl.lit(name).alias("model"),
+                        "target_name",
+                        pl.col("horizon").cast(pl.Int32),
+                        "features_type",
+                        pl.col("avaliability").cast(pl.Int32),
+                        pl.col("^pred_.*$").cast(pl.Float64).alias("pred"),
+                    )
+                    .with_columns(
+                        pl.int_range(pl.len())
+                        .over("target_name", "horizon")
+                        .alias("scenario_index"),
+                        pl.col("pred")
+                        .first()
+                        .over("target_name", "horizon")
+                        .alias("pred_base"),
+                    )
+                    .filter(pl.col("scenario_index") > 0)
+                )
+
+        if not frames:
+            raise ValueError("No fitted models in store manifests, run the grids first")
+
+        horizons = range(1, config.HORIZON + 1)
+        result = (
+            pl.concat(frames)
+            .with_columns(
+                pl.col("scenario_index")
+                .replace_strict(range(1, len(scenarios) + 1), scenarios)
+                .alias("scenario"),
+                pl.col("horizon")
+                .replace_strict(
+                    horizons,
+                    [
+                        vintage.anchor + relativedelta(months=3 * (horizon - 1))
+                        for horizon in horizons
+                    ],
+                    return_dtype=pl.Date,
+                )
+                .alias("date"),
+                (pl.col("avaliability") <= vintage.months_observed).alias(
+                    "avaliability_observed"
+                ),
+            )
+            .select(_SCENARIO_COLUMNS)
+        )
+        logger.info(
+            f"{len(scenarios)} scenarios from {vintage.anchor} were scored by"
+            f" {len(frames)} models: {result.height} forecasts"
+        )
+
+        return result
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import xml.etree.ElementTree as ET
+import zipfile
+from typing import Callable, Optional
+
+import attrs
+import polars as pl
+
+import config
+from preprocess_data.gigadata_parser import parse_giga_sheets
+
+logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+# версия формата кэша, менять при изменении логики парсинга
+CACHE_VERSION = "1"
+# движки парсера giga-книги расходятся в последних знаках (~1e-10), поэтому
+# движок входит в ключи её листов; остальные файлы читаются без него
+_GIGA_KEY_SEED = f"{CACHE_VERSION}_{config.GIGA_PARSER_ENGINE}".encode()
+
+_XLSX_MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_XLSX_REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_XLSX_PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+_SHARED_STRING_CELL = re.compile(rb'<c\b[^>]*\bt="s"[^>]*>\s*<v>(\d+)</v>')
+
+
+# Кэш распарсенных сырых данных в parquet, ключ — хэш и размер файла.
+# Для giga-книги ключ считается по каждому листу (xml листа плюс используемые им
+# строки из sharedStrings), поэтому правка одного листа перепарсивает только его.
+@attrs.define(slots=True)
+class RawDataCache:
+
+    cache_dir: str = config.RAW_CACHE_DIR
+    enabled: bool = config.USE_RAW_CACHE
+
+    @staticmethod
+    def file_key(path: str) -> str:
+        digest = hashlib.sha256(CACHE_VERSION.encode())
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        return f"{digest.hexdigest()[:32]}_{os.path.getsize(path)}"
+
+    @staticmethod
+    def _sheet_paths(workbook: zipfile.ZipFile) -> list[tuple[str, str]]:
+        rels = ET.fromstring(workbook.read("xl/_rels/workbook.xml.rels"))
+        targets = {
+            rel.get("Id"): rel.get("Target")
+            for rel in rels.iter(f"{_XLSX_PKG_REL_NS}Relationship")
+        }
+
+        book = ET.fromstring(workbook.read("xl/workbook.xml"))
+        sheet_paths = []
+        for sheet in book.iter(f"{_XLSX_MAIN_NS}sheet"):
+            target = targets[sheet.get(f"{_XLSX_REL_NS}id")].lstrip("/")
+            if not target.startswith("xl/"):
+                target = "xl/" + target
+            sheet_paths.append((sheet.get("name"), target))
+
+        return sheet_paths
+
+    @staticmethod
+    def _shared_strings(workbook: zipfile.ZipFile) -> list[str]:
+        if "xl/sharedStrings.xml" not in workbook.namelist():
+            return []
+
+        root = ET.fromstring(workbook.read("xl/sharedStrings.xml"))
+        return [
+            "".join(node.text or "" for node in item.iter(f"{_XLSX_MAIN_NS}t"))
+            for item in root.iter(f"{_XLSX_MAIN_NS}si")
+        ]
+
+    def sheet_keys(self, path: str) -> list[tuple[str, str]]:
+        with zipfile.ZipFile(path) as workbook:
+            shared_strings = self._shared_strings(workbook)
+
+            keys = []
+            for sheet_name, sheet_path in self._sheet_paths(workbook):
+                sheet_xml = workbook.read(sheet_path)
+
+                digest = hashlib.sha256(_GIGA_KEY_SEED)
+                digest.update(sheet_xml)
+                for index in _SHARED_STRING_CELL.findall(sheet_xml):
+                    digest.update(shared_strings[int(index)].encode())
+                    digest.update(b"\x00")
+
+                keys.append((sheet_name, f"{digest.hexdigest()[:32]}_{len(sheet_xml)}"))
+
+        return keys
+
+    def _frame_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.parquet")
+
+    def _load(self, key: str) -> Optional[pl.DataFrame]:
+        frame_path = self._frame_path(key)
+        if not os.path.exists(frame_path):
+            return None
+        return pl.read_parquet(frame_path)
+
+    def _save(self, key: str, frame: pl.DataFrame) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # пишем во временный файл, чтобы не оставить битый parquet
+        tmp_path = self._frame_path(key) + ".tmp"
+        frame.write_parquet(tmp_path)
+        os.replace(tmp_path, self._frame_path(key))
+
+    def read_excel(
+        self, path: str, reader: Callable[[str], pl.DataFrame] = pl.read_excel
+    ) -> pl.DataFrame:
+        if not self.enabled:
+            return reader(path)
+
+        key = self.file_key(path)
+        frame = self._load(key)
+        if frame is None:
+            frame = reader(path)
+            self._save(key, frame)
+            logger.info(f"{path} was parsed and cached")
+
+        return frame
+
+    def _load_manifest(self, manifest_path: str) -> Optional[list[pl.DataFrame]]:
+        # пустой, битый или ссылающийся на удалённые листы манифест — промах
+        if not os.path.exists(manifest_path):
+            return None
+        try:
+            with open(manifest_path) as file:
+                cached_keys = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if (
+            not isinstance(cached_keys, list)
+            or not cached_keys
+            or not all(isinstance(key, str) for key in cached_keys)
+        ):
+            return None
+
+        frames = [self._load(key) for key in cached_keys]
+        if any(frame is None for frame in frames):
+            return None
+
+        return frames
+
+    def read_giga_sheets(self, path: str) -> list[pl.DataFrame]:
+        # манифест книги: при неизменном файле не открываем xlsx вообще;
+        # ключи листов зависят от движка, поэтому манифест у каждого свой
+        if self.enabled:
+            manifest_path = os.path.join(
+                self.cache_dir,
+                f"{self.file_key(path)}_{config.GIGA_PARSER_ENGINE}.json",
+            )
+            frames = self._load_manifest(manifest_path)
+            if frames is not None:
+                return frames
+
+        sheet_keys = self.sheet_keys(path)
+        cached = {
+            sheet_name: self._load(key) if self.enabled else None
+            for sheet_name, key in sheet_keys
+        }
+
+        # все изменившиеся листы парсим одним вызовом
+        reparsed_sheets = [
+            sheet_name for sheet_name, frame in cached.items() if frame is None
+        ]
+        parsed = parse_giga_sheets(path, reparsed_sheets) if reparsed_sheets else {}
+
+        frames = []
+        parsed_keys = []
+        for sheet_name, key in sheet_keys:
+            frame = cached[sheet_name]
+            if frame is None:
+                frame = parsed[sheet_name]
+                if frame is None:
+                    continue
+                if self.enabled:
+                    self._save(key, frame)
+
+            frames.append(frame)
+            parsed_keys.append(key)
+
+        if self.enabled:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            if parsed_keys:
+                tmp_path = manifest_path + ".tmp"
+                with open(tmp_path, "w") as file:
+                    json.dump(parsed_keys, file)
+                os.replace(tmp_path, manifest_path)
+            logger.info(f"{path}: parsed sheets {reparsed_sheets}, others from cache")
+
+        return frames
@@ -1,19 +1,49 @@
+import logging
+from typing import Optional
+
 import attrs
 import polars as pl
+from polars.testing import assert_frame_equal
 
+import config
+from preprocess_data.feature_matrix import FeatureMatrix, FeatureMatrixSplit
 from preprocess_data.lags_service import LagsService
 from preprocess_data.montlhy_to_quarterly import MonthlyToQuarterlyService
-from preprocess_data.prepare_data import FeaturesService
+from preprocess_data.prepare_data import FeaturesService, FrameT
 from preprocess_data.splitter_service import TrainValTestSplit
 
+logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
 
 @attrs.define(slots=True)
 class DataE2E:
     @staticmethod
-    def run() -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame, pl.DataFrame, dict]:
+    def _select_features_types(
+        features: FrameT, avail_features_full: dict, features_types: list[str]
+    ) -> tuple[FrameT, dict]:
+        unused_columns = [
+            column
+            for features_type, avail_features in avail_features_full.items()
+            if features_type not in features_types
+            for columns in avail_features.values()
+            for column in columns
+        ]
+        avail_features_selected = {
+            features_type: avail_features
+            for features_type, avail_features in avail_features_full.items()
+            if features_type in features_types
+        }
+
+        return features.drop(unused_columns), avail_features_selected
+
+    @staticmethod
+    def _get_features_without_lags(
+        lazy: bool, features_types: Optional[list[str]]
+    ) -> tuple[FrameT, dict, list[str]]:
 
         features_service = FeaturesService()
-        monthly_data, quarterly_data = features_service.get_features()
+        monthly_data, quarterly_data = features_service.get_features(lazy=lazy)
 
         columns_d12 = features_service.columns_d12
         columns_rolling = features_service.columns_rolling
@@ -24,11 +54,173 @@ class DataE2E:
 
         avail_features_full = mtoq_service.avail_features_full
 
+        # лишние типы признаков убираем до лагов: в ленивом режиме
+        # polars тогда вообще не строит эти колонки
+        if features_types is not None:
+            features, avail_features_full = DataE2E._select_features_types(
+                features, avail_features_full, features_types
+            )
+
+        return features, avail_features_full, columns_d4
+
+    @staticmethod
+    def run(
+        lazy: bool = config.LAZY_PREPROCESSING,
+        features_types: Optional[list[str]] = None,
+    ) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame, pl.DataFrame, dict]:
+
+        features, avail_features_full, columns_d4 = DataE2E._get_features_without_lags(
+            lazy, features_types
+        )
+
         lags_service = LagsService(features)
         features = lags_service.get_lags(columns_d4, avail_features_full)
 
+        if lazy:
+            features = features.collect(engine=config.POLARS_ENGINE)
+
+        splitter_service = TrainValTestSplit(features)
+        train, valid, test = splitter_service.split()
+        train_valid = pl.concat([train, valid])
+
+        return (train, valid, train_valid, test, avail_features_full)
+
+    @staticmethod
+    def _split_matrix(matrix: FeatureMatrix, dates: pl.DataFrame) -> FeatureMatrixSplit:
+        if dates.is_empty():
+            return FeatureMatrixSplit(matrix, 0, 0)
+
+        return matrix.split(dates["date"].min(), dates["date"].max())
+
+    @staticmethod
+    def run_matrix(
+        lazy: bool = config.LAZY_PREPROCESSING,
+        features_types: Optional[list[str]] = None,
+    ) -> tuple[
+        FeatureMatrixSplit,
+        FeatureMatrixSplit,
+        FeatureMatrixSplit,
+        FeatureMatrixSplit,
+        dict,
+    ]:
+        # то же, что run, но лаги не материализуются: выборки — это
+        # диапазоны строк одной FeatureMatrix, включая историю до START_YEAR
+        features, avail_features_full, columns_d4 = DataE2E._get_features_without_lags(
+            lazy, features_types
+        )
+
+        if lazy:
+            features = features.collect(engine=config.POLARS_ENGINE)
+
+        matrix = FeatureMatrix.from_features(features, avail_features_full, columns_d4)
+
+        splitter_service = TrainValTestSplit(features.select("date"))
+        train, valid, test = [
+            DataE2E._split_matrix(matrix, dates) for dates in splitter_service.split()
+        ]
+        train_valid = train if valid.is_empty() else train.concat(valid)
+
+        return (train, valid, train_valid, test, avail_features_full)
+
+    @staticmethod
+    def _same_history(
+        data_prev: pl.DataFrame, data: pl.DataFrame, date_col: str, start_date
+    ) -> bool:
+        if data_prev.columns != data.columns:
+            return False
+
+        return data_prev.filter(pl.col(date_col) < start_date).equals(
+            data.filter(pl.col(date_col) < start_date)
+        )
+
+    @staticmethod
+    def run_incremental(
+        features_prev: pl.DataFrame,
+        monthly_data_raw_prev: pl.DataFrame,
+        quarterly_data_raw_prev: pl.DataFrame,
+        features_types: Optional[list[str]] = None,
+        verify: bool = False,
+    ) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame, pl.DataFrame, dict]:
+        # features_prev — склеенные train/valid/test прошлого запуска,
+        # *_raw_prev — сырые данные, из которых они были посчитаны
+
+        features_service = FeaturesService()
+        monthly_data_raw, quarterly_data_raw = features_service.get_raw_data()
+
+        # пересчитываем последний квартал прошлого запуска и всё, что после него
+        start_date = features_prev["date"].max()
+
+        # если история до start_date пересмотрена, дообновление некорректно
+        if not (
+            DataE2E._same_history(
+                monthly_data_raw_prev, monthly_data_raw, "datem", start_date
+            )
+            and DataE2E._same_history(
+                quarterly_data_raw_prev, quarterly_data_raw, "dateq", start_date
+            )
+        ):
+            logger.info("Raw history was revised, features are rebuilt from scratch")
+            return DataE2E.run(features_types=features_types)
+
+        monthly_data, quarterly_data = features_service.get_features_from_raw(
+            monthly_data_raw, quarterly_data_raw, start_date=start_date
+        )
+
+        columns_d4 = features_service.columns_d4
+
+        mtoq_service = MonthlyToQuarterlyService(
+            features_service.columns_d12, features_service.columns_rolling
+        )
+        features_tail = mtoq_service.run_transorm(monthly_data, quarterly_data)
+
+        avail_features_full = mtoq_service.avail_features_full
+
+        if features_types is not None:
+            features_tail, avail_features_full = DataE2E._select_features_types(
+                features_tail, avail_features_full, features_types
+            )
+
+        history = features_prev.filter(pl.col("date") < start_date)
+
+        lags_service = LagsService(features_tail)
+        features_tail = lags_service.get_lags_tail(
+            history, columns_d4, avail_features_full
+        )
+
+        # новые значения могли поменять набор признаков (например, лог-колонки)
+        if set(features_tail.columns) != set(features_prev.columns):
+            logger.info("Feature set has changed, features are rebuilt from scratch")
+            return DataE2E.run(features_types=features_types)
+
+        features = pl.concat(
+            [history, features_tail.select(features_prev.columns)],
+            how="vertical_relaxed",
+        )
+
         splitter_service = TrainValTestSplit(features)
         train, valid, test = splitter_service.split()
         train_valid = pl.concat([train, valid])
 
+        logger.info(
+            f"Features were updated incrementally, {features_tail.height} rows recomputed"
+        )
+
+        if verify:
+            train_full, valid_full, _, test_full, _ = DataE2E.run(
+                features_types=features_types
+            )
+            for split, split_full in zip(
+                [train, valid, test], [train_full, valid_full, test_full]
+            ):
+                try:
+                    assert_frame_equal(
+                        split, split_full.select(split.columns), check_dtypes=False
+                    )
+                except AssertionError as e:
+                    raise ValueError(
+                        f"Incremental features differ from full rebuild: {e}"
+                    )
+
+            logger.info("Incremental features match full rebuild")
+
         return (train, valid, train_valid, test, avail_features_full)
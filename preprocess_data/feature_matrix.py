@@ -0,0 +1,119 @@
+from datetime import date
+
+import attrs
+import numpy as np
+import polars as pl
+
+import config
+
+
+# Признаки без материализованных лагов: каждая базовая колонка хранится один
+# раз в float32-массиве, а лаг h — это та же колонка со сдвигом строк на h.
+# Сверху массив дополнен pad строками NaN, как у shift в polars.
+@attrs.define(slots=True)
+class FeatureMatrix:
+    values: np.ndarray
+    dates: list[date]
+    column_index: dict[str, int]
+    pad: int = config.HORIZON
+
+    @classmethod
+    def from_features(
+        cls, features: pl.DataFrame, avail_features_full: dict, columns_d4: list[str]
+    ) -> "FeatureMatrix":
+        # колонки одного типа и доступности идут подряд, поэтому блок
+        # признаков модели — это срез массива, а не выборка по индексам
+        base_columns = [
+            column
+            for avail_features in avail_features_full.values()
+            for avaliability in sorted(avail_features)
+            for column in avail_features[avaliability]
+        ] + columns_d4
+
+        pad = config.HORIZON
+        values = np.full((pad + features.height, len(base_columns)), np.nan, "float32")
+        values[pad:] = features.select(pl.col(base_columns).cast(pl.Float32)).to_numpy()
+        # срезы отдаются моделям без копирования, поэтому массив только на чтение
+        values.flags.writeable = False
+
+        return cls(
+            values=values,
+            dates=features["date"].to_list(),
+            column_index={column: index for index, column in enumerate(base_columns)},
+            pad=pad,
+        )
+
+    def split(self, start_date: date, end_date: date) -> "FeatureMatrixSplit":
+        dates = np.array(self.dates, dtype="datetime64[D]")
+        start = int(np.searchsorted(dates, np.datetime64(start_date, "D")))
+        end = int(np.searchsorted(dates, np.datetime64(end_date, "D"), side="right"))
+
+        return FeatureMatrixSplit(self, start, end)
+
+
+@attrs.define(slots=True)
+class FeatureMatrixSplit:
+    matrix: FeatureMatrix
+    start: int
+    end: int
+
+    @property
+    def height(self) -> int:
+        return self.end - self.start
+
+    def is_empty(self) -> bool:
+        return self.height == 0
+
+    def dates(self) -> pl.DataFrame:
+        return pl.DataFrame(
+            {"date": self.matrix.dates[self.start : self.end]},
+            schema={"date": pl.Date},
+        )
+
+    def concat(self, other: "FeatureMatrixSplit") -> "FeatureMatrixSplit":
+        if self.matrix is not other.matrix or self.end != other.start:
+            raise ValueError("Only adjacent splits of one matrix can be concatenated")
+
+        return FeatureMatrixSplit(self.matrix, self.start, other.end)
+
+    def _rows(self, lag: int) -> slice:
+        if not 0 <= lag <= self.matrix.pad:
+            raise ValueError(f"Invalid lag: {lag}, must be in [0, {self.matrix.pad}]")
+
+        return slice(
+            self.matrix.pad + self.start - lag, self.matrix.pad + self.end - lag
+        )
+
+    def lagged(self, columns: list[str], lag: int = 0) -> np.ndarray:
+        indices = [self.matrix.column_index[column] for column in columns]
+        first_index = indices[0]
+
+        # подряд идущие колонки отдаём срезом без копирования
+        if indices == list(range(first_index, first_index + len(indices))):
+            return self.matrix.values[
+                self._rows(lag), first_index : first_index + len(indices)
+            ]
+
+        return self.matrix.values[self._rows(lag)][:, indices]
+
+    def get_column(self, column: str, lag: int = 0) -> np.ndarray:
+        return self.matrix.values[self._rows(lag), self.matrix.column_index[column]]
+
+
+# Строки — сценарии прогноза с одного квартала anchor: признаки строки — это
+# признаки anchor, а в колонках таргетов — их значения за квартал до anchor.
+# Лаг здесь не сдвигает строки, поэтому дизайн горизонта h (признаки с лагом
+# h - 1, таргет с лагом h) для каждой строки — дизайн прогноза с anchor
+@attrs.define(slots=True)
+class ScenarioSplit(FeatureMatrixSplit):
+    def _rows(self, lag: int) -> slice:
+        if not 0 <= lag <= config.HORIZON:
+            raise ValueError(f"Invalid lag: {lag}, must be in [0, {config.HORIZON}]")
+
+        return slice(self.matrix.pad + self.start, self.matrix.pad + self.end)
+
+    def dates(self) -> pl.DataFrame:
+        # у всех строк одна дата — anchor
+        return pl.select(
+            pl.repeat(self.matrix.dates[0], self.height, dtype=pl.Date).alias("date")
+        )
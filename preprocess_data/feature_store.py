@@ -0,0 +1,229 @@
+import copy
+import glob
+import hashlib
+import json
+import logging
+import os
+from typing import Optional
+
+import attrs
+import polars as pl
+
+import config
+from preprocess_data.cache_service import RawDataCache
+from preprocess_data.datae2e import DataE2E
+from preprocess_data.feature_matrix import FeatureMatrixSplit
+from preprocess_data.prepare_data import FeaturesService
+
+logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+# версия формата хранилища, менять при несовместимых изменениях
+STORE_VERSION = "1"
+
+# константы config, от которых зависит результат DataE2E
+_CONFIG_FINGERPRINT_KEYS = [
+    "HORIZON",
+    "VALID_LEN",
+    "TEST_LEN",
+    "ROLLING_WINDOWS_MONTH",
+    "START_YEAR",
+    "GIGA_PARSER_ENGINE",
+]
+
+_INPUT_PATHS = [
+    config.GIGA_DATA_PATH,
+    config.FRED_DATA_PATH,
+    config.CBR_DATA_PATH,
+    config.QUARTERLY_DATA_PATH,
+]
+
+# исходники, меняющие признаки: правка кода тоже сбрасывает хранилище
+_SOURCE_PATTERNS = ["preprocess_data/*.py", "eng_ru_names_dict.py"]
+
+_in_process_store: dict[str, tuple] = {}
+
+
+# Общее хранилище результата DataE2E: в памяти процесса и на диске, ключ —
+# хэш входных файлов, констант config и кода препроцессинга.
+@attrs.define(slots=True)
+class FeatureStore:
+    store_dir: str = config.FEATURE_STORE_DIR
+    enabled: bool = config.USE_FEATURE_STORE
+
+    @staticmethod
+    def fingerprint(
+        features_types: Optional[list[str]] = None, with_inputs: bool = True
+    ) -> str:
+        digest = hashlib.sha256(STORE_VERSION.encode())
+
+        if with_inputs:
+            for path in _INPUT_PATHS:
+                digest.update(RawDataCache.file_key(path).encode())
+
+        for key in _CONFIG_FINGERPRINT_KEYS:
+            digest.update(f"{key}={getattr(config, key)!r};".encode())
+
+        for pattern in _SOURCE_PATTERNS:
+            for path in sorted(glob.glob(pattern)):
+                with open(path, "rb") as file:
+                    digest.update(file.read())
+
+        digest.update(json.dumps(features_types).encode())
+
+        return digest.hexdigest()[:32]
+
+    def _load(self, key: str) -> Optional[tuple]:
+        key_dir = os.path.join(self.store_dir, key)
+        if not os.path.exists(os.path.join(key_dir, "avail_features_full.json")):
+            return None
+
+        train, valid, test = [
+            pl.read_parquet(os.path.join(key_dir, f"{split}.parquet"))
+            for split in ["train", "valid", "test"]
+        ]
+        with open(os.path.join(key_dir, "avail_features_full.json")) as file:
+            avail_features_full = {
+                features_type: {int(avail): cols for avail, cols in avail.items()}
+                for features_type, avail in json.load(file).items()
+            }
+
+        return (train, valid, pl.concat([train, valid]), test, avail_features_full)
+
+    def _save(self, key: str, base_key: str, data: tuple) -> None:
+        train, valid, _, test, avail_features_full = data
+
+        key_dir = os.path.join(self.store_dir, key)
+        os.makedirs(key_dir, exist_ok=True)
+        for split, frame in zip(["train", "valid", "test"], [train, valid, test]):
+            frame.write_parquet(os.path.join(key_dir, f"{split}.parquet"))
+
+        # сырые данные нужны следующему запуску для дообновления признаков
+        monthly_data_raw, quarterly_data_raw = FeaturesService().get_raw_data()
+        monthly_data_raw.write_parquet(os.path.join(key_dir, "monthly_raw.parquet"))
+        quarterly_data_raw.write_parquet(os.path.join(key_dir, "quarterly_raw.parquet"))
+
+        # json пишется последним и служит признаком полной записи
+        with open(os.path.join(key_dir, "avail_features_full.json"), "w") as file:
+            json.dump(avail_features_full, file)
+
+        with open(os.path.join(self.store_dir, f"latest_{base_key}.txt"), "w") as file:
+            file.write(key)
+
+    def _update_latest(
+        self, base_key: str, features_types: Optional[list[str]]
+    ) -> Optional[tuple]:
+        latest_path = os.path.join(self.store_dir, f"latest_{base_key}.txt")
+        if not os.path.exists(latest_path):
+            return None
+
+        with open(latest_path) as file:
+            prev_key = file.read().strip()
+
+        prev_data = self._load(prev_key)
+        if prev_data is None:
+            return None
+
+        train, valid, _, test, _ = prev_data
+        return DataE2E.run_incremental(
+            pl.concat([train, valid, test]),
+            pl.read_parquet(
+                os.path.join(self.store_dir, prev_key, "monthly_raw.parquet")
+            ),
+            pl.read_parquet(
+                os.path.join(self.store_dir, prev_key, "quarterly_raw.parquet")
+            ),
+            features_types=features_types,
+            verify=config.VERIFY_INCREMENTAL_FEATURES,
+        )
+
+    @staticmethod
+    def _project(data: tuple, features_types: Optional[list[str]]) -> tuple:
+        # из полного набора убираются колонки лишних типов признаков вместе с
+        # их лагами; порядок остальных колонок тот же, что у DataE2E.run
+        train, valid, train_valid, test, avail_features_full = data
+        if features_types is None:
+            return data
+
+        unused_columns = {
+            column
+            for features_type, avail_features in avail_features_full.items()
+            if features_type not in features_types
+            for columns in avail_features.values()
+            for column in columns
+        }
+        unused_columns |= {
+            f"{column}_lag{lag}"
+            for column in list(unused_columns)
+            for lag in range(1, config.HORIZON)
+        }
+        avail_features_selected = {
+            features_type: avail_features
+            for features_type, avail_features in avail_features_full.items()
+            if features_type in features_types
+        }
+
+        return (
+            *[
+                frame.drop(
+                    [column for column in frame.columns if column in unused_columns]
+                )
+                for frame in (train, valid, train_valid, test)
+            ],
+            avail_features_selected,
+        )
+
+    def get(
+        self, features_types: Optional[list[str]] = None
+    ) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame, pl.DataFrame, dict]:
+        if not self.enabled:
+            return DataE2E.run(features_types=features_types)
+
+        # хранится только полный набор признаков, а features_types из него
+        # выбираются: пайплайны с разными типами признаков строят его один раз
+        key = self.fingerprint()
+
+        if key not in _in_process_store:
+            data = self._load(key)
+            if data is None:
+                # при тех же config и коде дообновляем прошлую версию признаков
+                base_key = self.fingerprint(with_inputs=False)
+                if config.INCREMENTAL_FEATURES:
+                    data = self._update_latest(base_key, None)
+                if data is None:
+                    data = DataE2E.run()
+                self._save(key, base_key, data)
+                logger.info(f"Features {key} were built and saved to store")
+            else:
+                logger.info(f"Features {key} were loaded from store")
+            _in_process_store[key] = data
+
+        train, valid, train_valid, test, avail_features_full = self._project(
+            _in_process_store[key], features_types
+        )
+
+        # кадры polars неизменяемы, а словарь отдаём копией
+        return (train, valid, train_valid, test, copy.deepcopy(avail_features_full))
+
+    def get_matrix(
+        self, features_types: Optional[list[str]] = None
+    ) -> tuple[
+        FeatureMatrixSplit,
+        FeatureMatrixSplit,
+        FeatureMatrixSplit,
+        FeatureMatrixSplit,
+        dict,
+    ]:
+        if not self.enabled:
+            return DataE2E.run_matrix(features_types=features_types)
+
+        # матрица без лагов строится быстро, поэтому хранится только в памяти
+        key = "matrix_" + self.fingerprint(features_types)
+
+        if key not in _in_process_store:
+            _in_process_store[key] = DataE2E.run_matrix(features_types=features_types)
+            logger.info(f"Feature matrix {key} was built")
+
+        train, valid, train_valid, test, avail_features_full = _in_process_store[key]
+
+        return (train, valid, train_valid, test, copy.deepcopy(avail_features_full))
@@ -1,108 +1,237 @@
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
 
+import fastexcel
 import pandas as pd
 import polars as pl
 
+import config
+
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
 
-def parse_giga_data(filename: str) -> list[pl.DataFrame]:
-    xls = pd.ExcelFile(filename)
-    sheet_names = xls.sheet_names
+def parse_giga_sheet(filename: str, sheet_name: str) -> Optional[pl.DataFrame]:
+    df_raw = pd.read_excel(filename, header=None, sheet_name=sheet_name)
+
+    block_starts = df_raw[
+        df_raw[0].apply(lambda x: isinstance(x, str))
+        & df_raw.iloc[:, 1:].isna().all(axis=1)
+    ].index.tolist()
+
+    all_blocks = []
+
+    for i, start in enumerate(block_starts):
+        name = str(df_raw.iloc[start, 0]).strip()
+        end = block_starts[i + 1] if i + 1 < len(block_starts) else len(df_raw)
+
+        block = df_raw.iloc[start + 1 : end].copy()
+
+        # удаляем пустые строки
+        block = block.dropna(how="all")
+        if block.empty:
+            continue
+
+        # переименовываем колонки — первая колонка это "year"
+        block.columns = range(block.shape[1])
+        block = block.rename(columns={0: "year"})
+
+        # оставляем только числовые месяцы (1..12)
+        month_cols = [c for c in range(1, 13) if c in block.columns]
+        if not month_cols:
+            continue
+
+        # “расплавляем” в длинный формат
+        block_long = block.melt(
+            id_vars="year",
+            value_vars=month_cols,
+            var_name="month",
+            value_name="value",
+        )
+
+        # чистим от NaN и неправильных годов
+        block_long = block_long.dropna(subset=["year", "value"])
+        block_long = block_long[block_long["year"].apply(lambda x: str(x).isdigit())]
+
+        # === ЧИСТИМ значения ===
+        block_long["value"] = (
+            block_long["value"]
+            .astype(str)
+            .str.replace(
+                r"[^0-9,.\-]", "", regex=True
+            )  # убираем скобки, символы, сноски
+            .str.replace(",", ".", regex=False)  # запятые → точки
+        )
+
+        # Преобразуем в float (невалидные → NaN)
+        block_long["value"] = pd.to_numeric(block_long["value"], errors="coerce")
+
+        # Удаляем пустые значения после очистки
+        block_long = block_long.dropna(subset=["value"])
+        # создаём дату
+        block_long["year"] = block_long["year"].astype(int)
+        block_long["month"] = block_long["month"].astype(int)
+        block_long["date"] = pd.to_datetime(
+            block_long["year"].astype(str)
+            + "-"
+            + block_long["month"].astype(str)
+            + "-01"
+        )
+
+        block_long["indicator"] = name
+
+        all_blocks.append(block_long[["date", "indicator", "value"]])
+
+    if not all_blocks:
+        return None
+
+    result_long = pd.concat(all_blocks, ignore_index=True)
+    parsed_list = pd.pivot(
+        result_long, index="date", columns="indicator", values="value"
+    )
+
+    return pl.DataFrame(parsed_list.reset_index()).with_columns(
+        pl.col("date").cast(pl.Date).alias("date")
+    )
+
+
+def parse_giga_sheet_calamine(
+    reader: fastexcel.ExcelReader, sheet_name: str
+) -> Optional[pl.DataFrame]:
+    # все ячейки читаем строками: так год, название блока и значения
+    # со сносками чистятся одним и тем же образом
+    df_raw = reader.load_sheet(sheet_name, header_row=None, dtypes="string").to_polars()
+    if df_raw.width < 2:
+        return None
+
+    first_col, other_cols = df_raw.columns[0], df_raw.columns[1:]
+    month_cols = other_cols[:12]
+
+    # начало блока — текст в первой колонке и пустая остальная строка
+    is_block_start = (
+        pl.col(first_col).is_not_null()
+        & ~pl.col(first_col).str.contains(r"^\d+$")
+        & pl.all_horizontal(pl.col(other_cols).is_null())
+    )
+
+    block_long = (
+        df_raw.with_columns(
+            pl.when(is_block_start)
+            .then(pl.col(first_col).str.strip_chars())
+            .forward_fill()
+            .alias("indicator"),
+            is_block_start.alias("is_block_start"),
+        )
+        .filter(pl.col("indicator").is_not_null() & ~pl.col("is_block_start"))
+        .select(
+            pl.col(first_col).alias("year"),
+            "indicator",
+            *[pl.col(col).alias(str(month)) for month, col in enumerate(month_cols, 1)],
+        )
+        .unpivot(index=["year", "indicator"], variable_name="month")
+        # чистим от пустых значений и неправильных годов
+        .filter(
+            pl.col("value").is_not_null()
+            & pl.col("year").is_not_null()
+            & pl.col("year").str.contains(r"^\d+$")
+        )
+        # убираем скобки, символы, сноски; запятые → точки
+        .with_columns(
+            pl.col("value")
+            .str.replace_all(r"[^0-9,.\-]", "")
+            .str.replace_all(",", ".", literal=True)
+            .cast(pl.Float64, strict=False)
+        )
+        .drop_nulls("value")
+        .select(
+            pl.date(
+                pl.col("year").cast(pl.Int32), pl.col("month").cast(pl.Int8), 1
+            ).alias("date"),
+            "indicator",
+            "value",
+        )
+    )
+
+    if block_long.is_empty():
+        return None
+
+    parsed_list = block_long.pivot(
+        on="indicator", index="date", values="value", aggregate_function=None
+    ).sort("date")
+
+    return parsed_list.select(
+        ["date"] + sorted(col for col in parsed_list.columns if col != "date")
+    )
+
+
+def _parse_giga_sheets_calamine_chunk(
+    filename: str, sheet_names: list[str]
+) -> dict[str, Optional[pl.DataFrame]]:
+    # книга открывается один раз на процесс, листы читаются из неё
+    reader = fastexcel.read_excel(filename)
+
+    parsed = {}
+    for sheet_name in sheet_names:
+        try:
+            parsed[sheet_name] = parse_giga_sheet_calamine(reader, sheet_name)
+        except Exception as e:
+            logger.info(f"List {sheet_name} was not parsed: {e}")
+            parsed[sheet_name] = None
+
+    return parsed
 
-    parsed_result = []
 
+def _parse_giga_sheets_pandas(
+    filename: str, sheet_names: list[str]
+) -> dict[str, Optional[pl.DataFrame]]:
+    parsed = {}
     for sheet_name in sheet_names:
         try:
-            df_raw = pd.read_excel(filename, header=None, sheet_name=sheet_name)
-
-            block_starts = df_raw[
-                df_raw[0].apply(lambda x: isinstance(x, str))
-                & df_raw.iloc[:, 1:].isna().all(axis=1)
-            ].index.tolist()
-
-            all_blocks = []
-
-            for i, start in enumerate(block_starts):
-                name = str(df_raw.iloc[start, 0]).strip()
-                end = block_starts[i + 1] if i + 1 < len(block_starts) else len(df_raw)
-
-                block = df_raw.iloc[start + 1 : end].copy()
-
-                # удаляем пустые строки
-                block = block.dropna(how="all")
-                if block.empty:
-                    continue
-
-                # переименовываем колонки — первая колонка это "year"
-                block.columns = range(block.shape[1])
-                block = block.rename(columns={0: "year"})
-
-                # оставляем только числовые месяцы (1..12)
-                month_cols = [c for c in range(1, 13) if c in block.columns]
-                if not month_cols:
-                    continue
-
-                # “расплавляем” в длинный формат
-                block_long = block.melt(
-                    id_vars="year",
-                    value_vars=month_cols,
-                    var_name="month",
-                    value_name="value",
-                )
-
-                # чистим от NaN и неправильных годов
-                block_long = block_long.dropna(subset=["year", "value"])
-                block_long = block_long[
-                    block_long["year"].apply(lambda x: str(x).isdigit())
-                ]
-
-                # === ЧИСТИМ значения ===
-                block_long["value"] = (
-                    block_long["value"]
-                    .astype(str)
-                    .str.replace(
-                        r"[^0-9,.\-]", "", regex=True
-                    )  # убираем скобки, символы, сноски
-                    .str.replace(",", ".", regex=False)  # запятые → точки
-                )
-
-                # Преобразуем в float (невалидные → NaN)
-                block_long["value"] = pd.to_numeric(
-                    block_long["value"], errors="coerce"
-                )
-
-                # Удаляем пустые значения после очистки
-                block_long = block_long.dropna(subset=["value"])
-                # создаём дату
-                block_long["year"] = block_long["year"].astype(int)
-                block_long["month"] = block_long["month"].astype(int)
-                block_long["date"] = pd.to_datetime(
-                    block_long["year"].astype(str)
-                    + "-"
-                    + block_long["month"].astype(str)
-                    + "-01"
-                )
-
-                block_long["indicator"] = name
-
-                all_blocks.append(block_long[["date", "indicator", "value"]])
-
-                result_long = pd.concat(all_blocks, ignore_index=True)
-                parsed_list = pd.pivot(
-                    result_long, index="date", columns="indicator", values="value"
-                )
-
-                parsed_list_polars = pl.DataFrame(
-                    parsed_list.reset_index()
-                ).with_columns(pl.col("date").cast(pl.Date).alias("date"))
-
-            parsed_result.append(parsed_list_polars)
-            # logger.info(f'List {sheet_name} was succesfully parsed')
+            parsed[sheet_name] = parse_giga_sheet(filename, sheet_name)
         except Exception as e:
-            pass
-            # logger.info(f'List {sheet_name} was not parsed')
-            # logger.error(f'ERROR message: {e}')
-
-    return parsed_result
+            logger.info(f"List {sheet_name} was not parsed: {e}")
+            parsed[sheet_name] = None
+
+    return parsed
+
+
+def parse_giga_sheets(
+    filename: str,
+    sheet_names: Optional[list[str]] = None,
+    engine: str = config.GIGA_PARSER_ENGINE,
+    max_workers: int = config.GIGA_PARSER_WORKERS,
+) -> dict[str, Optional[pl.DataFrame]]:
+    if sheet_names is None:
+        sheet_names = fastexcel.read_excel(filename).sheet_names
+
+    if engine == "pandas":
+        return _parse_giga_sheets_pandas(filename, sheet_names)
+    elif engine != "calamine":
+        raise ValueError("engine must be 'calamine' (default) or 'pandas'")
+
+    n_workers = min(max_workers, len(sheet_names))
+    if n_workers <= 1:
+        return _parse_giga_sheets_calamine_chunk(filename, sheet_names)
+
+    # листы раскладываем по процессам, каждый процесс открывает книгу один раз
+    chunks = [sheet_names[i::n_workers] for i in range(n_workers)]
+    parsed = {}
+    with ProcessPoolExecutor(
+        max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        for chunk_parsed in executor.map(
+            _parse_giga_sheets_calamine_chunk, [filename] * n_workers, chunks
+        ):
+            parsed.update(chunk_parsed)
+
+    return {sheet_name: parsed[sheet_name] for sheet_name in sheet_names}
+
+
+def parse_giga_data(
+    filename: str, engine: str = config.GIGA_PARSER_ENGINE
+) -> list[pl.DataFrame]:
+    parsed_result = parse_giga_sheets(filename, engine=engine)
+
+    return [sheet for sheet in parsed_result.values() if sheet is not None]
@@ -2,11 +2,12 @@ import attrs
 import polars as pl
 
 import config
+from preprocess_data.prepare_data import FrameT
 
 
 @attrs.define(slots=True)
 class LagsService:
-    features: pl.DataFrame
+    features: FrameT
 
     def _dict_to_list(self, features_dict: dict) -> list:
         if isinstance(features_dict, dict):
@@ -43,8 +44,24 @@ class LagsService:
 
         self.features = self.features.with_columns(lags_expr)
 
-    def get_lags(self, columns_d4: list[str], features_dict: dict) -> pl.DataFrame:
+    def get_lags(self, columns_d4: list[str], features_dict: dict) -> FrameT:
         self._get_monthly_lags(features_dict)
         self._get_quarterly_lags(columns_d4)
 
         return self.features
+
+    def get_lags_tail(
+        self, history: pl.DataFrame, columns_d4: list[str], features_dict: dict
+    ) -> pl.DataFrame:
+        # self.features — только новые строки; для их лагов достаточно
+        # HORIZON последних уже посчитанных строк истории
+        new_rows_count = self.features.height
+        self.features = pl.concat(
+            [
+                history.select(self.features.columns).tail(config.HORIZON),
+                self.features,
+            ],
+            how="vertical_relaxed",
+        )
+
+        return self.get_lags(columns_d4, features_dict).tail(new_rows_count)
@@ -1,6 +1,8 @@
 import attrs
 import polars as pl
 
+from preprocess_data.prepare_data import FrameT
+
 
 @attrs.define(slots=True)
 class MonthlyToQuarterlyService:
@@ -8,110 +10,96 @@ class MonthlyToQuarterlyService:
     columns_rolling: list
     avail_features_full: dict = {}
 
-    def _split_by_columns(
-        self, monthly_data: pl.DataFrame, columns_to_fit: list
-    ) -> tuple[pl.DataFrame, dict]:
-
-        avail_features = {}
-
-        monthly_data_selected_columns = monthly_data.with_columns(
-            [((pl.col("datem").dt.month() - 1) % 3 + 1).alias("month_in_quarter")]
-        ).select(["datem", "month_in_quarter"] + columns_to_fit)
-
-        first_month_data = (
-            monthly_data_selected_columns.filter(pl.col("month_in_quarter") == 1)
-            .rename(
-                {
-                    column: column + "_m1"
-                    for column in monthly_data_selected_columns.columns
-                    if column != "datem" and column != "month_in_quarter"
-                }
-            )
-            .drop("month_in_quarter")
-            .with_columns(
-                pl.col("datem").dt.year().alias("year"),
-                pl.col("datem").dt.quarter().alias("quarter"),
-            )
-        )
-        avail_features[1] = first_month_data.drop(["datem", "year", "quarter"]).columns
-
-        second_month_data = (
-            monthly_data_selected_columns.filter(pl.col("month_in_quarter") == 2)
-            .rename(
-                {
-                    column: column + "_m2"
-                    for column in monthly_data_selected_columns.columns
-                    if column != "datem" and column != "month_in_quarter"
-                }
-            )
-            .with_columns(
-                pl.col("datem").dt.year().alias("year"),
-                pl.col("datem").dt.quarter().alias("quarter"),
-            )
-            .drop("month_in_quarter", "datem")
-        )
-        avail_features[2] = second_month_data.drop(["year", "quarter"]).columns
-
-        third_month_data = (
-            monthly_data_selected_columns.filter(pl.col("month_in_quarter") == 3)
-            .rename(
-                {
-                    column: column + "_m3"
-                    for column in monthly_data_selected_columns.columns
-                    if column != "datem" and column != "month_in_quarter"
-                }
-            )
-            .with_columns(
-                pl.col("datem").dt.year().alias("year"),
-                pl.col("datem").dt.quarter().alias("quarter"),
-            )
-            .drop("month_in_quarter", "datem")
+    @staticmethod
+    def _take_columns(frame: FrameT, columns: list, suffix: str = "") -> FrameT:
+        # у DataFrame выборка и переименование без построения выражений:
+        # на тысячах колонок это заметно быстрее select/rename
+        if isinstance(frame, pl.DataFrame):
+            taken = frame[columns]
+            taken.columns = [column + suffix for column in columns]
+            return taken
+
+        return frame.select(columns).rename(
+            {column: column + suffix for column in columns}
         )
-        avail_features[3] = third_month_data.drop(["year", "quarter"]).columns
-
-        monthly_data_quarterly_split = first_month_data.join(
-            second_month_data, on=["year", "quarter"], how="left"
-        ).join(third_month_data, on=["year", "quarter"], how="left")
-
-        return monthly_data_quarterly_split, avail_features
 
-    def _split_monthly_to_quarterly(self, monthly_data: pl.DataFrame) -> dict:
-
-        self.avail_features_full = {"rolling": {}, "d12": {}}
-
-        rolling_features, avail_features_rolling = self._split_by_columns(
-            monthly_data, self.columns_rolling
+    @staticmethod
+    def _split_by_columns(columns_to_fit: list) -> dict:
+        return {
+            month: [column + f"_m{month}" for column in columns_to_fit]
+            for month in range(1, 4)
+        }
+
+    def _split_monthly_to_quarterly(self, monthly_data: FrameT) -> FrameT:
+
+        self.avail_features_full = {
+            "rolling": self._split_by_columns(self.columns_rolling),
+            "d12": self._split_by_columns(self.columns_d12),
+        }
+
+        # сетка месяцев от начала первого до конца последнего квартала:
+        # тогда i-й месяц квартала — это каждая третья строка со сдвигом i - 1;
+        # left join не обязан сохранять порядок строк, поэтому сетка сортируется
+        calendar = monthly_data.select(
+            pl.date_range(
+                pl.col("datem").min().dt.truncate("1q"),
+                pl.col("datem").max().dt.truncate("1q").dt.offset_by("2mo"),
+                interval="1mo",
+            ).alias("datem")
         )
-        self.avail_features_full["rolling"] = avail_features_rolling
-        d12_features, avail_features_d12 = self._split_by_columns(
-            monthly_data, self.columns_d12
-        )
-        self.avail_features_full["d12"] = avail_features_d12
+        monthly_grid = calendar.join(
+            self._take_columns(
+                monthly_data, ["datem"] + self.columns_d12 + self.columns_rolling
+            ).with_columns(pl.lit(True).alias("month_in_data")),
+            on="datem",
+            how="left",
+        ).sort("datem")
+        by_month = {
+            month: monthly_grid.gather_every(3, offset=month - 1)
+            for month in range(1, 4)
+        }
 
         features_mtoq = pl.concat(
-            [d12_features, rolling_features.drop(["datem", "year", "quarter"])],
+            [
+                self._take_columns(by_month[1], ["datem", "month_in_data"]),
+                self._take_columns(by_month[1], self.columns_d12, "_m1"),
+                by_month[1].select(
+                    pl.col("datem").dt.year().alias("year"),
+                    pl.col("datem").dt.quarter().alias("quarter"),
+                ),
+                self._take_columns(by_month[2], self.columns_d12, "_m2"),
+                self._take_columns(by_month[3], self.columns_d12, "_m3"),
+                self._take_columns(by_month[1], self.columns_rolling, "_m1"),
+                self._take_columns(by_month[2], self.columns_rolling, "_m2"),
+                self._take_columns(by_month[3], self.columns_rolling, "_m3"),
+            ],
             how="horizontal",
         )
 
+        # кварталы без первого месяца в данных не берём, как и раньше
+        features_mtoq = features_mtoq.filter(
+            pl.col("month_in_data").is_not_null()
+        ).drop("month_in_data")
+
         return features_mtoq
 
     def _join_quarterly_data(
-        self, features_mtoq: pl.DataFrame, quarterly_data: pl.DataFrame
-    ) -> pl.DataFrame:
+        self, features_mtoq: FrameT, quarterly_data: FrameT
+    ) -> FrameT:
         joined = quarterly_data.rename({"dateq": "date"}).join(
             features_mtoq.rename({"datem": "date"}), on="date"
         )
 
         return joined
 
-    def run_transorm(
-        self, monthly_data: pl.DataFrame, quarterly_data: pl.DataFrame
-    ) -> pl.DataFrame:
+    def run_transorm(self, monthly_data: FrameT, quarterly_data: FrameT) -> FrameT:
         features_mtoq = self._split_monthly_to_quarterly(monthly_data)
         features = self._join_quarterly_data(features_mtoq, quarterly_data)
 
         features = features.drop(["year", "quarter"])
-        features = features.select(
-            ["date"] + [col for col in features.columns if col != "date"]
+        features = self._take_columns(
+            features,
+            ["date"]
+            + [col for col in features.collect_schema().names() if col != "date"],
         )
         return features
@@ -1,15 +1,20 @@
 import logging
+from datetime import date
+from typing import Optional, Union
 
 import attrs
 import polars as pl
+from dateutil.relativedelta import relativedelta
 
 import config
 from eng_ru_names_dict import chain_indeces, eng_ru_quarterly_dict
-from preprocess_data.gigadata_parser import parse_giga_data
+from preprocess_data.cache_service import RawDataCache
 
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
+FrameT = Union[pl.DataFrame, pl.LazyFrame]
+
 
 @attrs.define(slots=True)
 class FeaturesService:
@@ -20,21 +25,22 @@ class FeaturesService:
 
     @staticmethod
     def _read_monthly_data() -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+        raw_cache = RawDataCache()
 
         cbr_data_raw = (
-            pl.read_excel(config.CBR_DATA_PATH)
+            raw_cache.read_excel(config.CBR_DATA_PATH)
             .with_columns(pl.col("date").cast(pl.Date).alias("datem"))
             .drop("date")
         )
 
         fred_data_raw = (
-            pl.read_excel(config.FRED_DATA_PATH)
+            raw_cache.read_excel(config.FRED_DATA_PATH)
             .with_columns(pl.col("date").cast(pl.Date).alias("datem"))
             .drop("date")
         )
 
         quarterly_data_raw = (
-            pl.read_excel(config.QUARTERLY_DATA_PATH)
+            raw_cache.read_excel(config.QUARTERLY_DATA_PATH)
             .with_columns(pl.col("date").cast(pl.Date).alias("dateq"))
             .with_columns(
                 pl.col("dateq").dt.quarter().alias("quarter"),
@@ -48,7 +54,7 @@ class FeaturesService:
 
     @staticmethod
     def _parse_giga_data() -> pl.DataFrame:
-        giga_data_list = parse_giga_data(config.GIGA_DATA_PATH)
+        giga_data_list = RawDataCache().read_giga_sheets(config.GIGA_DATA_PATH)
 
         min_date = min(sheet["date"].min() for sheet in giga_data_list)
         max_date = max(sheet["date"].max() for sheet in giga_data_list)
@@ -89,22 +95,24 @@ class FeaturesService:
     ) -> pl.DataFrame:
         giga_data = giga_data.sort("datem")
 
+        # первое непустое значение — база, дальше накопленное произведение x/100;
+        # пропуски цепочку не прерывают и остаются пустыми
+        base_index_expr = []
         for column in chain_indeces:
-            chain_series = giga_data[column]
-            first_non_null = chain_series.drop_nulls()[0]
-
-            base_index = []
-            last_value = None
-            for x in chain_series:
-                if x is None:
-                    base_index.append(None)
-                else:
-                    if last_value is None:
-                        last_value = first_non_null
-                    else:
-                        last_value = last_value * x / 100
-                    base_index.append(last_value)
-            giga_data = giga_data.with_columns(pl.Series(column, base_index))
+            chain = pl.col(column).cast(pl.Float64)
+            is_first = chain.is_not_null() & (chain.is_not_null().cum_sum() == 1)
+            chain_factor = (
+                pl.when(chain.is_null())
+                .then(1.0)
+                .when(is_first)
+                .then(chain)
+                .otherwise(chain / 100)
+            )
+            base_index_expr.append(
+                pl.when(chain.is_not_null()).then(chain_factor.cum_prod()).alias(column)
+            )
+
+        giga_data = giga_data.with_columns(base_index_expr)
 
         return giga_data
 
@@ -118,23 +126,29 @@ class FeaturesService:
         )
         return monthly_data
 
-    def _get_features_monthly(self, monthly_data: pl.DataFrame) -> pl.DataFrame:
+    def _get_features_monthly(
+        self, monthly_data: FrameT, start_date: Optional[date] = None
+    ) -> FrameT:
         monthly_data = monthly_data.sort("datem")
 
-        def get_possibly_log_variables(monthly_data: pl.DataFrame) -> list[str]:
-            columns_possibly_log = []
-            for column in monthly_data.columns:
-
-                if column != "datem":
-                    negative_count = monthly_data.filter(pl.col(column) <= 0).height
-                    if negative_count == 0:
-                        columns_possibly_log.append(column)
+        def get_possibly_log_variables(monthly_data: FrameT) -> list[str]:
+            columns = [
+                column
+                for column in monthly_data.collect_schema().names()
+                if column != "datem"
+            ]
+            # одна агрегация по всем колонкам вместо фильтра на каждую
+            has_non_positive = monthly_data.select(
+                [(pl.col(column) <= 0).any() for column in columns]
+            )
+            if isinstance(has_non_positive, pl.LazyFrame):
+                has_non_positive = has_non_positive.collect()
 
-            return columns_possibly_log
+            return [column for column in columns if not has_non_positive[column].item()]
 
         columns_possibly_log = get_possibly_log_variables(monthly_data)
         columns_not_possibly_log = list(
-            set(monthly_data.columns) - set(columns_possibly_log)
+            set(monthly_data.collect_schema().names()) - set(columns_possibly_log)
         )
         columns_not_possibly_log = [
             column for column in columns_not_possibly_log if column != "datem"
@@ -163,6 +177,14 @@ class FeaturesService:
 
         self.columns_d12 = columns_d12_log + columns_d12_no_log
 
+        # при дообновлении считаем только хвост: новые месяцы плюс окно,
+        # которое нужно для d12 и самого длинного скользящего среднего
+        if start_date is not None:
+            lookback_months = 12 + max(config.ROLLING_WINDOWS_MONTH) - 1
+            monthly_data = monthly_data.filter(
+                pl.col("datem") >= start_date - relativedelta(months=lookback_months)
+            )
+
         monthly_data = monthly_data.with_columns(d12_log_expr).with_columns(
             d12_no_log_expr
         )
@@ -181,9 +203,12 @@ class FeaturesService:
 
         monthly_data = monthly_data.with_columns(rolling_mean_d12)
 
+        if start_date is not None:
+            monthly_data = monthly_data.filter(pl.col("datem") >= start_date)
+
         return monthly_data
 
-    def _prepare_quarterly_data(self, quarterly_data_raw: pl.DataFrame) -> pl.DataFrame:
+    def _prepare_quarterly_data(self, quarterly_data_raw: FrameT) -> FrameT:
         quarterly_transform_expr = []
         quarterly_transform = {}
 
@@ -200,15 +225,34 @@ class FeaturesService:
         quarterly_data = quarterly_data_raw.with_columns(quarterly_transform_expr)
         return quarterly_data
 
-    def get_features(self) -> tuple[pl.DataFrame, pl.DataFrame]:
+    def get_raw_data(self) -> tuple[pl.DataFrame, pl.DataFrame]:
         cbr_data_raw, fred_data_raw, quarterly_data_raw = self._read_monthly_data()
         giga_data = self._parse_giga_data()
         giga_data = self._convert_indeces_to_basics(giga_data, chain_indeces)
         joined_monthly_data = self._join_monhtly_data(
             giga_data, fred_data_raw, cbr_data_raw
         )
-        monthly_features = self._get_features_monthly(joined_monthly_data)
 
+        return joined_monthly_data, quarterly_data_raw
+
+    def get_features_from_raw(
+        self,
+        monthly_data_raw: pl.DataFrame,
+        quarterly_data_raw: pl.DataFrame,
+        lazy: bool = False,
+        start_date: Optional[date] = None,
+    ) -> tuple[FrameT, FrameT]:
+        # в ленивом режиме признаки только описываются, считаются при collect
+        if lazy:
+            monthly_data_raw = monthly_data_raw.lazy()
+            quarterly_data_raw = quarterly_data_raw.lazy()
+
+        monthly_features = self._get_features_monthly(monthly_data_raw, start_date)
         quarterly_data = self._prepare_quarterly_data(quarterly_data_raw)
 
         return monthly_features, quarterly_data
+
+    def get_features(self, lazy: bool = False) -> tuple[FrameT, FrameT]:
+        monthly_data_raw, quarterly_data_raw = self.get_raw_data()
+
+        return self.get_features_from_raw(monthly_data_raw, quarterly_data_raw, lazy)